@@ -0,0 +1,87 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sqlite3
+import threading
+
+from spectrometer.openstack.common import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+CACHE_FILE_NAME = '.commit_cache.sqlite'
+BULK_READ_SIZE = 500
+# seconds a writer waits for another one holding the database lock
+BUSY_TIMEOUT = 60
+
+
+class CommitCache(object):
+    """Commits parsed from git log keyed by commit id.
+
+    Commits are immutable, so a commit once parsed together with its diff
+    stat never needs to be read from git again. Every thread uses its own
+    connection, writers of different threads wait for each other.
+    """
+
+    def __init__(self, sources_root):
+        self.path = os.path.join(sources_root, CACHE_FILE_NAME)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if not connection:
+            LOG.debug('Open commit cache %s', self.path)
+            # the connection is used by this thread only, close() may be
+            # called from another one
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                         check_same_thread=False)
+            connection.execute('CREATE TABLE IF NOT EXISTS commits '
+                               '(commit_id TEXT PRIMARY KEY, '
+                               'data TEXT NOT NULL)')
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def get_many(self, commit_ids):
+        connection = self._connect()
+        commit_ids = list(commit_ids)
+        result = {}
+        for i in range(0, len(commit_ids), BULK_READ_SIZE):
+            chunk = commit_ids[i:i + BULK_READ_SIZE]
+            cursor = connection.execute(
+                'SELECT commit_id, data FROM commits WHERE commit_id IN '
+                '(%s)' % ','.join('?' * len(chunk)), chunk)
+            for commit_id, data in cursor:
+                result[str(commit_id)] = json.loads(data)
+        return result
+
+    def set_many(self, commits):
+        connection = self._connect()
+        connection.executemany(
+            'INSERT OR REPLACE INTO commits (commit_id, data) VALUES (?, ?)',
+            [(c['commit_id'], json.dumps(c)) for c in commits])
+        connection.commit()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
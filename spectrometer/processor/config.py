@@ -23,6 +23,26 @@ OPTS = [
                help='URI for default data'),
     cfg.StrOpt('sources-root', default='/var/local/spectrometer',
                help='The folder that holds all project sources to analyze'),
+    cfg.StrOpt('vcs-backend', default='git',
+               help='The way git repositories are read: "git" runs the git '
+                    'command line, "libgit2" reads objects in-process '
+                    'through pygit2'),
+    cfg.IntOpt('maintenance-time-budget', default=600,
+               help='Time in seconds the processor may spend at the end of '
+                    'a run on maintenance of repos in sources root '
+                    '(commit-graph, repack, prune), 0 disables it'),
+    cfg.StrOpt('metrics-file',
+               help='File the timings and counters of every processor run '
+                    'are appended to as a line of JSON, '
+                    'processor_metrics.json in sources root if not set'),
+    cfg.StrOpt('profile', choices=['cprofile', 'sampling'],
+               help='Profile top-level stages of the run: "cprofile" '
+                    'traces every call, "sampling" takes stacks '
+                    'periodically and is cheap enough for regular runs'),
+    cfg.StrOpt('profile-dir', default='.',
+               help='The folder profiles of stages are written to'),
+    cfg.FloatOpt('profile-interval', default=0.01,
+                 help='Seconds between samples of the sampling profiler'),
     cfg.StrOpt('runtime-storage-uri', default='memcached://127.0.0.1:11211',
                help='Storage URI'),
     cfg.StrOpt('listen-host', default='127.0.0.1',
@@ -31,16 +51,67 @@ OPTS = [
                help='The port dashboard listens on'),
     cfg.IntOpt('days_to_update_members', default=7,
                help='Number of days to update members'),
+    cfg.IntOpt('member-crawl-concurrency', default=4,
+               help='Maximum number of member profiles fetched '
+                    'concurrently'),
+    cfg.FloatOpt('member-crawl-rate-limit', default=10,
+                 help='Maximum number of member profile requests per second, '
+                      '0 for no limit'),
     cfg.StrOpt('corrections-uri',
                default=('https://raw.githubusercontent.com/dave-tucker/'
                         'spectrometer/master/etc/corrections.json'),
                help='The address of file with corrections data'),
     cfg.StrOpt('review-uri', default='gerrit://git.opendaylight.org',
-               help='URI of review system'),
+               help='URI of review system, gerrit://host[:port] for SSH '
+                    'or https+gerrit://host/path for the REST API'),
     cfg.StrOpt('ssh-key-filename', default='/home/user/.ssh/id_rsa',
                help='SSH key for gerrit review system access'),
     cfg.StrOpt('ssh-username', default='user',
                help='SSH username for gerrit review system access'),
+    cfg.IntOpt('gerrit-channels', default=4,
+               help='Maximum number of Gerrit queries run concurrently over '
+                    'the SSH or HTTP connections'),
+    cfg.BoolOpt('gerrit-project-queries', default=False,
+                help='Query reviews of all tracked branches of a project at '
+                     'once instead of one query per branch'),
+    cfg.IntOpt('mail-archive-concurrency', default=4,
+               help='Maximum number of mail list pages and archives '
+                    'downloaded concurrently'),
+    cfg.IntOpt('http-timeout', default=60,
+               help='Timeout in seconds of HTTP requests to mail lists, '
+                    'member directories and Gerrit'),
+    cfg.IntOpt('http-connections-per-host', default=8,
+               help='Maximum number of HTTP requests run concurrently '
+                    'against one host, 0 means unlimited'),
+    cfg.IntOpt('http-retries', default=3,
+               help='Number of retries of an HTTP request failed with a '
+                    'connection error or a server error status, waiting '
+                    'twice as long after each'),
+    cfg.BoolOpt('daemon', default=False,
+                help='Keep running and update every source on its own '
+                     'schedule instead of exiting after a single pass'),
+    cfg.DictOpt('daemon-intervals',
+                default={'default-data': 3600, 'git': 300, 'gerrit': 120,
+                         'mail': 3600, 'members': 86400,
+                         'corrections': 3600, 'update': 300,
+                         'maintenance': 86400},
+                help='Seconds between the end of a run of a source and the '
+                     'start of the next one in daemon mode, 0 disables the '
+                     'source'),
+    cfg.DictOpt('daemon-priorities',
+                default={'default-data': 60, 'gerrit': 50, 'git': 40,
+                         'update': 30, 'corrections': 20, 'mail': 20,
+                         'members': 10, 'maintenance': 0},
+                help='Priorities of sources in daemon mode, a higher one '
+                     'runs first when several sources are due'),
+    cfg.IntOpt('pipeline-queue-size', default=256,
+               help='Maximum number of records a stage of the import '
+                    'pipeline runs ahead of the next one, 0 runs all '
+                    'stages in one thread'),
+    cfg.IntOpt('checkpoint-interval', default=1000,
+               help='Number of commits or reviews after which the progress '
+                    'of a long import is stored, so an interrupted run '
+                    'resumes from there, 0 disables checkpoints'),
     cfg.BoolOpt('force-update', default=False,
                 help='Forcibly read default data and update records'),
     cfg.StrOpt('program-list-uri',
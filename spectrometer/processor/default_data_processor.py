@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import collections
+import copy
 import hashlib
 import json
 
@@ -28,6 +29,8 @@ from spectrometer.processor import vcs
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_DATA_KEY = 'default_data'
+
 
 def _check_default_data_change(runtime_storage_inst, default_data):
     h = hashlib.new('sha1')
@@ -152,8 +155,6 @@ STORE_FUNCS = {
 
 
 def _store_default_data(runtime_storage_inst, default_data):
-    normalizer.normalize_default_data(default_data)
-
     LOG.debug('Update runtime storage with default data')
     for key, value in six.iteritems(default_data):
         if key in STORE_FUNCS:
@@ -162,12 +163,44 @@ def _store_default_data(runtime_storage_inst, default_data):
             runtime_storage_inst.set_by_key(key, value)
 
 
-def _update_records(runtime_storage_inst, sources_root):
-    LOG.debug('Update existing records')
+def _get_section_key(section):
+    return DEFAULT_DATA_KEY + ':' + section
+
+
+def _get_applied_data(runtime_storage_inst):
+    sections = runtime_storage_inst.get_by_key(DEFAULT_DATA_KEY)
+    if not sections:
+        return None
+    return dict((section, runtime_storage_inst.get_by_key(
+        _get_section_key(section))) for section in sections)
+
+
+def _store_applied_data(runtime_storage_inst, applied_data):
+    # sections are stored apart, the whole data may exceed the size limit
+    # of a memcached item. Data stored partially is not used for a diff
+    runtime_storage_inst.set_by_key(DEFAULT_DATA_KEY, None)
+    try:
+        for section, value in six.iteritems(applied_data):
+            runtime_storage_inst.set_by_key(_get_section_key(section), value)
+    except Exception as e:
+        LOG.error('Unable to store applied default data, its next change '
+                  'updates all records')
+        LOG.exception(e)
+        return
+    runtime_storage_inst.set_by_key(DEFAULT_DATA_KEY, sorted(applied_data))
+
+
+def _get_release_index(runtime_storage_inst, sources_root):
     release_index = {}
     for repo in utils.load_repos(runtime_storage_inst):
         vcs_inst = vcs.get_vcs(repo, sources_root)
         release_index.update(vcs_inst.get_release_index())
+    return release_index
+
+
+def _update_records(runtime_storage_inst, sources_root):
+    LOG.debug('Update existing records')
+    release_index = _get_release_index(runtime_storage_inst, sources_root)
 
     record_processor_inst = record_processor.RecordProcessor(
         runtime_storage_inst)
@@ -213,15 +246,108 @@ def _update_members_company_name(runtime_storage_inst):
         runtime_storage_inst._commit_update(record_id)
 
 
+def _diff_items(old_items, new_items):
+    """Returns items found only in the old list and only in the new one.
+
+    A changed item is found in both, as its old and its new version.
+    """
+    def dump(item):
+        return json.dumps(item, sort_keys=True)
+
+    old_dumps = set(dump(item) for item in old_items)
+    new_dumps = set(dump(item) for item in new_items)
+    return ([item for item in old_items if dump(item) not in new_dumps],
+            [item for item in new_items if dump(item) not in old_dumps])
+
+
+def _get_default_data_changes(old_data, new_data):
+    """Maps changed sections of default data to their changes.
+
+    Users and companies are mapped to tuples (removed items, added items),
+    other sections to True.
+    """
+    changes = {}
+    for section in set(old_data) | set(new_data):
+        old_value = old_data.get(section)
+        new_value = new_data.get(section)
+        if old_value == new_value:
+            continue
+        if section in ('users', 'companies'):
+            changes[section] = _diff_items(old_value or [], new_value or [])
+        else:
+            changes[section] = True
+    return changes
+
+
+def _apply_default_data_changes(runtime_storage_inst, default_data, changes,
+                                sources_root):
+    """Stores default data, updates only records affected by the changes."""
+    LOG.debug('Apply changes of default data sections: %s', sorted(changes))
+    removed_users, added_users = changes.get('users', ([], []))
+    removed_companies, added_companies = changes.get('companies', ([], []))
+
+    # stored profiles are merged with changed users only
+    _store_default_data(runtime_storage_inst,
+                        dict(default_data, users=added_users))
+    record_processor_inst = record_processor.RecordProcessor(
+        runtime_storage_inst)
+
+    user_ids = set()
+    emails = set()
+    for user in removed_users + added_users:
+        if user.get('ldap_id'):
+            user_ids.add(user['ldap_id'])
+        emails.update(email.lower() for email in user.get('emails', []))
+    domains = set()
+    for company in removed_companies + added_companies:
+        domains.update(domain for domain in company['domains'] if domain)
+    if user_ids or emails or domains:
+        LOG.info('Update records of %(users)s users, %(emails)s emails and '
+                 '%(domains)s domains',
+                 {'users': len(user_ids), 'emails': len(emails),
+                  'domains': len(domains)})
+        record_processor_inst.update_user_info(user_ids, emails, domains)
+
+    # repos carry release tags
+    if 'releases' in changes or 'repos' in changes:
+        LOG.info('Update releases of records')
+        record_processor_inst.update_releases(
+            _get_release_index(runtime_storage_inst, sources_root))
+
+    if 'companies' in changes:
+        _update_members_company_name(runtime_storage_inst)
+
+
 def process(runtime_storage_inst, default_data, sources_root, force_update):
+    """Stores changed default data and updates records affected by it.
+
+    Default data is compared with the one applied last time, only records
+    of changed users, companies and releases are updated. The first run
+    and forced update process all the records.
+    """
     LOG.debug('Process default data')
 
     dd_changed = _check_default_data_change(runtime_storage_inst, default_data)
+    if not dd_changed and not force_update:
+        return False
+
+    applied_data = _get_applied_data(runtime_storage_inst)
+    changes = None
+    if applied_data and not force_update:
+        changes = _get_default_data_changes(applied_data, default_data)
+    applied_data = copy.deepcopy(default_data)
 
     if 'project_sources' in default_data:
         _update_project_list(default_data)
+    normalizer.normalize_default_data(default_data)
 
-    if dd_changed or force_update:
+    if changes is None:
         _store_default_data(runtime_storage_inst, default_data)
         _update_records(runtime_storage_inst, sources_root)
         _update_members_company_name(runtime_storage_inst)
+    else:
+        _apply_default_data_changes(runtime_storage_inst, default_data,
+                                    changes, sources_root)
+
+    _store_applied_data(runtime_storage_inst, applied_data)
+    return True
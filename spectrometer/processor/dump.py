@@ -20,6 +20,7 @@ from oslo.config import cfg
 
 from spectrometer.openstack.common import log as logging
 from spectrometer.processor import config
+from spectrometer.processor import profiler
 from spectrometer.processor import runtime_storage
 
 
@@ -44,6 +45,7 @@ def read_records_from_fd(fd):
         yield record
 
 
+@profiler.profiled('import_data')
 def import_data(runtime_storage_inst, fd):
     bucket = {}
     count = 0
@@ -66,6 +68,7 @@ def import_data(runtime_storage_inst, fd):
     runtime_storage_inst._set_record_count(count)
 
 
+@profiler.profiled('export_data')
 def export_data(runtime_storage_inst, fd):
     for record in runtime_storage_inst.get_all_records():
         pickle.dump(record, fd)
@@ -83,6 +86,9 @@ def main():
     logging.setup('spectrometer')
     LOG.info('Logging enabled')
 
+    profiler.setup(cfg.CONF.profile, cfg.CONF.profile_dir,
+                   cfg.CONF.profile_interval)
+
     runtime_storage_inst = runtime_storage.get_runtime_storage(
         cfg.CONF.runtime_storage_uri)
 
@@ -101,6 +107,8 @@ def main():
             fd = sys.stdout
         export_data(runtime_storage_inst, fd)
 
+    profiler.PROFILER.dump()
+
 
 if __name__ == '__main__':
     main()
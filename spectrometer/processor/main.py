@@ -14,6 +14,10 @@
 # limitations under the License.
 
 import collections
+import functools
+import os
+import signal
+import time
 
 from oslo.config import cfg
 import psutil
@@ -24,17 +28,23 @@ import yaml
 from spectrometer.openstack.common import log as logging
 from spectrometer.processor import config
 from spectrometer.processor import default_data_processor
+from spectrometer.processor import metrics
 from spectrometer.processor import mls
 from spectrometer.processor import mps
+from spectrometer.processor import pipeline
+from spectrometer.processor import profiler
 from spectrometer.processor import rcs
 from spectrometer.processor import record_processor
 from spectrometer.processor import runtime_storage
+from spectrometer.processor import scheduler
 from spectrometer.processor import utils
 from spectrometer.processor import vcs
 
 
 LOG = logging.getLogger(__name__)
 
+METRICS_FILE_NAME = 'processor_metrics.json'
+
 
 def get_pids():
     # needs to be compatible with psutil >= 1.1.1 since it's a global req.
@@ -69,78 +79,319 @@ def _merge_commits(original, new):
         return True
 
 
-def _record_typer(record_iterator, record_type):
-    for record in record_iterator:
-        record['record_type'] = record_type
+def _checkpoint(record_iterator, save, interval):
+    """Follows every interval-th record with a checkpoint saving it."""
+    for n, record in enumerate(record_iterator, 1):
         yield record
+        if interval and n % interval == 0:
+            yield pipeline.Checkpoint(save, record)
+
+
+def _process_records(items, record_type, record_processor_inst, source):
+    for item in items:
+        if pipeline.is_checkpoint(item):
+            yield item
+            continue
+
+        item['record_type'] = record_type
+        for record in metrics.METRICS.time_iterator(
+                'process', record_processor_inst.process([item]), source):
+            yield record
+
+
+def _ingest(items, record_type, record_processor_inst, runtime_storage_inst,
+            merge_handler=None, source=None, queue_size=None):
+    """Processes and stores a stream of records and checkpoints.
+
+    Producing the stream, processing and storing run in their own threads
+    connected by queues of `queue_size` items, so waits for the network
+    of one stage overlap with work of the others while a slow stage holds
+    the others back. Checkpoints are applied once records before them are
+    stored.
+    """
+    if queue_size is None:
+        queue_size = cfg.CONF.pipeline_queue_size
+
+    items = pipeline.prefetch(items, queue_size)
+    processed = pipeline.prefetch(
+        _process_records(items, record_type, record_processor_inst, source),
+        queue_size)
+    runtime_storage_inst.set_records(pipeline.apply_checkpoints(processed),
+                                     merge_handler)
+
+
+def _is_repo_changed(vcs_inst, last_ids):
+    remote_heads = vcs_inst.ls_remote()
+    if remote_heads is None:
+        return True
+    return any(remote_heads.get(branch) != last_id
+               for branch, last_id in six.iteritems(last_ids))
 
 
-def process_repo(repo, runtime_storage_inst, record_processor_inst):
-    uri = repo['uri']
-    LOG.debug('Processing repo uri %s' % uri)
-
-    vcs_inst = vcs.get_vcs(repo, cfg.CONF.sources_root)
-    vcs_inst.fetch()
-
-    rcs_inst = rcs.get_rcs(repo, cfg.CONF.review_uri)
-    rcs_inst.setup(key_filename=cfg.CONF.ssh_key_filename,
-                   username=cfg.CONF.ssh_username)
-
+def _get_branches(repo):
     branches = set(['master'])
     for release in repo.get('releases'):
         if 'branch' in release:
             branches.add(release['branch'])
+    return branches
 
-    for branch in branches:
-        LOG.debug('Processing repo %s, branch %s', uri, branch)
-
-        vcs_key = 'vcs:' + str(parse.quote_plus(uri) + ':' + branch)
-        last_id = runtime_storage_inst.get_by_key(vcs_key)
 
-        commit_iterator = vcs_inst.log(branch, last_id)
-        commit_iterator_typed = _record_typer(commit_iterator, 'commit')
-        processed_commit_iterator = record_processor_inst.process(
-            commit_iterator_typed)
-        runtime_storage_inst.set_records(
-            processed_commit_iterator, _merge_commits)
-
-        last_id = vcs_inst.get_last_id(branch)
-        runtime_storage_inst.set_by_key(vcs_key, last_id)
-
-        LOG.debug('Processing reviews for repo %s, branch %s', uri, branch)
+@profiler.profiled('process_repo')
+def process_repo(repo, runtime_storage_inst, record_processor_inst):
+    uri = repo['uri']
+    module = repo['module']
+    LOG.debug('Processing repo uri %s' % uri)
 
-        rcs_key = 'rcs:' + str(parse.quote_plus(uri) + ':' + branch)
-        last_id = runtime_storage_inst.get_by_key(rcs_key)
+    vcs_inst = vcs.get_vcs(repo, cfg.CONF.sources_root,
+                           cfg.CONF.vcs_backend)
 
-        review_iterator = rcs_inst.log(branch, last_id)
-        review_iterator_typed = _record_typer(review_iterator, 'review')
-        processed_review_iterator = record_processor_inst.process(
-            review_iterator_typed)
-        runtime_storage_inst.set_records(processed_review_iterator,
-                                         utils.merge_records)
+    branches = _get_branches(repo)
+    LOG.debug('Processing repo %s, branches %s', uri, list(branches))
 
-        last_id = rcs_inst.get_last_id(branch)
-        runtime_storage_inst.set_by_key(rcs_key, last_id)
+    vcs_keys = dict((branch, 'vcs:' + str(parse.quote_plus(uri) + ':' +
+                                          branch))
+                    for branch in branches)
+    last_ids = dict((branch, runtime_storage_inst.get_by_key(vcs_key))
+                    for branch, vcs_key in six.iteritems(vcs_keys))
 
+    with metrics.METRICS.timer('repo_probe', module):
+        repo_changed = _is_repo_changed(vcs_inst, last_ids)
 
-def process_mail_list(uri, runtime_storage_inst, record_processor_inst):
-    mail_iterator = mls.log(uri, runtime_storage_inst)
-    mail_iterator_typed = _record_typer(mail_iterator, 'email')
-    processed_mail_iterator = record_processor_inst.process(
-        mail_iterator_typed)
-    runtime_storage_inst.set_records(processed_mail_iterator)
+    if not repo_changed:
+        LOG.debug('Branches of repo %s are not changed, skip fetch', uri)
+    else:
+        with metrics.METRICS.timer('repo_fetch', module):
+            vcs_inst.fetch()
+
+        checkpoint_ids = dict(last_ids)
+
+        def save_checkpoint(commit):
+            # parents come before children, so all commits reachable from
+            # this one are stored by now. The commit is also listed in the
+            # branches that already had it, their ids must not go back
+            commit_id = commit['commit_id']
+            LOG.debug('Checkpoint of repo %(uri)s at %(commit)s',
+                      {'uri': uri, 'commit': commit_id})
+            for branch in commit['branches']:
+                last_id = checkpoint_ids[branch]
+                if last_id == commit_id or (
+                        last_id and
+                        not vcs_inst.is_ancestor(last_id, commit_id)):
+                    continue
+                checkpoint_ids[branch] = commit_id
+                runtime_storage_inst.set_by_key(vcs_keys[branch], commit_id)
+
+        commit_iterator = metrics.METRICS.time_iterator(
+            'git_log', vcs_inst.log_all(last_ids), module)
+        commit_iterator = _checkpoint(commit_iterator, save_checkpoint,
+                                      cfg.CONF.checkpoint_interval)
+        try:
+            _ingest(commit_iterator, 'commit', record_processor_inst,
+                    runtime_storage_inst, _merge_commits, module)
+        except Exception as e:
+            # commits past the last checkpoint are not stored, the heads
+            # must not be taken as seen
+            LOG.error('Unable to process repo %(uri)s: %(err)s',
+                      {'uri': uri, 'err': e})
+            LOG.exception(e)
+            return
+
+        for branch, vcs_key in six.iteritems(vcs_keys):
+            last_id = vcs_inst.get_last_id(branch)
+            runtime_storage_inst.set_by_key(vcs_key, last_id)
+
+
+def _get_checkpoint_key(rcs_key):
+    return 'checkpoint:' + rcs_key
+
+
+def _complete_review_task(runtime_storage_inst, rcs_key, last_id,
+                          checkpoint, branches=None):
+    if checkpoint and checkpoint.get('newest'):
+        last_id = max(last_id, checkpoint['newest'])
+    runtime_storage_inst.set_by_key(rcs_key, last_id)
+    if branches is not None:
+        runtime_storage_inst.set_by_key(_get_tracked_branches_key(rcs_key),
+                                        branches)
+    if checkpoint and checkpoint.get('until'):
+        runtime_storage_inst.delete_by_key(_get_checkpoint_key(rcs_key))
+
+
+def _store_last_review_ids(poll_iterator, runtime_storage_inst,
+                           checkpoints=None, interval=0, branch_sets=None):
+    """Yields reviews followed by checkpoints of their tasks.
+
+    Last id of a task is stored once all its reviews are, together with
+    the branches of the task found in `branch_sets`. Reviews of a
+    task come newest first. A checkpoint of a running task keeps the last
+    id the task started from, lastUpdated of the newest review and of the
+    last stored one. A poll interrupted after a checkpoint is resumed
+    with the reviews updated until the last stored one.
+    """
+    checkpoints = checkpoints or {}
+    branch_sets = branch_sets or {}
+    counts = collections.defaultdict(int)
+    for kind, rcs_key, value in poll_iterator:
+        checkpoint = checkpoints.get(rcs_key)
+        if kind == 'done':
+            yield pipeline.Checkpoint(_complete_review_task,
+                                      runtime_storage_inst, rcs_key, value,
+                                      checkpoint, branch_sets.get(rcs_key))
+            continue
+
+        metrics.METRICS.add('gerrit_poll', 'reviews', 1, value.get('module'))
+        yield value
+
+        if checkpoint is None or not interval:
+            continue
+        checkpoint.setdefault('newest', value['lastUpdated'])
+        counts[rcs_key] += 1
+        if counts[rcs_key] % interval == 0:
+            checkpoint['until'] = value['lastUpdated']
+            yield pipeline.Checkpoint(runtime_storage_inst.set_by_key,
+                                      _get_checkpoint_key(rcs_key),
+                                      dict(checkpoint))
+
+
+def _resume_review_tasks(tasks, runtime_storage_inst):
+    resumed_tasks = []
+    checkpoints = {}
+    for rcs_key, rcs_inst, branch, last_id in tasks:
+        checkpoint = runtime_storage_inst.get_by_key(
+            _get_checkpoint_key(rcs_key))
+        until = None
+        if checkpoint and checkpoint.get('last_id') == last_id:
+            LOG.info('Resume polling of %(key)s from %(until)s',
+                     {'key': rcs_key, 'until': checkpoint['until']})
+            until = checkpoint['until']
+        else:
+            checkpoint = {'last_id': last_id}
+        checkpoints[rcs_key] = checkpoint
+        resumed_tasks.append((rcs_key, rcs_inst, branch, last_id, until))
+    return resumed_tasks, checkpoints
+
+
+def _get_rcs_key(repo, branch=None):
+    rcs_key = 'rcs:' + str(parse.quote_plus(repo['uri']))
+    if branch:
+        rcs_key += ':' + branch
+    return rcs_key
+
+
+def _get_tracked_branches_key(rcs_key):
+    return 'tracked_branches:' + rcs_key
+
+
+def _get_project_review_tasks(repo, rcs_inst, runtime_storage_inst):
+    """Returns review tasks of the repo polling its branches at once.
+
+    The project last id holds for the branches tracked when it was
+    stored. A branch added later is polled on its own from scratch
+    first, it joins the project query once it has a last id.
+    """
+    branches = sorted(_get_branches(repo))
+    rcs_key = _get_rcs_key(repo)
+    last_id = runtime_storage_inst.get_by_key(rcs_key)
+    branch_ids = dict((b, runtime_storage_inst.get_by_key(
+        _get_rcs_key(repo, b))) for b in branches)
+    if last_id is None:
+        # continue from the per-branch last ids if every branch has one
+        if None not in branch_ids.values():
+            last_id = min(branch_ids.values())
+        return [(rcs_key, rcs_inst, branches, last_id)]
+
+    tracked = runtime_storage_inst.get_by_key(
+        _get_tracked_branches_key(rcs_key))
+    if tracked is None:
+        # stored before branches were tracked
+        tracked = branches
+
+    tasks = []
+    project_branches = []
+    for branch in branches:
+        if branch in tracked:
+            project_branches.append(branch)
+        elif branch_ids[branch] is not None:
+            LOG.debug('Branch %(branch)s of %(uri)s joins the project query',
+                      {'branch': branch, 'uri': repo['uri']})
+            project_branches.append(branch)
+            last_id = min(last_id, branch_ids[branch])
+        else:
+            LOG.debug('Poll new branch %(branch)s of %(uri)s on its own',
+                      {'branch': branch, 'uri': repo['uri']})
+            tasks.append((_get_rcs_key(repo, branch), rcs_inst, branch,
+                          None))
+    if project_branches:
+        tasks.append((rcs_key, rcs_inst, project_branches, last_id))
+    return tasks
+
+
+@profiler.profiled('process_reviews')
+def process_reviews(repos, runtime_storage_inst, record_processor_inst):
+    tasks = []
+    for repo in repos:
+        rcs_inst = rcs.get_rcs(repo, cfg.CONF.review_uri)
+        rcs_inst.setup(key_filename=cfg.CONF.ssh_key_filename,
+                       username=cfg.CONF.ssh_username,
+                       projection=record_processor.REVIEW_PROJECTION)
+
+        if cfg.CONF.gerrit_project_queries:
+            tasks += _get_project_review_tasks(repo, rcs_inst,
+                                               runtime_storage_inst)
+            continue
+
+        for branch in _get_branches(repo):
+            rcs_key = _get_rcs_key(repo, branch)
+            last_id = runtime_storage_inst.get_by_key(rcs_key)
+            tasks.append((rcs_key, rcs_inst, branch, last_id))
+
+    LOG.debug('Processing reviews, %(tasks)s queries over %(channels)s '
+              'channels', {'tasks': len(tasks),
+                           'channels': cfg.CONF.gerrit_channels})
+
+    # project queries remember the branches they cover
+    branch_sets = dict((task[0], task[2]) for task in tasks
+                       if isinstance(task[2], list))
+    tasks, checkpoints = _resume_review_tasks(tasks, runtime_storage_inst)
+
+    # polling runs in worker threads, the time is spent waiting for them
+    poll_iterator = metrics.METRICS.time_iterator(
+        'gerrit_poll', rcs.log_concurrently(tasks, cfg.CONF.gerrit_channels),
+        counter='results')
+    review_iterator = _store_last_review_ids(poll_iterator,
+                                             runtime_storage_inst,
+                                             checkpoints,
+                                             cfg.CONF.checkpoint_interval,
+                                             branch_sets)
+    _ingest(review_iterator, 'review', record_processor_inst,
+            runtime_storage_inst, utils.merge_records)
+
+
+@profiler.profiled('process_mail_lists')
+def process_mail_lists(runtime_storage_inst, record_processor_inst):
+    mail_lists = runtime_storage_inst.get_by_key('mail_lists') or []
+    # mails never change, those already stored are skipped while parsing
+    mail_iterator = mls.log(mail_lists, runtime_storage_inst,
+                            cfg.CONF.mail_archive_concurrency,
+                            is_known=runtime_storage_inst.has_record)
+    _ingest(mail_iterator, 'email', record_processor_inst,
+            runtime_storage_inst)
 
 
 def process_member_list(uri, runtime_storage_inst, record_processor_inst):
     mps_inst = mps.get_mps(uri)
-    member_iterator = mps_inst.log(uri, runtime_storage_inst,
-                                   cfg.CONF.days_to_update_members)
-    member_iterator_typed = _record_typer(member_iterator, 'member')
-    processed_member_iterator = record_processor_inst.process(
-        member_iterator_typed)
-    runtime_storage_inst.set_records(processed_member_iterator)
-
-
+    mps_inst.setup(concurrency=cfg.CONF.member_crawl_concurrency,
+                   rate_limit=cfg.CONF.member_crawl_rate_limit)
+    member_iterator = metrics.METRICS.time_iterator(
+        'member_crawl', mps_inst.log(runtime_storage_inst,
+                                     cfg.CONF.days_to_update_members), uri)
+    # crawlers store their progress as members are asked for, so the
+    # stages run in lockstep
+    _ingest(member_iterator, 'member', record_processor_inst,
+            runtime_storage_inst, source=uri, queue_size=0)
+
+
+@profiler.profiled('update_members')
 def update_members(runtime_storage_inst, record_processor_inst):
     member_lists = runtime_storage_inst.get_by_key('member_lists') or []
     for member_list in member_lists:
@@ -155,17 +406,59 @@ def update_records(runtime_storage_inst, record_processor_inst):
     for repo in repos:
         process_repo(repo, runtime_storage_inst, record_processor_inst)
 
-    mail_lists = runtime_storage_inst.get_by_key('mail_lists') or []
-    for mail_list in mail_lists:
-        process_mail_list(mail_list, runtime_storage_inst,
-                          record_processor_inst)
+    # reviews change without touching branch heads, so they are polled
+    # for all repos regardless of the probe result
+    process_reviews(repos, runtime_storage_inst, record_processor_inst)
+    rcs.close_connections()
 
-    record_processor_inst.update()
+    process_mail_lists(runtime_storage_inst, record_processor_inst)
+
+    # changes of default data are applied to the affected records as it is
+    # loaded, relations between records change only with new ones
+    if record_processor_inst.is_update_needed():
+        record_processor_inst.update()
+    elif record_processor_inst.is_core_update_needed():
+        record_processor_inst.update_core_contributors()
+
+
+def maintain_repos(runtime_storage_inst, time_budget):
+    if time_budget <= 0:
+        return
+
+    start = time.time()
+    due_tasks = []
+    for repo in utils.load_repos(runtime_storage_inst):
+        key = 'maintenance:' + str(parse.quote_plus(repo['uri']))
+        state = runtime_storage_inst.get_by_key(key) or {}
+        for task, (interval, cmd) in six.iteritems(vcs.MAINTENANCE_TASKS):
+            last_run = state.get(task, 0)
+            if last_run + interval <= start:
+                due_tasks.append((last_run, repo, task))
+
+    # the longest waiting tasks go first, so all repos get their turn
+    # even if the budget is too small to serve everyone in one run
+    due_tasks.sort(key=lambda t: t[0])
+    LOG.info('Repo maintenance tasks due: %s', len(due_tasks))
+
+    for n, (last_run, repo, task) in enumerate(due_tasks):
+        if time.time() - start >= time_budget:
+            LOG.info('Repo maintenance time budget is exhausted, '
+                     'postpone %s tasks', len(due_tasks) - n)
+            break
+
+        vcs_inst = vcs.get_vcs(repo, cfg.CONF.sources_root,
+                               cfg.CONF.vcs_backend)
+        if vcs_inst.maintain(task):
+            key = 'maintenance:' + str(parse.quote_plus(repo['uri']))
+            state = runtime_storage_inst.get_by_key(key) or {}
+            state[task] = int(time.time())
+            runtime_storage_inst.set_by_key(key, state)
 
 
 def apply_corrections(uri, runtime_storage_inst):
     LOG.info('Applying corrections from uri %s', uri)
-    corrections = utils.read_json_from_uri(uri)
+    with metrics.METRICS.timer('corrections_read'):
+        corrections = utils.read_json_from_uri(uri)
     if not corrections:
         LOG.error('Unable to read corrections from uri: %s', uri)
         return
@@ -176,7 +469,8 @@ def apply_corrections(uri, runtime_storage_inst):
             valid_corrections.append(c)
         else:
             LOG.warn('Correction misses primary key: %s', c)
-    runtime_storage_inst.apply_corrections(valid_corrections)
+    with metrics.METRICS.timer('corrections_apply'):
+        runtime_storage_inst.apply_corrections(valid_corrections)
 
 
 def _read_official_programs_yaml(program_list_uri, release_names):
@@ -263,6 +557,151 @@ def process_program_list(runtime_storage_inst, program_list_uri):
     runtime_storage_inst.set_by_key('module_groups', module_groups)
 
 
+def load_default_data(runtime_storage_inst, force_update):
+    """Stores default data and the program list.
+
+    Returns None if default data is unavailable, otherwise whether records
+    were updated with changed default data.
+    """
+    with metrics.METRICS.timer('default_data'):
+        default_data = utils.read_json_from_uri(cfg.CONF.default_data_uri)
+        if not default_data:
+            return None
+        changed = default_data_processor.process(runtime_storage_inst,
+                                                 default_data,
+                                                 cfg.CONF.sources_root,
+                                                 force_update)
+
+    with metrics.METRICS.timer('program_list'):
+        process_program_list(runtime_storage_inst, cfg.CONF.program_list_uri)
+    return changed
+
+
+def store_metrics(runtime_storage_inst, task=None):
+    summary = metrics.METRICS.get_summary()
+    if task:
+        summary['task'] = task
+    metrics.store_summary(summary, runtime_storage_inst,
+                          cfg.CONF.metrics_file or os.path.join(
+                              cfg.CONF.sources_root, METRICS_FILE_NAME))
+
+
+def _run_metered(runtime_storage_inst, task, action):
+    metrics.METRICS.reset()
+    try:
+        action()
+    finally:
+        store_metrics(runtime_storage_inst, task)
+        profiler.PROFILER.dump()
+
+
+def _publish_update(runtime_storage_inst):
+    runtime_storage_inst.set_by_key('runtime_storage_update_time',
+                                    utils.date_to_timestamp('now'))
+
+
+class Daemon(object):
+    """Updates sources on their own schedule in a long-running process.
+
+    The record processor, runtime storage indexes and connections to
+    review and web servers are kept between runs, so a run costs only the
+    work of its source.
+    """
+
+    def __init__(self, runtime_storage_inst):
+        self.runtime_storage_inst = runtime_storage_inst
+        self.record_processor_inst = record_processor.RecordProcessor(
+            runtime_storage_inst)
+
+    def update_default_data(self):
+        changed = load_default_data(self.runtime_storage_inst, False)
+        if changed is None:
+            LOG.error('Unable to load default data')
+        elif changed:
+            # companies, releases and modules are cached by the processor.
+            # Affected records are updated already, relations between
+            # records are not changed by default data
+            LOG.info('Default data is changed, reload record processor')
+            records_processed = self.record_processor_inst.records_processed
+            self.record_processor_inst = record_processor.RecordProcessor(
+                self.runtime_storage_inst)
+            self.record_processor_inst.records_processed = records_processed
+            _publish_update(self.runtime_storage_inst)
+
+    def update_repos(self):
+        for repo in utils.load_repos(self.runtime_storage_inst):
+            process_repo(repo, self.runtime_storage_inst,
+                         self.record_processor_inst)
+
+    def update_reviews(self):
+        process_reviews(utils.load_repos(self.runtime_storage_inst),
+                        self.runtime_storage_inst, self.record_processor_inst)
+
+    def update_mail_lists(self):
+        process_mail_lists(self.runtime_storage_inst,
+                           self.record_processor_inst)
+
+    def update_members(self):
+        update_members(self.runtime_storage_inst, self.record_processor_inst)
+        _publish_update(self.runtime_storage_inst)
+
+    def apply_corrections(self):
+        apply_corrections(cfg.CONF.corrections_uri, self.runtime_storage_inst)
+        _publish_update(self.runtime_storage_inst)
+
+    def update_records(self):
+        # relations between records are refreshed once for all sources
+        # that processed records since the last time
+        if self.record_processor_inst.is_update_needed():
+            update_pids(self.runtime_storage_inst)
+            self.record_processor_inst.update()
+        elif self.record_processor_inst.is_core_update_needed():
+            self.record_processor_inst.update_core_contributors()
+        else:
+            return
+        _publish_update(self.runtime_storage_inst)
+
+    def maintain_repos(self):
+        maintain_repos(self.runtime_storage_inst,
+                       cfg.CONF.maintenance_time_budget)
+
+    def get_tasks(self):
+        return [('default-data', self.update_default_data),
+                ('git', self.update_repos),
+                ('gerrit', self.update_reviews),
+                ('mail', self.update_mail_lists),
+                ('members', self.update_members),
+                ('corrections', self.apply_corrections),
+                ('update', self.update_records),
+                ('maintenance', self.maintain_repos)]
+
+
+def run_daemon(runtime_storage_inst):
+    daemon = Daemon(runtime_storage_inst)
+    scheduler_inst = scheduler.Scheduler()
+    for name, action in daemon.get_tasks():
+        interval = int(cfg.CONF.daemon_intervals.get(name, 0))
+        priority = int(cfg.CONF.daemon_priorities.get(name, 0))
+        # default data is loaded at start, everything else is due now
+        delay = interval if name == 'default-data' else 0
+        scheduler_inst.add(name, functools.partial(
+            _run_metered, runtime_storage_inst, name, action),
+            interval, priority, delay)
+
+    def stop(signum, frame):
+        LOG.info('Stop after the running task, signal %s', signum)
+        scheduler_inst.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    LOG.info('Processor daemon started')
+    try:
+        scheduler_inst.run()
+    finally:
+        rcs.close_connections()
+
+
 def main():
     # init conf and logging
     conf = cfg.CONF
@@ -273,19 +712,23 @@ def main():
     logging.setup('spectrometer')
     LOG.info('Logging enabled')
 
+    profiler.setup(cfg.CONF.profile, cfg.CONF.profile_dir,
+                   cfg.CONF.profile_interval)
+    utils.setup_http_connection_pool(cfg.CONF.http_timeout,
+                                     cfg.CONF.http_connections_per_host,
+                                     cfg.CONF.http_retries)
+
     runtime_storage_inst = runtime_storage.get_runtime_storage(
         cfg.CONF.runtime_storage_uri)
 
-    default_data = utils.read_json_from_uri(cfg.CONF.default_data_uri)
-    if not default_data:
+    if load_default_data(runtime_storage_inst,
+                         cfg.CONF.force_update) is None:
         LOG.critical('Unable to load default data')
         return not 0
-    default_data_processor.process(runtime_storage_inst,
-                                   default_data,
-                                   cfg.CONF.sources_root,
-                                   cfg.CONF.force_update)
 
-    process_program_list(runtime_storage_inst, cfg.CONF.program_list_uri)
+    if cfg.CONF.daemon:
+        run_daemon(runtime_storage_inst)
+        return
 
     update_pids(runtime_storage_inst)
 
@@ -299,8 +742,13 @@ def main():
     # long operation should be the last
     update_members(runtime_storage_inst, record_processor_inst)
 
-    runtime_storage_inst.set_by_key('runtime_storage_update_time',
-                                    utils.date_to_timestamp('now'))
+    _publish_update(runtime_storage_inst)
+
+    # keeps git traversal fast, runs when fresh data is already published
+    maintain_repos(runtime_storage_inst, cfg.CONF.maintenance_time_budget)
+
+    store_metrics(runtime_storage_inst)
+    profiler.PROFILER.dump()
 
 
 if __name__ == '__main__':
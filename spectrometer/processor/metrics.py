@@ -0,0 +1,140 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import copy
+import json
+import threading
+import time
+
+import six
+
+from spectrometer.openstack.common import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+METRICS_KEY = 'processor_metrics'
+METRICS_HISTORY_KEY = 'processor_metrics_history'
+METRICS_HISTORY_SIZE = 100
+
+
+class Metrics(object):
+    """Time and counters of processor stages, overall and per source.
+
+    Stages are nested the way the record pipeline pulls data: while
+    storage pulls processed records, the processor pulls parsed ones and
+    so on. The time of a stage excludes the time of the stages nested
+    into it, so stage times of a thread add up to the time spent in them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.stages = {}
+            self.sources = {}
+
+    def _get_counters(self, stage, source):
+        counters = self.stages.setdefault(stage, {})
+        if source is None:
+            return [counters]
+        source_stages = self.sources.setdefault(source, {})
+        return [counters, source_stages.setdefault(stage, {})]
+
+    def add(self, stage, counter, value=1, source=None):
+        with self.lock:
+            for counters in self._get_counters(stage, source):
+                counters[counter] = counters.get(counter, 0) + value
+
+    def _get_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def timer(self, stage, source=None):
+        stack = self._get_stack()
+        # time of nested stages, it is accounted to them
+        stack.append(0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add(stage, 'time', elapsed - nested, source)
+            self.add(stage, 'calls', 1, source)
+
+    def time_iterator(self, stage, iterator, source=None, counter='records'):
+        """Yields items of the iterator accounting their production time."""
+        iterator = iter(iterator)
+        while True:
+            with self.timer(stage, source):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            self.add(stage, counter, 1, source)
+            yield item
+
+    def get_summary(self):
+        with self.lock:
+            end = time.time()
+            return {'start': int(self.start), 'end': int(end),
+                    'time': end - self.start,
+                    'stages': copy.deepcopy(self.stages),
+                    'sources': copy.deepcopy(self.sources)}
+
+
+METRICS = Metrics()
+
+
+def _format_stage(stage, counters):
+    return '%s: %s' % (stage, ', '.join(
+        '%s=%s' % (k, ('%.2f' % v) if isinstance(v, float) else v)
+        for k, v in sorted(six.iteritems(counters))))
+
+
+def store_summary(summary, runtime_storage_inst, file_name=None):
+    """Keeps the summary of a run in storage and appends it to the file.
+
+    Storage keeps the last summary and stage totals of the most recent
+    runs, the per source breakdown of many runs would not fit into a
+    memcached item. The file gets every summary as a line of JSON.
+    """
+    for stage, counters in sorted(six.iteritems(summary['stages'])):
+        LOG.info('Stage %s', _format_stage(stage, counters))
+
+    runtime_storage_inst.set_by_key(METRICS_KEY, summary)
+    history = runtime_storage_inst.get_by_key(METRICS_HISTORY_KEY) or []
+    history.append(dict((k, v) for k, v in six.iteritems(summary)
+                        if k != 'sources'))
+    runtime_storage_inst.set_by_key(METRICS_HISTORY_KEY,
+                                    history[-METRICS_HISTORY_SIZE:])
+
+    if file_name:
+        try:
+            with open(file_name, 'a') as fd:
+                fd.write(json.dumps(summary, sort_keys=True) + '\n')
+        except IOError as e:
+            LOG.error('Unable to write metrics to %(file)s: %(err)s',
+                      {'file': file_name, 'err': e})
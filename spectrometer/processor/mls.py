@@ -19,29 +19,30 @@ import re
 import StringIO
 
 import six
-from six.moves import http_client
 from six.moves.urllib import parse
 
 from spectrometer.openstack.common import log as logging
+from spectrometer.processor import metrics
+from spectrometer.processor import pipeline
 from spectrometer.processor import utils
 
 
 LOG = logging.getLogger(__name__)
 
-EMAIL_HEADER_PATTERN = ('From \S+(?: at \S+)?\s+'
-                        '\w{3}\s+\w{3}\s+\d{1,2}\s+\d{2}:\d{2}(?::\d{2})?'
-                        '(?:\s+\S+)?\s+\d{4}.*?\n')
-
-MAIL_BOX_PATTERN = re.compile(
-    '^' + EMAIL_HEADER_PATTERN +
-    'From: (?P<author_email>\S+(?: at \S+))'
-    '(?:\W+(?P<author_name>\w+(?:\s\w+)*))?.*?\n'
-    'Date: (?P<date>.*?)\n'
-    'Subject: (?P<subject>.*?)(?=\n\S+:)'
-    '.*?Message-ID: (?P<message_id>\S+)\n'
-    '\n(?P<body>.*?)\n'
-    '(?=' + EMAIL_HEADER_PATTERN + 'From: )',
-    flags=re.MULTILINE | re.DOTALL)
+ENVELOPE_PATTERN = re.compile(
+    'From \S+(?: at \S+)?\s+'
+    '\w{3}\s+\w{3}\s+\d{1,2}\s+\d{2}:\d{2}(?::\d{2})?'
+    '(?:\s+\S+)?\s+\d{4}')
+
+AUTHOR_PATTERN = re.compile('(?P<author_email>\S+(?: at \S+))'
+                            '(?:\W+(?P<author_name>\w+(?:\s\w+)*))?')
+
+MAIL_HEADERS = {
+    'from': 'from',
+    'date': 'date',
+    'subject': 'subject',
+    'message-id': 'message_id',
+}
 
 MESSAGE_PATTERNS = {
     'bug_id': re.compile(r'https://bugs.launchpad.net/bugs/(?P<id>\d+)',
@@ -51,59 +52,169 @@ MESSAGE_PATTERNS = {
                                re.IGNORECASE),
 }
 
-TRAILING_RECORD = ('From ishakhat at mirantis.com  Tue Sep 17 07:30:43 2013'
-                   'From: ')
-
 
 def _get_mail_archive_links(uri):
-    content = utils.read_uri(uri)
+    try:
+        status, headers, content = utils.HTTP_CONNECTION_POOL.request(uri)
+    except Exception as e:
+        LOG.error('Error %(error)s reading mail list from uri: %(uri)s',
+                  {'error': e, 'uri': uri})
+        return []
+    if status != 200:
+        LOG.error('Error %(status)s reading mail list from uri: %(uri)s',
+                  {'status': status, 'uri': uri})
+        return []
+
     links = set(re.findall(r'\shref\s*=\s*[\'"]([^\'"]*\.txt(\.gz)?)', content,
                            flags=re.IGNORECASE))
     # each link is a tuple due to having multiple groups in the re
     # we are only interested in the first one
-    return [parse.urljoin(uri, link[0]) for link in links]
+    return sorted(parse.urljoin(uri, link[0]) for link in links)
+
+
+def _is_gzipped(link):
+    return re.search('\.txt\.gz', link) is not None
+
+
+def _get_archive_state(link, runtime_storage_inst):
+    state = runtime_storage_inst.get_by_key('mail_link:' + link)
+    if not isinstance(state, dict):
+        # earlier runs kept only the Last-Modified header
+        return {}
+    return state
+
+
+def _read_archive(link, state):
+    """Reads mail archive if it has changed since the state was taken.
+
+    Returns tuple (content, new state), content is None if the archive is
+    not changed. Plain text archives only grow during the month, so just
+    the appended part is requested when the previous length is known.
+    """
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    offset = 0
+    if state.get('length') and not _is_gzipped(link):
+        offset = state['length']
+        headers['Range'] = 'bytes=%d-' % offset
+
+    try:
+        status, response_headers, content = (
+            utils.HTTP_CONNECTION_POOL.request(link, headers=headers))
+    except Exception as e:
+        LOG.error('Error %(error)s reading mail archive from uri: %(uri)s',
+                  {'error': e, 'uri': link})
+        return None, state
+
+    if status == 304:
+        LOG.debug('Mail archive is not changed: %s', link)
+        return None, state
+    if status == 206 and not response_headers.get(
+            'content-range', '').startswith('bytes %d-' % offset):
+        status = 416
+    if offset and status == 416:
+        LOG.debug('Mail archive is rewritten, read it again: %s', link)
+        return _read_archive(link, {})
+    if status not in (200, 206):
+        LOG.error('Error %(status)s reading mail archive from uri: %(uri)s',
+                  {'status': status, 'uri': link})
+        return None, state
+
+    length = len(content)
+    if status == 206:
+        LOG.debug('Read %(length)s bytes appended to mail archive %(uri)s',
+                  {'length': length, 'uri': link})
+        length += offset
+    return content, {'etag': response_headers.get('etag'),
+                     'last_modified': response_headers.get('last-modified'),
+                     'length': length}
 
 
-def _link_content_changed(link, runtime_storage_inst):
-    LOG.debug('Check changes for mail archive located at uri: %s', link)
-    parsed_uri = parse.urlparse(link)
-    conn = http_client.HTTPConnection(parsed_uri.netloc)
-    conn.request('HEAD', parsed_uri.path)
-    res = conn.getresponse()
-    last_modified = res.getheader('last-modified')
-    conn.close()
+def _get_message_id(headers):
+    message_id = headers.get('message_id', '').split()
+    return message_id[0] if message_id else None
 
-    if last_modified != runtime_storage_inst.get_by_key('mail_link:' + link):
-        LOG.debug('Mail archive changed, last modified at: %s', last_modified)
-        runtime_storage_inst.set_by_key('mail_link:' + link, last_modified)
-        return True
 
-    # return true every time for now
-    return True
+def _make_mail(headers, body_lines):
+    if len(headers) < len(MAIL_HEADERS):
+        return None
+    author = AUTHOR_PATTERN.match(headers['from'])
+    if not author:
+        return None
+    message_id = _get_message_id(headers)
+    if not message_id:
+        return None
 
+    mail = author.groupdict()
+    mail['date'] = headers['date']
+    mail['subject'] = headers['subject']
+    mail['message_id'] = message_id
+    # the last line is the blank one separating mails
+    mail['body'] = ''.join(body_lines)[:-1]
+    return mail
 
-def _retrieve_mails(uri):
-    LOG.debug('Retrieving mail archive from uri: %s', uri)
-    content = utils.read_uri(uri)
-    if not content:
-        LOG.error('Error reading mail archive from uri: %s', uri)
-        return
 
+def _parse_mbox(fd, is_known=None):
+    """Yields mails of mbox file one by one reading it line by line.
+
+    Only the headers that make up email records are kept, at most one mail
+    is held in memory at a time. Mails whose Message-ID `is_known` returns
+    True for are skipped without reading their bodies.
+    """
+    headers = None
+    header = None
+    body_lines = None
+
+    for line in fd:
+        if line.startswith('From ') and ENVELOPE_PATTERN.match(line):
+            if headers is not None:
+                mail = _make_mail(headers, body_lines)
+                if mail:
+                    yield mail
+            headers = {}
+            header = None
+            body_lines = None
+        elif headers is None:
+            continue  # text before the first mail or a skipped one
+        elif body_lines is not None:
+            body_lines.append(line)
+        elif line in ('\n', '\r\n'):
+            body_lines = []
+            if is_known and is_known(_get_message_id(headers)):
+                headers = None
+        elif line[0] in ' \t':
+            if header:
+                # folded header value
+                headers[header] += '\n' + line.rstrip('\r\n')
+        else:
+            name, colon, value = line.partition(':')
+            header = MAIL_HEADERS.get(name.lower())
+            if header and header not in headers:
+                headers[header] = value.strip()
+            else:
+                header = None
+
+    if headers is not None:
+        mail = _make_mail(headers, body_lines or ['\n'])
+        if mail:
+            yield mail
+
+
+def _retrieve_mails(uri, content, is_known=None):
+    fd = StringIO.StringIO(content)
     # only gunzip if the uri has a .gz suffix
-    matchgz = re.compile('\.txt\.gz')
-    if matchgz.search(uri):
+    if _is_gzipped(uri):
         LOG.debug('%s is a gzipped file', uri)
-        gzip_fd = gzip.GzipFile(fileobj=StringIO.StringIO(content))
-        content = gzip_fd.read()
+        fd = gzip.GzipFile(fileobj=fd)
     else:
         LOG.debug('%s is not a gzipped file', uri)
 
     LOG.debug('Mail archive is loaded, start processing')
 
-    content += TRAILING_RECORD
-
-    for rec in re.finditer(MAIL_BOX_PATTERN, content):
-        email = rec.groupdict()
+    for email in _parse_mbox(fd, is_known):
         email['author_email'] = email['author_email'].replace(' at ', '@', 1)
         if not utils.check_email_validity(email['author_email']):
             continue
@@ -125,12 +236,65 @@ def _retrieve_mails(uri):
         yield email
 
 
-def log(uri, runtime_storage_inst):
+def _read_archives_concurrently(links, states, concurrency):
+    """Downloads archives ahead of the consumer, yields them in order.
+
+    Yields tuples (link, content, new state) in the order of links. At
+    most `concurrency` archives are downloading or waiting to be consumed
+    at a time, so the consumer parses one archive while the following
+    ones are being downloaded.
+    """
+    def read(task):
+        link, state = task
+        LOG.debug('Retrieving mail archive from uri: %s', link)
+        try:
+            return _read_archive(link, state)
+        except Exception as e:
+            LOG.error('Failed to read mail archive %(uri)s: %(err)s',
+                      {'uri': link, 'err': e})
+            LOG.exception(e)
+            return None, state
+
+    tasks = list(zip(links, states))
+    for (link, state), (content, new_state) in zip(
+            tasks, utils.imap_concurrently(read, tasks, concurrency)):
+        yield link, content, new_state
+
+
+def log(uris, runtime_storage_inst, concurrency=1, is_known=None):
+    """Yields mails of the mail lists and checkpoints of their archives.
+
+    Index pages of all the lists are read concurrently and so are the
+    archives of all the lists afterwards, `concurrency` requests at a
+    time overall.
+    """
+    sources = {}
+    for uri, links in zip(uris, utils.imap_concurrently(
+            _get_mail_archive_links, uris, concurrency)):
+        LOG.debug('Mail archive links of %(uri)s: %(links)s',
+                  {'uri': uri, 'links': links})
+        for link in links:
+            sources[link] = uri
+    links = sorted(sources)
+    states = [_get_archive_state(link, runtime_storage_inst)
+              for link in links]
+
+    # downloads run in worker threads for all the lists at once, the time
+    # is spent waiting for them
+    for link, content, new_state in metrics.METRICS.time_iterator(
+            'mail_download', _read_archives_concurrently(
+                links, states, concurrency), counter='archives'):
+        if not content:
+            continue
+        source = sources[link]
+        metrics.METRICS.add('mail_download', 'bytes', len(content), source)
+
+        for mail in metrics.METRICS.time_iterator(
+                'mail_parse', _retrieve_mails(link, content, is_known),
+                source):
+            LOG.debug('New mail: %s', mail['message_id'])
+            yield mail
 
-    links = _get_mail_archive_links(uri)
-    LOG.debug('Mail archive links: %s', str(links))
-    for link in links:
-        if _link_content_changed(link, runtime_storage_inst):
-            for mail in _retrieve_mails(link):
-                LOG.debug('New mail: %s', mail['message_id'])
-                yield mail
+        # the state is stored once all mails of the archive are
+        yield pipeline.Checkpoint(runtime_storage_inst.set_by_key,
+                                  'mail_link:' + link, new_state)
@@ -17,7 +17,9 @@ import re
 import time
 
 import ldap
+from ldap import controls as ldap_controls
 import six
+from six.moves.urllib import parse
 
 from spectrometer.openstack.common import log as logging
 from spectrometer.processor import utils
@@ -30,24 +32,42 @@ NAME_AND_DATE_PATTERN = r'<h3>(?P<member_name>[^<]*)[\s\S]*?' \
                         r'<div class="span-7 last">(?P<date_joined>[^<]*)'
 COMPANY_PATTERN = r'<strong>Date\sJoined[\s\S]*?<b>(?P<company_draft>[^<]*)' \
                   r'[\s\S]*?From\s(?P<date_from>[\s\S]*?)\(Current\)'
-CNT_EMPTY_MEMBERS = 50
+MEMBER_PROBE_WINDOW = 50
+MEMBER_CRAWL_WINDOW = 64
+LDAP_PAGE_SIZE = 500
+LDAP_MEMBER_FILTER = '(objectclass=identityPerson)'
+LDAP_ATTRIBUTES = ['uid', 'cn', 'country', 'o', 'mail', 'modifyTimestamp']
 
 
 class Mps(object):
     def __init__(self, uri):
         self.uri = uri
 
-    def setup(self):
+    def setup(self, **kwargs):
         pass
 
-    def log(self):
+    def log(self, runtime_storage_inst, days_to_update_members):
         pass
 
 
 class Web(Mps):
+    """Crawls member profiles numbered by member id.
+
+    Ids of deleted profiles leave gaps, the last member is the one followed
+    by MEMBER_PROBE_WINDOW absent ids. Gaps make presence of ids not
+    monotonic, so there is nothing to search for, ids past the last member
+    index are fetched in windows of concurrent requests until the absent
+    ones make up a probe window.
+    """
 
     def __init__(self, uri):
-        self.uri = uri
+        super(Web, self).__init__(uri)
+        self.concurrency = 1
+        self.rate_limiter = utils.RateLimiter(0)
+
+    def setup(self, **kwargs):
+        self.concurrency = max(kwargs.get('concurrency') or 1, 1)
+        self.rate_limiter = utils.RateLimiter(kwargs.get('rate_limit') or 0)
 
     def _convert_str_fields_to_unicode(self, result):
         for field, value in result.iteritems():
@@ -58,9 +78,22 @@ class Web(Mps):
                 except Exception:
                     pass
 
-    def _retrieve_member(self, member_id, html_parser):
+    def _read_profile(self, profile_uri):
+        self.rate_limiter.wait()
+        try:
+            status, headers, content = utils.HTTP_CONNECTION_POOL.request(
+                profile_uri)
+        except Exception as e:
+            LOG.warn('Error while reading uri %(uri)s: %(err)s',
+                     {'uri': profile_uri, 'err': e})
+            return None
+        if status != 200:
+            return None
+        return content
+
+    def _retrieve_member(self, profile_uri, member_id, html_parser):
 
-        content = utils.read_uri(self.uri)
+        content = self._read_profile(profile_uri)
 
         if not content:
             return {}
@@ -73,7 +106,7 @@ class Web(Mps):
             member['member_id'] = member_id
             member['member_name'] = result['member_name']
             member['date_joined'] = result['date_joined']
-            member['member_uri'] = self.uri
+            member['member_uri'] = profile_uri
             break
 
         member['company_draft'] = '*independent'
@@ -85,6 +118,17 @@ class Web(Mps):
 
         return member
 
+    def _fetch(self, member_ids):
+        """Returns profiles of the members by id, fetched concurrently."""
+        html_parser = six.moves.html_parser.HTMLParser()
+
+        def retrieve(member_id):
+            return self._retrieve_member(self.uri + str(member_id),
+                                         str(member_id), html_parser)
+
+        return dict(zip(member_ids, utils.imap_concurrently(
+            retrieve, member_ids, self.concurrency)))
+
     def log(self, runtime_storage_inst, days_to_update_members):
         LOG.debug('Retrieving new openstack.org members')
 
@@ -102,32 +146,38 @@ class Web(Mps):
 
             runtime_storage_inst.set_by_key('last_update_members_date',
                                             last_update_members_date)
-
-        cnt_empty = 0
-        cur_index = last_member_index + 1
-        html_parser = six.moves.html_parser.HTMLParser()
-
-        while cnt_empty < CNT_EMPTY_MEMBERS:
-
-            profile_uri = self.uri + str(cur_index)
-            member = self._retrieve_member(profile_uri,
-                                           str(cur_index), html_parser)
-
-            if 'member_name' not in member:
-                cnt_empty += 1
-                cur_index += 1
-                continue
-
-            self._convert_str_fields_to_unicode(member)
-
-            cnt_empty = 0
-            last_member_index = cur_index
-            cur_index += 1
-            LOG.debug('New member: %s', member['member_id'])
-            yield member
+            # an interrupted crawl continues the same full update
+            runtime_storage_inst.set_by_key('last_member_index', 0)
+
+        stored_index = last_member_index
+        window_start = last_member_index + 1
+        while window_start <= last_member_index + MEMBER_PROBE_WINDOW:
+            # ids past the probe window after the last member are not needed
+            window = range(window_start,
+                           min(window_start + MEMBER_CRAWL_WINDOW,
+                               last_member_index + MEMBER_PROBE_WINDOW + 1))
+            members = self._fetch(window)
+
+            for member_id in window:
+                member = members[member_id]
+                if 'member_name' not in member:
+                    continue
+
+                self._convert_str_fields_to_unicode(member)
+
+                last_member_index = member_id
+                LOG.debug('New member: %s', member['member_id'])
+                yield member
+
+            if last_member_index != stored_index:
+                # members of the window are stored by now, an interrupted
+                # crawl continues from the next one
+                runtime_storage_inst.set_by_key('last_member_index',
+                                                last_member_index)
+                stored_index = last_member_index
+            window_start = window[-1] + 1
 
         LOG.debug('Last_member_index: %s', last_member_index)
-        runtime_storage_inst.set_by_key('last_member_index', last_member_index)
 
 
 class Ldap(Mps):
@@ -136,7 +186,7 @@ class Ldap(Mps):
         super(Ldap, self).__init__(uri)
         self.base_dn = kwargs.get('base_dn')
 
-    def setup(self):
+    def setup(self, **kwargs):
         self.connection = ldap.initialize(self.uri)
 
     def _connect(self):
@@ -151,28 +201,71 @@ class Ldap(Mps):
     def _disconnect(self):
         self.connection.unbind()
 
-    def log(self, runtime_storage_inst=None, days_to_update_members=None):
-        filter = '(objectclass=identityPerson)'
+    def _get_filter(self, modified_since):
+        if not modified_since:
+            return LDAP_MEMBER_FILTER
+        return '(&%(filter)s(modifyTimestamp>=%(since)s))' % {
+            'filter': LDAP_MEMBER_FILTER, 'since': modified_since}
+
+    def _search(self, filterstr):
+        """Yields entries page by page using the paged results control."""
+        page_control = ldap_controls.SimplePagedResultsControl(
+            True, size=LDAP_PAGE_SIZE, cookie='')
+        while True:
+            msgid = self.connection.search_ext(
+                self.base_dn, ldap.SCOPE_SUBTREE, filterstr, LDAP_ATTRIBUTES,
+                serverctrls=[page_control])
+            rtype, entries, rmsgid, response_controls = (
+                self.connection.result3(msgid))
+            for entry in entries:
+                yield entry
+
+            cookies = [c.cookie for c in response_controls
+                       if c.controlType == page_control.controlType]
+            if not cookies or not cookies[0]:
+                break
+            page_control.cookie = cookies[0]
 
+    def log(self, runtime_storage_inst, days_to_update_members):
+        sync_key = 'members_sync:' + parse.quote_plus(self.uri)
+        sync = runtime_storage_inst.get_by_key(sync_key) or {}
+
+        # changed members are synced on every run, all of them periodically
+        update_interval_seconds = days_to_update_members * 24 * 60 * 60
+        now = int(time.time())
+        modified_since = sync.get('modify_timestamp')
+        if sync.get('full_sync_date', 0) <= now - update_interval_seconds:
+            LOG.debug('Retrieving all members from %s', self.uri)
+            modified_since = None
+            sync['full_sync_date'] = now
+        else:
+            LOG.debug('Retrieving members of %(uri)s modified since '
+                      '%(since)s', {'uri': self.uri, 'since': modified_since})
+
+        last_modified = modified_since
         try:
-            users = self.connection.search_s(self.base_dn,
-                                             ldap.SCOPE_SUBTREE, filter)
+            for dn, data in self._search(self._get_filter(modified_since)):
+                LOG.debug('New member: %s', dn)
+                member = {}
+                member['member_id'] = data.get('uid', None)
+                member['ldap_id'] = data.get('uid', None)
+                member['member_name'] = data.get('cn', None)
+                member['date_joined'] = None
+                member['country'] = data.get("country", None)
+                member['company_draft'] = data.get("o", "*independent")
+                member['email'] = data.get("mail", None)
+                yield member
+
+                # generalized time in UTC compares as a string
+                modified = (data.get('modifyTimestamp') or [None])[0]
+                if modified and modified > last_modified:
+                    last_modified = modified
         except ldap.LDAPError as e:
             LOG.error("%s" % e)
+            return
 
-        for user in users:
-            LOG.debug('New member: %s', user)
-            # The data we want is on the right side of the user tuple
-            data = user[1]
-            member = {}
-            member['member_id'] = data.get('uid', None)
-            member['ldap_id'] = data.get('uid', None)
-            member['member_name'] = data.get('cn', None)
-            member['date_joined'] = None
-            member['country'] = data.get("country", None)
-            member['company_draft'] = data.get("o", "*independent")
-            member['email'] = data.get("mail", None)
-            yield member
+        sync['modify_timestamp'] = last_modified
+        runtime_storage_inst.set_by_key(sync_key, sync)
 
 
 def get_mps(uri):
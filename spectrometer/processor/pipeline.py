@@ -0,0 +1,115 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+
+PUT_TIMEOUT = 1
+
+_END = object()
+
+
+class Checkpoint(object):
+    """Marker in a stream of records that saves progress.
+
+    Stages pass checkpoints through in stream order, the storing stage
+    calls them once all records before them are stored.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self):
+        self.func(*self.args)
+
+
+def is_checkpoint(item):
+    return isinstance(item, Checkpoint)
+
+
+def apply_checkpoints(items):
+    """Yields records to the storing stage and calls checkpoints.
+
+    Records are stored one by one, so once the next item is asked for,
+    all records before it are stored.
+    """
+    for item in items:
+        if is_checkpoint(item):
+            item()
+        else:
+            yield item
+
+
+class _Error(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def _produce(iterator, items, stopped):
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for item in iterator:
+            if not put(item):
+                return
+    except Exception:
+        put(_Error(sys.exc_info()))
+        return
+    put(_END)
+
+
+def prefetch(iterator, size):
+    """Yields items of the iterator produced in a separate thread.
+
+    At most `size` items are produced ahead of the consumer, the producer
+    waits for the consumer once the queue is full. An exception of the
+    producer is raised in the consumer. The size of 0 produces items in
+    the consumer thread.
+    """
+    if size <= 0:
+        for item in iterator:
+            yield item
+        return
+
+    items = queue.Queue(size)
+    stopped = threading.Event()
+    producer = threading.Thread(target=_produce,
+                                args=(iterator, items, stopped))
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                break
+            if isinstance(item, _Error):
+                six.reraise(*item.exc_info)
+            yield item
+    finally:
+        # the consumer may stop early, the producer must not wait forever
+        stopped.set()
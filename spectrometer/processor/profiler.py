@@ -0,0 +1,193 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import contextlib
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+
+import six
+
+from spectrometer.openstack.common import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """Profiles top-level stages of a run, does nothing by default."""
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.local = threading.local()
+
+    def _start(self, stage):
+        pass
+
+    def _stop(self, stage):
+        pass
+
+    @contextlib.contextmanager
+    def profile(self, stage):
+        # a stage called from another one is profiled as part of it
+        if getattr(self.local, 'stage', None):
+            yield
+            return
+
+        self.local.stage = stage
+        self._start(stage)
+        try:
+            yield
+        finally:
+            self._stop(stage)
+            self.local.stage = None
+
+    def _get_file_name(self, stage, extension):
+        return os.path.join(self.directory, '%s-%s.%s' % (
+            time.strftime('%Y%m%d-%H%M%S'), stage, extension))
+
+    def dump(self):
+        """Writes profiles of stages run since the last dump."""
+        pass
+
+
+class CProfiler(Profiler):
+    """Deterministic profiler, a .prof file per stage.
+
+    Only the thread running the stage is profiled, time of worker threads
+    shows up as waiting for their results.
+    """
+
+    def __init__(self, directory='.'):
+        super(CProfiler, self).__init__(directory)
+        self.profiles = {}
+
+    def _start(self, stage):
+        if stage not in self.profiles:
+            self.profiles[stage] = cProfile.Profile()
+        # calls of the same stage are accumulated in one profile
+        self.profiles[stage].enable()
+
+    def _stop(self, stage):
+        self.profiles[stage].disable()
+
+    def dump(self):
+        for stage, profile in six.iteritems(self.profiles):
+            file_name = self._get_file_name(stage, 'prof')
+            LOG.info('Write profile of %(stage)s to %(file)s',
+                     {'stage': stage, 'file': file_name})
+            profile.dump_stats(file_name)
+        self.profiles = {}
+
+
+def _format_frame(frame):
+    code = frame.f_code
+    return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler(Profiler):
+    """Statistical profiler with overhead low enough for production runs.
+
+    A background thread takes stacks of all threads every `interval`
+    seconds while a stage runs. Stacks are written in the collapsed format
+    read by flame graph tools, a .stacks file per stage.
+    """
+
+    def __init__(self, directory='.', interval=0.01):
+        super(SamplingProfiler, self).__init__(directory)
+        self.interval = interval
+        self.samples = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.stage = None
+        self.sampler = None
+
+    def _sample(self, stage):
+        sampler_id = threading.current_thread().ident
+        stacks = []
+        for thread_id, frame in six.iteritems(sys._current_frames()):
+            if thread_id == sampler_id:
+                continue
+            stack = []
+            while frame:
+                stack.append(_format_frame(frame))
+                frame = frame.f_back
+            stacks.append(';'.join(reversed(stack)))
+        with self.lock:
+            self.samples[stage].update(stacks)
+
+    def _run_sampler(self):
+        while self.stage:
+            self._sample(self.stage)
+            time.sleep(self.interval)
+
+    def _start(self, stage):
+        self.stage = stage
+        self.sampler = threading.Thread(target=self._run_sampler)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def _stop(self, stage):
+        self.stage = None
+        self.sampler.join()
+
+    def dump(self):
+        with self.lock:
+            samples, self.samples = (
+                self.samples, collections.defaultdict(collections.Counter))
+        for stage, stacks in six.iteritems(samples):
+            file_name = self._get_file_name(stage, 'stacks')
+            LOG.info('Write %(count)s samples of %(stage)s to %(file)s',
+                     {'count': sum(six.itervalues(stacks)), 'stage': stage,
+                      'file': file_name})
+            with open(file_name, 'w') as fd:
+                for stack, count in sorted(six.iteritems(stacks)):
+                    fd.write('%s %d\n' % (stack, count))
+
+
+PROFILER = Profiler()
+
+
+def setup(mode, directory, interval):
+    global PROFILER
+
+    if not mode:
+        PROFILER = Profiler()
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if mode == 'cprofile':
+        PROFILER = CProfiler(directory)
+    else:
+        PROFILER = SamplingProfiler(directory, interval)
+    LOG.info('Profile stages with %(mode)s into %(dir)s',
+             {'mode': mode, 'dir': directory})
+
+
+def profiled(stage):
+    """Profiles every call of the decorated function as the stage."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.profile(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -13,29 +13,168 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
 import json
 import re
+import threading
+import time
 
 import paramiko
+import six
+from six.moves import queue
+from six.moves.urllib import parse
 
 from spectrometer.openstack.common import log as logging
+from spectrometer.processor import utils
 
 
 LOG = logging.getLogger(__name__)
 
 DEFAULT_PORT = 29418
 GERRIT_URI_PREFIX = r'^gerrit:\/\/'
+GERRIT_REST_URI_PREFIX = r'^(https?)\+gerrit:\/\/'
+GERRIT_XSSI_PREFIX = ")]}'"
+GERRIT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+GERRIT_REST_OPTIONS = ['ALL_REVISIONS', 'DETAILED_LABELS', 'DETAILED_ACCOUNTS']
 PAGE_LIMIT = 100
+QUEUE_SIZE = 1000
+QUEUE_TIMEOUT = 1
+
+
+class SshConnectionManager(object):
+    """Keeps one authenticated SSH transport per server alive.
+
+    Gerrit queries run on their own channels of the shared transport, so
+    polling many repos and branches costs a single handshake. Threads
+    never keep a client, they ask for it before every command.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        # replaced clients with transports still used by other threads
+        self.retired = []
+        self.lock = threading.Lock()
+
+    def _is_active(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get_client(self, hostname, port, username, key_filename,
+                   broken=None):
+        """Returns the client of the server, connects if there is none.
+
+        `broken` is the client a command has failed on. It is replaced
+        unless another thread has replaced it already, and is closed only
+        once its transport is down, other threads may still run commands
+        over it.
+        """
+        key = (hostname, port, username, key_filename)
+        with self.lock:
+            client = self.clients.get(key)
+            if (client and client is not broken and
+                    self._is_active(client)):
+                return client
+            if client:
+                LOG.debug('Reconnecting to %(host)s:%(port)s',
+                          {'host': hostname, 'port': port})
+                if self._is_active(client):
+                    self.retired.append(client)
+                else:
+                    client.close()
+                del self.clients[key]
+
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(hostname, port=port, key_filename=key_filename,
+                           username=username)
+            self.clients[key] = client
+            return client
+
+    def close_all(self):
+        with self.lock:
+            for client in list(self.clients.values()) + self.retired:
+                client.close()
+            self.clients = {}
+            self.retired = []
+
+
+CONNECTION_MANAGER = SshConnectionManager()
+
+
+def close_connections():
+    CONNECTION_MANAGER.close_all()
+    utils.HTTP_CONNECTION_POOL.close_all()
+
+
+def _get_project(project_organization, module):
+    if project_organization == "opendaylight":
+        return module
+    return '%s/%s' % (project_organization, module)
+
+
+def _get_branch_query(branches):
+    """Returns query for a branch or any branch of the list."""
+    if isinstance(branches, six.string_types):
+        branches = [branches]
+    query = ' OR '.join('branch:%s' % branch for branch in branches)
+    if len(branches) > 1:
+        query = '(%s)' % query
+    return query
+
+
+def _format_time(timestamp):
+    return time.strftime(GERRIT_TIME_FORMAT + ' +0000', time.gmtime(timestamp))
+
+
+def _check_last_id(last_id):
+    if last_id and last_id > time.time() + 24 * 3600:
+        # a sort key stored before polling by update time, poll everything
+        return None
+    return last_id
+
+
+def _track_last_id(reviews, polled_last_ids, branches, last_id):
+    """Remembers lastUpdated of the newest review as the next last id.
+
+    Reviews come newest first, so a review updated while the rest are
+    paged through is newer than the remembered value and gets picked up
+    again by the next poll. If polling fails or stops the remembered value
+    is dropped, reviews past the last page read are not polled yet.
+    """
+    key = _get_branch_query(branches)
+    polled_last_ids[key] = last_id
+    first = True
+    completed = False
+    try:
+        for review in reviews:
+            if first:
+                polled_last_ids[key] = review['lastUpdated']
+                first = False
+            yield review
+        completed = True
+    finally:
+        # failed, or closed by a consumer that has stopped
+        if not completed:
+            polled_last_ids.pop(key, None)
 
 
 class Rcs(object):
+    """Review control system.
+
+    `branch` arguments of log and get_last_id take either a branch name or
+    a list of them, the latter queries reviews of all branches at once.
+    `until` of log limits reviews to those updated until the time, it is
+    used to resume an interrupted poll.
+    """
+
     def __init__(self, repo, uri):
         self.repo = repo
 
     def setup(self, **kwargs):
         pass
 
-    def log(self, branch, last_id):
+    def log(self, branch, last_id, until=None):
         return []
 
     def get_last_id(self, branch):
@@ -54,9 +193,9 @@ class Gerrit(Rcs):
         else:
             raise Exception('Invalid rcs uri %s' % uri)
 
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.projection = None
+        # last ids as of the start of polling, see _track_last_id
+        self.polled_last_ids = {}
 
     def setup(self, **kwargs):
         if 'key_filename' in kwargs:
@@ -69,43 +208,67 @@ class Gerrit(Rcs):
         else:
             self.username = None
 
-    def _connect(self):
+        if 'projection' in kwargs:
+            # reviews are parsed in full, only the fields the consumer
+            # needs are kept
+            self.projection = kwargs['projection']
+
+    def _decode(self, line):
+        review = json.loads(line)
+        if self.projection:
+            review = utils.project(review, self.projection)
+        return review
+
+    def _connect(self, broken=None):
+        """Returns the shared client of the server or None on failure.
+
+        Polls of one repo run in several threads, so the client is not
+        kept on the instance.
+        """
         try:
-            self.client.connect(self.hostname, port=self.port,
-                                key_filename=self.key_filename,
-                                username=self.username)
-            LOG.debug('Successfully connected to Gerrit')
-            return True
+            return CONNECTION_MANAGER.get_client(
+                self.hostname, self.port, self.username, self.key_filename,
+                broken=broken)
         except Exception as e:
             LOG.error('Failed to connect to gerrit %(host)s:%(port)s. '
                       'Error: %(err)s', {'host': self.hostname,
                                          'port': self.port, 'err': e})
             LOG.exception(e)
-            return False
+            return None
 
     def _get_cmd(self, project_organization, module, branch, sort_key=None,
-                 is_open=False, limit=PAGE_LIMIT):
+                 last_updated=None, until=None, limit=PAGE_LIMIT):
         if project_organization:
-            if project_organization == "opendaylight":
-                cmd = ('gerrit query --all-approvals --patch-sets --format '
-                       ' JSON project:\'%(module)s\' branch:%(branch)s '
-                       'limit:%(limit)s' %
-                       {'module': module, 'branch': branch, 'limit': limit})
-            else:
-                cmd = ('gerrit query --all-approvals --patch-sets --format '
-                       'JSON project:\'%(ogn)s/%(module)s\' branch:%(branch)s '
-                       'limit:%(limit)s' %
-                       {'ogn': project_organization, 'module': module,
-                        'branch': branch, 'limit': limit})
-        if is_open:
-            cmd += ' is:open'
+            cmd = ('gerrit query --all-approvals --patch-sets --format '
+                   'JSON project:\'%(project)s\' %(branch)s '
+                   'limit:%(limit)s' %
+                   {'project': _get_project(project_organization, module),
+                    'branch': _get_branch_query(branch), 'limit': limit})
+        if last_updated:
+            cmd += ' \'after:"%s"\'' % _format_time(last_updated)
+        if until:
+            cmd += ' \'before:"%s"\'' % _format_time(until)
         if sort_key:
             cmd += ' resume_sortkey:%016x' % sort_key
         return cmd
 
-    def _exec_command(self, cmd):
+    def _exec_command(self, cmd, client=None, retry=True):
+        client = client or self._connect()
+        if not client:
+            return False
         try:
-            return self.client.exec_command(cmd)
+            return client.exec_command(cmd)
+        except paramiko.SSHException as e:
+            if retry:
+                # the shared transport has dropped since the last query
+                LOG.debug('Transport is broken, reconnecting: %s', e)
+                client = self._connect(broken=client)
+                if client:
+                    return self._exec_command(cmd, client, retry=False)
+            LOG.error('Error %(error)s while execute command %(cmd)s',
+                      {'error': e, 'cmd': cmd})
+            LOG.exception(e)
+            return False
         except Exception as e:
             LOG.error('Error %(error)s while execute command %(cmd)s',
                       {'error': e, 'cmd': cmd})
@@ -113,28 +276,27 @@ class Gerrit(Rcs):
             return False
 
     def _poll_reviews(self, project_organization, module, branch,
-                      start_id=None, last_id=None, is_open=False):
-        sort_key = start_id
+                      last_updated=None, until=None):
+        sort_key = None
 
         while True:
             cmd = self._get_cmd(project_organization, module, branch, sort_key,
-                                is_open)
+                                last_updated, until)
             LOG.debug('Executing command: %s', cmd)
             exec_result = self._exec_command(cmd)
             if not exec_result:
-                break
+                # the reviews past the page are unknown, the poll must not
+                # be taken for a complete one
+                raise Exception('Failed to poll reviews of module %s' %
+                                module)
             stdin, stdout, stderr = exec_result
 
             proceed = False
             for line in stdout:
-                review = json.loads(line)
+                review = self._decode(line)
 
                 if 'sortKey' in review:
                     sort_key = int(review['sortKey'], 16)
-                    if sort_key <= last_id:
-                        proceed = False
-                        break
-
                     proceed = True
                     review['module'] = module
                     yield review
@@ -142,30 +304,25 @@ class Gerrit(Rcs):
             if not proceed:
                 break
 
-    def log(self, branch, last_id):
+    def log(self, branch, last_id, until=None):
         if not self._connect():
-            return
-
-        # poll new reviews from the top down to last_id
-        LOG.debug('Poll new reviews for module: %s', self.repo['module'])
-        for review in self._poll_reviews(self.repo['organization'],
-                                         self.repo['module'], branch,
-                                         last_id=last_id):
-            yield review
-
-        # poll open reviews from last_id down to bottom
-        LOG.debug('Poll open reviews for module: %s', self.repo['module'])
-        start_id = None
-        if last_id:
-            start_id = last_id + 1  # include the last review into query
-        for review in self._poll_reviews(self.repo['organization'],
-                                         self.repo['module'], branch,
-                                         start_id=start_id, is_open=True):
+            raise Exception('Failed to connect to gerrit %s' % self.hostname)
+
+        # poll only reviews updated since the last run, newest first
+        LOG.debug('Poll reviews for module: %s', self.repo['module'])
+        last_id = _check_last_id(last_id)
+        reviews = self._poll_reviews(self.repo['organization'],
+                                     self.repo['module'], branch,
+                                     last_updated=last_id, until=until)
+        for review in _track_last_id(reviews, self.polled_last_ids, branch,
+                                     last_id):
             yield review
 
-        self.client.close()
-
     def get_last_id(self, branch):
+        key = _get_branch_query(branch)
+        if key in self.polled_last_ids:
+            return self.polled_last_ids.pop(key)
+
         if not self._connect():
             return None
 
@@ -182,22 +339,269 @@ class Gerrit(Rcs):
         last_id = None
         for line in stdout:
             review = json.loads(line)
-            if 'sortKey' in review:
-                last_id = int(review['sortKey'], 16)
+            if 'lastUpdated' in review:
+                last_id = review['lastUpdated']
+                break
+
+        LOG.debug('Module %(module)s last id is %(id)s',
+                  {'module': self.repo['module'], 'id': last_id})
+        return last_id
+
+
+def _parse_time(s):
+    # REST API timestamps are UTC with nanoseconds: 2014-01-24 10:32:16.0000
+    return calendar.timegm(time.strptime(s[:19], GERRIT_TIME_FORMAT))
+
+
+def _make_account(account):
+    return dict((k, v) for k, v in account.items()
+                if k in ('name', 'email', 'username'))
+
+
+class GerritRest(Rcs):
+    """Polls reviews through the Gerrit REST API over keep-alive HTTP.
+
+    Changes are converted into the same records `gerrit query` returns
+    over SSH. Last id is the time of the latest change update, the REST
+    API reports only the latest vote of every reviewer, so a vote is
+    attached to the patch set that was current when it was cast.
+    """
+
+    def __init__(self, repo, uri):
+        super(GerritRest, self).__init__(repo, uri)
+
+        match = re.search(GERRIT_REST_URI_PREFIX, uri)
+        stripped = uri[match.end():].rstrip('/') if match else None
+        if not stripped:
+            raise Exception('Invalid rcs uri %s' % uri)
+        self.base_uri = '%s://%s' % (match.group(1), stripped)
+
+        # last ids as of the start of polling, see _track_last_id
+        self.polled_last_ids = {}
+
+    def _query(self, query, start=0, limit=PAGE_LIMIT):
+        params = [('q', query), ('n', limit), ('S', start)]
+        params += [('o', option) for option in GERRIT_REST_OPTIONS]
+        uri = '%s/changes/?%s' % (self.base_uri, parse.urlencode(params))
+        LOG.debug('Requesting: %s', uri)
+
+        status, headers, body = utils.HTTP_CONNECTION_POOL.request(
+            uri, headers={'Accept': 'application/json'})
+        if status != 200:
+            raise Exception('Gerrit responded with status %(status)s to '
+                            '%(uri)s' % {'status': status, 'uri': uri})
+        if body.startswith(GERRIT_XSSI_PREFIX):
+            body = body[len(GERRIT_XSSI_PREFIX):]
+        return json.loads(body)
+
+    def _poll_changes(self, query):
+        """Pages through the changes of the query, newest first.
+
+        Pages are keyed by update time rather than offset. A change updated
+        during a poll limited by `until` leaves the results, with an offset
+        the change moving up into the page already read would be skipped.
+        `before:` takes whole seconds, so the next page starts within the
+        second of the last change read and the changes seen are dropped.
+        """
+        before = None
+        start = 0
+        # update times of the changes seen in the second of `before`
+        seen = {}
+        while True:
+            page_query = query
+            if before is not None:
+                page_query += ' before:"%s"' % _format_time(before + 1)
+            changes = self._query(page_query, start=start)
+
+            fresh = False
+            for change in changes:
+                if change['_number'] in seen:
+                    continue
+                seen[change['_number']] = _parse_time(change['updated'])
+                fresh = True
+                yield change
+            if not changes or not changes[-1].get('_more_changes'):
                 break
 
-        self.client.close()
+            if fresh:
+                before = _parse_time(changes[-1]['updated'])
+                start = 0
+                seen = dict((number, updated)
+                            for number, updated in six.iteritems(seen)
+                            if updated >= before)
+            else:
+                # a whole page of changes updated within the same second
+                start += len(changes)
+
+    def _get_query(self, branch, last_id=None, until=None):
+        query = 'project:%(project)s %(branch)s' % {
+            'project': _get_project(self.repo['organization'],
+                                    self.repo['module']),
+            'branch': _get_branch_query(branch)}
+        if last_id:
+            query += ' after:"%s"' % _format_time(last_id)
+        if until:
+            query += ' before:"%s"' % _format_time(until)
+        return query
+
+    def _make_patch_sets(self, change):
+        patch_sets = []
+        for revision_id, revision in change.get('revisions', {}).items():
+            patch_sets.append({
+                'number': str(revision['_number']),
+                'revision': revision_id,
+                'ref': revision.get('ref'),
+                'createdOn': _parse_time(revision['created']),
+                'uploader': _make_account(revision.get('uploader', {})),
+            })
+        patch_sets.sort(key=lambda patch: int(patch['number']))
+
+        for label, label_info in change.get('labels', {}).items():
+            for vote in label_info.get('all', []):
+                if not vote.get('value') or 'date' not in vote:
+                    continue
+                granted_on = _parse_time(vote['date'])
+                patches = ([p for p in patch_sets
+                            if p['createdOn'] <= granted_on] or patch_sets)
+                if not patches:
+                    continue
+                patches[-1].setdefault('approvals', []).append({
+                    'type': label,
+                    'description': label,
+                    'value': str(vote['value']),
+                    'grantedOn': granted_on,
+                    'by': _make_account(vote),
+                })
+
+        for patch in patch_sets:
+            if 'approvals' in patch:
+                patch['approvals'].sort(key=lambda a: a['grantedOn'])
+        return patch_sets
+
+    def _make_review(self, change):
+        review = {
+            'id': change['change_id'],
+            'number': str(change['_number']),
+            'subject': change['subject'],
+            'project': change['project'],
+            'branch': change['branch'],
+            'status': change['status'],
+            'open': change['status'] == 'NEW',
+            'url': '%s/%s' % (self.base_uri, change['_number']),
+            'createdOn': _parse_time(change['created']),
+            'lastUpdated': _parse_time(change['updated']),
+            'owner': _make_account(change['owner']),
+            'patchSets': self._make_patch_sets(change),
+            'module': self.repo['module'],
+        }
+        if change.get('topic'):
+            review['topic'] = change['topic']
+        return review
+
+    def log(self, branch, last_id, until=None):
+        # reviews get updated on every new patch set and vote, so polling
+        # the ones updated after last_id covers the open reviews too
+        LOG.debug('Poll reviews for module: %s', self.repo['module'])
+        last_id = _check_last_id(last_id)
+        query = self._get_query(branch, last_id, until)
+        reviews = (self._make_review(change)
+                   for change in self._poll_changes(query))
+        for review in _track_last_id(reviews, self.polled_last_ids, branch,
+                                     last_id):
+            yield review
+
+    def get_last_id(self, branch):
+        key = _get_branch_query(branch)
+        if key in self.polled_last_ids:
+            return self.polled_last_ids.pop(key)
+
+        LOG.debug('Get last id for module: %s', self.repo['module'])
+        changes = self._query(self._get_query(branch), limit=1)
+        last_id = _parse_time(changes[0]['updated']) if changes else None
 
         LOG.debug('Module %(module)s last id is %(id)s',
                   {'module': self.repo['module'], 'id': last_id})
         return last_id
 
 
+def _put_result(results, stopped, result):
+    """Puts the result unless the consumer has stopped, returns if put."""
+    while not stopped.is_set():
+        try:
+            results.put(result, timeout=QUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _poll_worker(tasks, results, stopped):
+    while not stopped.is_set():
+        try:
+            key, rcs_inst, branch, last_id, until = tasks.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            for review in rcs_inst.log(branch, last_id, until):
+                if not _put_result(results, stopped, ('review', key, review)):
+                    return
+            if not _put_result(results, stopped,
+                               ('done', key, rcs_inst.get_last_id(branch))):
+                return
+        except Exception as e:
+            LOG.error('Failed to poll reviews for %(key)s: %(err)s',
+                      {'key': key, 'err': e})
+            LOG.exception(e)
+    _put_result(results, stopped, ('exit', None, None))
+
+
+def log_concurrently(tasks, concurrency):
+    """Polls reviews of several modules and branches at once.
+
+    Every task is a tuple (key, rcs_inst, branch, last_id, until), where
+    branch may be a list of branches polled by a single query, at most
+    `concurrency` of them run at the same time, each on its own channel.
+    Yields ('review', key, review) for every review and ('done', key,
+    new_last_id) once a task is polled completely.
+    """
+    task_queue = queue.Queue()
+    for task in tasks:
+        task_queue.put(task)
+
+    results = queue.Queue(QUEUE_SIZE)
+    stopped = threading.Event()
+    workers = min(max(concurrency, 1), task_queue.qsize())
+    for i in range(workers):
+        worker = threading.Thread(target=_poll_worker,
+                                  args=(task_queue, results, stopped))
+        worker.daemon = True
+        worker.start()
+
+    try:
+        while workers:
+            kind, key, value = results.get()
+            if kind == 'exit':
+                workers -= 1
+            else:
+                yield kind, key, value
+    finally:
+        # the consumer may stop early, workers waiting for room in the
+        # queue must give up and exit
+        stopped.set()
+        while True:
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                break
+
+
 def get_rcs(repo, uri):
     LOG.debug('Review control system is requested for uri %s' % uri)
     match = re.search(GERRIT_URI_PREFIX, uri)
     if match:
         return Gerrit(repo, uri)
+    if re.search(GERRIT_REST_URI_PREFIX, uri):
+        return GerritRest(repo, uri)
     else:
         LOG.warning('Unsupported review control system, fallback to dummy')
         return Rcs(repo, uri)
@@ -16,16 +16,55 @@
 import bisect
 import collections
 import copy
+import functools
 import time
 
 import six
 
 from spectrometer.openstack.common import log as logging
+from spectrometer.processor import metrics
+from spectrometer.processor import profiler
 from spectrometer.processor import utils
 
 
 LOG = logging.getLogger(__name__)
 
+UPDATE_PROGRESS_KEY = 'update_progress'
+CORE_CONTRIBUTORS_DATE_KEY = 'core_contributors_update_date'
+# core contributors are those with +2/-2 marks within the last quarter
+CORE_CONTRIBUTORS_UPDATE_INTERVAL = 24 * 60 * 60
+
+USER_PROJECTION = {'name': None, 'email': None, 'username': None}
+
+# fields of Gerrit reviews used by _process_review, top-level fields are
+# copied into review records as is
+REVIEW_PROJECTION = {
+    'id': None,
+    'number': None,
+    'subject': None,
+    'project': None,
+    'branch': None,
+    'topic': None,
+    'url': None,
+    'status': None,
+    'open': None,
+    'sortKey': None,
+    'createdOn': None,
+    'lastUpdated': None,
+    'owner': USER_PROJECTION,
+    'patchSets': {
+        'number': None,
+        'createdOn': None,
+        'uploader': USER_PROJECTION,
+        'approvals': {
+            'type': None,
+            'value': None,
+            'grantedOn': None,
+            'by': USER_PROJECTION,
+        },
+    },
+}
+
 
 class RecordProcessor(object):
     def __init__(self, runtime_storage_inst):
@@ -39,6 +78,9 @@ class RecordProcessor(object):
         self.modules = None
         self.alias_module_map = None
 
+        # records are processed since the last update started
+        self.records_processed = False
+
     def _get_release(self, timestamp):
         release_index = bisect.bisect(self.releases_dates, timestamp)
         if release_index >= len(self.releases):
@@ -299,7 +341,12 @@ class RecordProcessor(object):
         if 'email' not in owner or 'username' not in owner:
             return  # ignore
 
-        yield self._make_review_record(record)
+        digest = utils.make_digest(record)
+        if self.runtime_storage_inst.get_digest(record['id']) == digest:
+            return  # not changed since the last poll
+
+        review = self._make_review_record(record)
+        review['digest'] = digest
 
         for patch in record.get('patchSets', []):
             if (('email' not in patch['uploader']) or
@@ -320,6 +367,10 @@ class RecordProcessor(object):
 
                 yield self._make_mark_record(record, patch, approval)
 
+        # the review goes last, so its digest is stored only after all
+        # the patches and marks made of it
+        yield review
+
     def _guess_module(self, record):
         subject = record['subject'].lower()
         pos = len(subject)
@@ -445,6 +496,12 @@ class RecordProcessor(object):
 
                 self._renew_record_date(r)
 
+                if not self.records_processed:
+                    # passes of an interrupted update miss the new records
+                    self.runtime_storage_inst.set_by_key(UPDATE_PROGRESS_KEY,
+                                                         None)
+                    self.records_processed = True
+
                 yield r
 
     def _update_records_with_releases(self, release_index):
@@ -460,10 +517,13 @@ class RecordProcessor(object):
                 record['release'] = release
                 yield record
 
-    def _update_records_with_user_info(self):
+    def _update_records_with_user_info(self, record_filter=None):
         LOG.debug('Update user info in records')
 
         for record in self.runtime_storage_inst.get_all_records():
+            if record_filter and not record_filter(record):
+                continue
+
             company_name = record['company_name']
             user_id = record['user_id']
             author_name = record['author_name']
@@ -666,25 +726,100 @@ class RecordProcessor(object):
             for processed in self._close_patch(cores, marks_patch['marks']):
                 yield processed
 
-    def update(self, release_index=None):
-        self.runtime_storage_inst.set_records(
-            self._update_records_with_user_info())
+    def update_user_info(self, user_ids, emails, domains):
+        """Updates user info only in records of the given users.
 
-        if release_index:
+        Records are picked by user id, author email or a domain of the
+        email, the way companies are looked up.
+        """
+        def is_affected(record):
+            email = record.get('author_email') or ''
+            if record.get('user_id') in user_ids or email in emails:
+                return True
+            parts = email.partition('@')[2].split('.')
+            return any('.'.join(parts[i:]) in domains
+                       for i in range(len(parts) - 1))
+
+        with metrics.METRICS.timer('update_user_info'):
             self.runtime_storage_inst.set_records(
-                self._update_records_with_releases(release_index))
-
-        self.runtime_storage_inst.set_records(
-            self._update_reviews_with_sequence_number())
-
-        self.runtime_storage_inst.set_records(
-            self._update_blueprints_with_mention_info())
-
-        self.runtime_storage_inst.set_records(
-            self._update_commits_with_merge_date())
+                self._update_records_with_user_info(is_affected))
 
-        self._determine_core_contributors()
+    def update_releases(self, release_index):
+        with metrics.METRICS.timer('update_releases'):
+            self.runtime_storage_inst.set_records(
+                self._update_records_with_releases(release_index))
 
-        # disagreement calculation must go after determining core contributors
-        self.runtime_storage_inst.set_records(
-            self._update_marks_with_disagreement())
+    def _get_update_passes(self, release_index):
+        passes = [('user_info', self._update_records_with_user_info)]
+        if release_index:
+            passes.append(('releases', functools.partial(
+                self._update_records_with_releases, release_index)))
+        passes += [
+            ('review_numbers', self._update_reviews_with_sequence_number),
+            ('blueprint_mentions', self._update_blueprints_with_mention_info),
+            ('merge_dates', self._update_commits_with_merge_date),
+            ('core_contributors', self._determine_core_contributors),
+            # disagreement calculation must go after determining core
+            # contributors
+            ('disagreement', self._update_marks_with_disagreement),
+        ]
+        return passes
+
+    def _get_completed_passes(self):
+        # a pass is marked once all its records are stored, the marks are
+        # reset by processing of new records, not by writes of the passes
+        progress = self.runtime_storage_inst.get_by_key(
+            UPDATE_PROGRESS_KEY) or {}
+        return progress.get('passes', [])
+
+    def is_update_needed(self):
+        # new records or passes left by an interrupted update
+        return bool(self.records_processed or
+                    self.runtime_storage_inst.get_by_key(UPDATE_PROGRESS_KEY))
+
+    def is_core_update_needed(self):
+        # marks leave the quarter with time, without any new records
+        update_date = self.runtime_storage_inst.get_by_key(
+            CORE_CONTRIBUTORS_DATE_KEY) or 0
+        return (update_date + CORE_CONTRIBUTORS_UPDATE_INTERVAL <=
+                int(time.time()))
+
+    def _run_pass(self, name, update_pass):
+        with metrics.METRICS.timer('update_' + name):
+            records = update_pass()
+            # core contributors are stored with users, not records
+            if records is not None:
+                self.runtime_storage_inst.set_records(records)
+
+    def update_core_contributors(self):
+        """Refreshes core contributors and disagreement of their marks."""
+        update_date = int(time.time())
+        for name, update_pass in self._get_update_passes(None):
+            if name in ('core_contributors', 'disagreement'):
+                self._run_pass(name, update_pass)
+        self.runtime_storage_inst.set_by_key(CORE_CONTRIBUTORS_DATE_KEY,
+                                             update_date)
+
+    @profiler.profiled('update')
+    def update(self, release_index=None):
+        self.records_processed = False
+        update_date = int(time.time())
+        completed = self._get_completed_passes()
+        # an update interrupted in its first pass is left to resume too
+        self.runtime_storage_inst.set_by_key(UPDATE_PROGRESS_KEY, {
+            'passes': completed})
+        for name, update_pass in self._get_update_passes(release_index):
+            if name in completed:
+                LOG.info('Pass %s is completed by the interrupted update, '
+                         'skip it', name)
+                continue
+
+            self._run_pass(name, update_pass)
+
+            completed.append(name)
+            self.runtime_storage_inst.set_by_key(UPDATE_PROGRESS_KEY, {
+                'passes': completed})
+
+        self.runtime_storage_inst.set_by_key(UPDATE_PROGRESS_KEY, None)
+        self.runtime_storage_inst.set_by_key(CORE_CONTRIBUTORS_DATE_KEY,
+                                             update_date)
@@ -13,12 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import re
 
 import memcache
 import six
+from six.moves import cPickle as pickle
 
 from spectrometer.openstack.common import log as logging
+from spectrometer.processor import metrics
 from spectrometer.processor import utils
 
 
@@ -31,6 +34,91 @@ UPDATE_ID_PREFIX = 'update:'
 MEMCACHED_URI_PREFIX = r'^memcached:\/\/'
 
 
+def _metered(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with metrics.METRICS.timer('storage'):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _MeteredPickler(object):
+    """Pickler of memcache.Client counting bytes of the pickled values."""
+
+    def __init__(self, file, protocol=0):
+        self.file = file
+        self.pickler = pickle.Pickler(file, protocol)
+
+    def dump(self, value):
+        self.pickler.dump(value)
+        metrics.METRICS.add('storage', 'bytes_written', self.file.tell())
+
+
+class _MeteredUnpickler(object):
+    """Unpickler of memcache.Client counting bytes of the read values."""
+
+    def __init__(self, file):
+        self.file = file
+        self.unpickler = pickle.Unpickler(file)
+
+    def load(self):
+        value = self.unpickler.load()
+        metrics.METRICS.add('storage', 'bytes_read', self.file.tell())
+        return value
+
+
+def _add_bytes(counter, values):
+    # pickled values are counted as memcache.Client serializes them
+    metrics.METRICS.add('storage', counter, sum(
+        len(value) for value in values
+        if isinstance(value, (six.binary_type, six.text_type))))
+
+
+class MeteredClient(memcache.Client):
+    """memcache.Client that accounts its requests in processor metrics.
+
+    Calls of the 'storage' stage are round trips to memcached, multi key
+    requests count once however many servers they touch. Bytes are sizes
+    of the strings and of the values as pickled, not counting compression.
+    """
+
+    def __init__(self, servers, **kwargs):
+        kwargs.setdefault('pickler', _MeteredPickler)
+        kwargs.setdefault('unpickler', _MeteredUnpickler)
+        super(MeteredClient, self).__init__(servers, **kwargs)
+
+    add = _metered(memcache.Client.add)
+    incr = _metered(memcache.Client.incr)
+    delete = _metered(memcache.Client.delete)
+    delete_multi = _metered(memcache.Client.delete_multi)
+
+    def get(self, key):
+        with metrics.METRICS.timer('storage'):
+            value = super(MeteredClient, self).get(key)
+        _add_bytes('bytes_read', [value])
+        return value
+
+    def get_multi(self, keys, *args, **kwargs):
+        with metrics.METRICS.timer('storage'):
+            values = super(MeteredClient, self).get_multi(keys, *args,
+                                                          **kwargs)
+        _add_bytes('bytes_read', six.itervalues(values))
+        return values
+
+    def set(self, key, val, *args, **kwargs):
+        with metrics.METRICS.timer('storage'):
+            result = super(MeteredClient, self).set(key, val, *args, **kwargs)
+        _add_bytes('bytes_written', [val])
+        return result
+
+    def set_multi(self, mapping, *args, **kwargs):
+        with metrics.METRICS.timer('storage'):
+            result = super(MeteredClient, self).set_multi(mapping, *args,
+                                                          **kwargs)
+        _add_bytes('bytes_written', six.itervalues(mapping))
+        return result
+
+
 class RuntimeStorage(object):
     def __init__(self, uri):
         pass
@@ -44,6 +132,12 @@ class RuntimeStorage(object):
     def get_by_key(self, key):
         pass
 
+    def get_digest(self, primary_key):
+        pass
+
+    def has_record(self, primary_key):
+        return False
+
     def set_by_key(self, key, value):
         pass
 
@@ -64,7 +158,7 @@ class MemcachedStorage(RuntimeStorage):
         stripped = re.sub(MEMCACHED_URI_PREFIX, '', uri)
         if stripped:
             storage_uri = stripped.split(',')
-            self.memcached = memcache.Client(storage_uri)
+            self.memcached = MeteredClient(storage_uri)
             self._build_index()
             self._init_user_count()
         else:
@@ -72,30 +166,63 @@ class MemcachedStorage(RuntimeStorage):
 
     def _build_index(self):
         self.record_index = {}
+        self.digest_index = {}
         for record in self.get_all_records():
             self.record_index[record['primary_key']] = record['record_id']
+            self.digest_index[record['primary_key']] = record.get('digest')
+
+    def has_record(self, primary_key):
+        return primary_key in self.record_index
+
+    def get_digest(self, primary_key):
+        """Returns content digest the record was stored with, if any."""
+        return self.digest_index.get(primary_key)
+
+    def _make_digest(self, record):
+        if 'digest' in record:
+            # set by the producer from the data the record is made of
+            return record['digest']
+        return utils.make_digest(dict(
+            (k, v) for k, v in six.iteritems(record) if k != 'record_id'))
 
     def set_records(self, records_iterator, merge_handler=None):
+        """Stores records, inserting new and updating existing ones.
+
+        When records are merged into existing ones, records that have not
+        changed since they were stored, according to their digest, are
+        skipped without reading the original.
+        """
         for record in records_iterator:
-            if record['primary_key'] in self.record_index:
+            primary_key = record['primary_key']
+            if primary_key in self.record_index:
                 # update
-                record_id = self.record_index[record['primary_key']]
+                record_id = self.record_index[primary_key]
                 if not merge_handler:
                     record['record_id'] = record_id
                     LOG.debug('Update record %s', record)
                     self.set_by_key(self._get_record_name(record_id), record)
+                    self.digest_index[primary_key] = record.get('digest')
                 else:
+                    digest = self._make_digest(record)
+                    if self.digest_index.get(primary_key) == digest:
+                        continue  # not changed
+
                     original = self.get_by_key(self._get_record_name(
                         record_id))
                     if merge_handler(original, record):
                         LOG.debug('Update record with merge %s', record)
+                        original['digest'] = digest
                         self.set_by_key(self._get_record_name(record_id),
                                         original)
+                    self.digest_index[primary_key] = digest
             else:
                 # insert record
                 record_id = self._get_record_count()
                 record['record_id'] = record_id
-                self.record_index[record['primary_key']] = record_id
+                if merge_handler:
+                    record['digest'] = self._make_digest(record)
+                self.record_index[primary_key] = record_id
+                self.digest_index[primary_key] = record.get('digest')
                 LOG.debug('Insert new record %s', record)
                 self.set_by_key(self._get_record_name(record_id), record)
                 self._set_record_count(record_id + 1)
@@ -0,0 +1,104 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import six
+
+from spectrometer.openstack.common import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+MAX_IDLE_TIME = 60
+
+
+class Task(object):
+    def __init__(self, name, action, interval, priority, next_run):
+        self.name = name
+        self.action = action
+        self.interval = interval
+        self.priority = priority
+        self.next_run = next_run
+        self.running = False
+
+
+class Scheduler(object):
+    """Runs periodic tasks one at a time in the calling thread.
+
+    Among due tasks the one with the highest priority runs first, ties go
+    to the task that has waited longer. A task is rescheduled `interval`
+    seconds after its run ends, so runs of the same task never overlap or
+    pile up however long they take.
+    """
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = {}
+        self.stopped = False
+
+    def add(self, name, action, interval, priority=0, delay=0):
+        if interval <= 0:
+            LOG.info('Task %s is disabled', name)
+            return
+        self.tasks[name] = Task(name, action, interval, priority,
+                                self.clock() + delay)
+
+    def _get_next_task(self, now):
+        due_tasks = [task for task in six.itervalues(self.tasks)
+                     if task.next_run <= now and not task.running]
+        if not due_tasks:
+            return None
+        return min(due_tasks, key=lambda t: (-t.priority, t.next_run))
+
+    def _run_task(self, task):
+        LOG.info('Run task %s', task.name)
+        task.running = True
+        start = self.clock()
+        try:
+            task.action()
+        except Exception as e:
+            LOG.exception('Task %(name)s failed: %(error)s',
+                          {'name': task.name, 'error': e})
+        finally:
+            task.running = False
+            task.next_run = self.clock() + task.interval
+        LOG.info('Task %(name)s took %(time).1fs, next run in %(interval)ss',
+                 {'name': task.name, 'time': self.clock() - start,
+                  'interval': task.interval})
+
+    def run_pending(self):
+        """Runs the most urgent due task, returns False if none is due."""
+        task = self._get_next_task(self.clock())
+        if not task:
+            return False
+        self._run_task(task)
+        return True
+
+    def _get_idle_time(self):
+        if not self.tasks:
+            return MAX_IDLE_TIME
+        next_run = min(task.next_run for task in six.itervalues(self.tasks))
+        return min(max(next_run - self.clock(), 0), MAX_IDLE_TIME)
+
+    def run(self):
+        self.stopped = False
+        while not self.stopped:
+            if not self.run_pending():
+                self.sleep(self._get_idle_time())
+
+    def stop(self):
+        self.stopped = True
@@ -15,12 +15,18 @@
 
 import cgi
 import datetime
+import hashlib
 import json
 import re
+import socket
+import sys
+import threading
 import time
 
 import iso8601
 import six
+from six.moves import http_client
+from six.moves import queue
 from six.moves.urllib import parse
 from six.moves.urllib import request
 
@@ -84,6 +90,13 @@ def check_email_validity(email):
 
 def read_uri(uri):
     try:
+        if parse.urlparse(uri).scheme in ('http', 'https'):
+            status, headers, raw = HTTP_CONNECTION_POOL.request(uri)
+            if status != 200:
+                LOG.warn('Error %(status)s while reading uri %(uri)s',
+                         {'status': status, 'uri': uri})
+                return None
+            return raw
         fd = request.urlopen(uri)
         raw = fd.read()
         fd.close()
@@ -92,6 +105,242 @@ def read_uri(uri):
         LOG.warn('Error while reading uri: %s' % e)
 
 
+class HttpConnectionPool(object):
+    """Keeps idle HTTP/1.1 connections alive between requests.
+
+    Connections are kept per scheme and host, a connection is used by one
+    request at a time, so the pool is safe to share between threads. At
+    most `connections_per_host` requests to a host run at a time, others
+    wait for them. Requests failed with a connection error or a status in
+    RETRY_STATUSES are retried `retries` times, waiting `backoff` seconds
+    doubled on every retry. Redirects are followed up to MAX_REDIRECTS
+    times, like urlopen does.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 10
+
+    def __init__(self, timeout=60, connections_per_host=0, retries=0,
+                 backoff=1):
+        self.timeout = timeout
+        self.connections_per_host = connections_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.idle = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def _acquire(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def _release(self, key, connection):
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+
+    def _make_connection(self, scheme, netloc):
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http_client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _get_slots(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.Semaphore(
+                    self.connections_per_host)
+            return self.slots[key]
+
+    def request(self, uri, headers=None):
+        """Performs GET request, returns tuple (status, headers, body)."""
+        for i in range(self.MAX_REDIRECTS + 1):
+            result = self._request_retried(uri, headers)
+            status, response_headers, body = result
+            if (status not in self.REDIRECT_STATUSES or
+                    'location' not in response_headers):
+                return result
+            uri = parse.urljoin(uri, response_headers['location'])
+            LOG.debug('Redirected to uri %s', uri)
+        raise http_client.HTTPException('Too many redirects for uri %s' %
+                                        uri)
+
+    def _request_retried(self, uri, headers):
+        parsed = parse.urlparse(uri)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        attempt = 0
+        while True:
+            try:
+                result = self._request_limited(key, path, headers)
+            except (http_client.HTTPException, socket.error) as e:
+                if attempt >= self.retries:
+                    raise
+                LOG.debug('Error %(err)s while reading uri %(uri)s, retry',
+                          {'err': e, 'uri': uri})
+            else:
+                if result[0] not in self.RETRY_STATUSES or (
+                        attempt >= self.retries):
+                    return result
+                LOG.debug('Status %(status)s while reading uri %(uri)s, '
+                          'retry', {'status': result[0], 'uri': uri})
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _request_limited(self, key, path, headers):
+        if not self.connections_per_host:
+            return self._request(key, path, headers)
+        slots = self._get_slots(key)
+        slots.acquire()
+        try:
+            return self._request(key, path, headers)
+        finally:
+            slots.release()
+
+    def _request(self, key, path, headers):
+        connection = self._acquire(key)
+        reused = connection is not None
+        while True:
+            if not connection:
+                connection = self._make_connection(*key)
+            try:
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                connection = None
+                if not reused:
+                    raise
+                # the server has closed the idle connection meanwhile
+                reused = False
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return response.status, dict(response.getheaders()), body
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+HTTP_CONNECTION_POOL = HttpConnectionPool()
+
+
+def setup_http_connection_pool(timeout, connections_per_host, retries):
+    global HTTP_CONNECTION_POOL
+
+    HTTP_CONNECTION_POOL.close_all()
+    HTTP_CONNECTION_POOL = HttpConnectionPool(timeout, connections_per_host,
+                                              retries)
+
+
+def _imap_worker(func, tasks, results, slots):
+    while True:
+        slots.acquire()
+        try:
+            index, item = tasks.get_nowait()
+        except queue.Empty:
+            slots.release()
+            break
+        try:
+            results[index].put((True, func(item)))
+        except Exception:
+            results[index].put((False, sys.exc_info()))
+
+
+def imap_concurrently(func, items, concurrency):
+    """Yields results of func called for the items in worker threads.
+
+    Results are yielded in the order of items. At most `concurrency` calls
+    are running or have their results waiting to be consumed at a time, so
+    the consumer handles one result while the following ones are being
+    produced. An exception of a call is raised when its result is due.
+    """
+    items = list(items)
+    concurrency = max(concurrency, 1)
+    tasks = queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+    results = [queue.Queue(1) for item in items]
+    slots = threading.Semaphore(concurrency)
+
+    for i in range(min(concurrency, len(items))):
+        worker = threading.Thread(target=_imap_worker,
+                                  args=(func, tasks, results, slots))
+        worker.daemon = True
+        worker.start()
+
+    try:
+        for result in results:
+            succeeded, value = result.get()
+            if not succeeded:
+                six.reraise(*value)
+            yield value
+            slots.release()
+    finally:
+        # the consumer may stop early, workers waiting for a slot must
+        # find no tasks left and exit
+        while True:
+            try:
+                tasks.get_nowait()
+            except queue.Empty:
+                break
+        for i in range(concurrency):
+            slots.release()
+
+
+class RateLimiter(object):
+    """Spaces calls of wait() to at most `rate` per second over threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            scheduled = max(now, self.next_time)
+            self.next_time = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+def project(value, projection):
+    """Keeps only the fields of the projection in the decoded JSON value.
+
+    Projection is a dict that maps field names either to None, keeping the
+    value as is, or to a nested projection applied to the object or to
+    every object of the list.
+    """
+    if isinstance(value, list):
+        return [project(item, projection) for item in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for field, nested in six.iteritems(projection):
+        if field in value:
+            if nested:
+                result[field] = project(value[field], nested)
+            else:
+                result[field] = value[field]
+    return result
+
+
 def read_json_from_uri(uri):
     try:
         LOG.debug("Reading JSON from URI: %s" % uri)
@@ -170,6 +419,18 @@ def merge_records(original, new):
     return need_update
 
 
+def _sorted_set(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def make_digest(data):
+    """Returns digest of JSON-like data that does not depend on key order."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True,
+                                   default=_sorted_set)).hexdigest()
+
+
 def get_blueprint_id(module, name):
     return module + ':' + name
 
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import os
 import re
 import shutil
@@ -20,7 +21,13 @@ import shutil
 import sh
 import six
 
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
 from spectrometer.openstack.common import log as logging
+from spectrometer.processor import commit_cache
 from spectrometer.processor import utils
 
 
@@ -41,15 +48,29 @@ class Vcs(object):
     def fetch(self):
         pass
 
+    def ls_remote(self):
+        return None
+
     def get_release_index(self):
         pass
 
     def log(self, branch, head_commit_id):
         pass
 
+    def log_all(self, head_commit_ids):
+        for branch, head_commit_id in six.iteritems(head_commit_ids):
+            for commit in self.log(branch, head_commit_id) or []:
+                yield commit
+
     def get_last_id(self, branch):
         pass
 
+    def is_ancestor(self, ancestor_id, commit_id):
+        return False
+
+    def maintain(self, task):
+        return False
+
 
 GIT_LOG_PARAMS = [
     ('commit_id', '%H'),
@@ -59,8 +80,11 @@ GIT_LOG_PARAMS = [
     ('subject', '%s'),
     ('message', '%b'),
 ]
-GIT_LOG_FORMAT = ''.join([(r[0] + ':' + r[1] + '%n')
-                          for r in GIT_LOG_PARAMS]) + 'diff_stat:'
+# records are separated by NUL, a commit without diff stat (no files
+# changed) must not take the record of the next one
+GIT_LOG_RECORD_SEPARATOR = '\x00'
+GIT_LOG_FORMAT = '%x00' + ''.join([(r[0] + ':' + r[1] + '%n')
+                                   for r in GIT_LOG_PARAMS]) + 'diff_stat:'
 DIFF_STAT_PATTERN = ('[^\d]+(\d+)\s+[^\s]*\s+changed'
                      '(,\s+(\d+)\s+([^\d\s]*)\s+(\d+)?)?')
 GIT_LOG_PATTERN = re.compile(''.join([(r[0] + ':(.*?)\n')
@@ -68,6 +92,13 @@ GIT_LOG_PATTERN = re.compile(''.join([(r[0] + ':(.*?)\n')
                              'diff_stat:' + DIFF_STAT_PATTERN,
                              re.DOTALL)
 
+# maintenance task -> (interval in seconds, git command)
+MAINTENANCE_TASKS = {
+    'commit-graph': (60 * 60, ['commit-graph', 'write', '--reachable']),
+    'repack': (24 * 60 * 60, ['repack', '-a', '-d', '-l']),
+    'prune': (7 * 24 * 60 * 60, ['prune', '--expire', '2.weeks.ago']),
+}
+
 CO_AUTHOR_PATTERN_RAW = '(?P<author_name>.+?)\s*<(?P<author_email>.+)>'
 CO_AUTHOR_PATTERN = re.compile(CO_AUTHOR_PATTERN_RAW, re.IGNORECASE)
 
@@ -94,6 +125,7 @@ class Git(Vcs):
         else:
             raise Exception('Unexpected uri %s for git' % uri)
         self.release_index = {}
+        self.commit_cache = commit_cache.CommitCache(self.sources_root)
 
     def _checkout(self, branch):
         try:
@@ -138,6 +170,24 @@ class Git(Vcs):
 
         self.get_release_index()
 
+    def ls_remote(self):
+        LOG.debug('List remote heads of repo uri %s', self.repo['uri'])
+
+        try:
+            output = sh.git('ls-remote', '--heads', self.repo['uri'],
+                            _tty_out=False)
+        except sh.ErrorReturnCode as e:
+            LOG.error('Unable to list remote heads of git repo %s',
+                      self.repo['uri'])
+            LOG.exception(e)
+            return None
+
+        heads = {}
+        for line in output:
+            commit_id, refname = line.split()
+            heads[refname[len('refs/heads/'):]] = commit_id
+        return heads
+
     def get_release_index(self):
         if not os.path.exists(self.folder):
             return {}
@@ -175,20 +225,143 @@ class Git(Vcs):
         commit_range = 'HEAD'
         if head_commit_id:
             commit_range = head_commit_id + '..HEAD'
+        output = sh.git('rev-list', '--no-merges', commit_range,
+                        _tty_out=False)
+
+        branches_index = collections.OrderedDict(
+            (line.strip(), set([branch])) for line in output)
+        for commit in self._read_commits(branches_index):
+            yield commit
+
+    def _get_remote_heads(self):
+        heads = {}
+        output = sh.git('for-each-ref', '--format=%(objectname) %(refname)',
+                        'refs/remotes/origin', _tty_out=False)
+        for line in output:
+            commit_id, refname = line.strip().split(' ', 1)
+            if refname != 'refs/remotes/origin/HEAD':
+                heads[refname[len('refs/remotes/origin/'):]] = commit_id
+        return heads
+
+    def _get_branches_index(self, heads, head_commit_ids):
+        # commits reachable from every last processed id are known to all
+        # branches already, so the walk may stop at their merge base
+        last_ids = [c for c in head_commit_ids.values() if c]
+        bases = []
+        if last_ids and len(last_ids) == len(head_commit_ids):
+            if len(last_ids) == 1:
+                bases = last_ids
+            else:
+                bases = self._get_merge_bases(last_ids)
+
+        membership = collections.defaultdict(set)
+        processed = collections.defaultdict(set)
+        for branch, commit_id in six.iteritems(heads):
+            membership[commit_id].add(branch)
+        for branch, commit_id in six.iteritems(head_commit_ids):
+            if commit_id:
+                processed[commit_id].add(branch)
+
+        # topological order lists children before parents, so branch
+        # membership is complete by the time a commit is reached
+        branches_index = collections.OrderedDict()
+        for commit_id, parents in self._walk(list(heads.values()) + last_ids,
+                                             bases):
+            branches = membership.pop(commit_id, set())
+            seen = processed.pop(commit_id, set())
+            for parent in parents:
+                membership[parent] |= branches
+                processed[parent] |= seen
+            if len(parents) > 1:
+                continue  # merge commit
+            if branches - seen:
+                branches_index[commit_id] = branches
+        return branches_index
+
+    def _get_merge_bases(self, commit_ids):
+        return str(sh.git('merge-base', '--octopus', '--all',
+                          *commit_ids)).split()
+
+    def _walk(self, commit_ids, hidden_ids):
+        revisions = list(commit_ids) + ['^' + c for c in hidden_ids]
+        output = sh.git('rev-list', '--topo-order', '--parents', *revisions,
+                        _tty_out=False)
+        for line in output:
+            ids = line.split()
+            yield ids[0], ids[1:]
+
+    def log_all(self, head_commit_ids):
+        LOG.debug('Parsing git log of branches %(branches)s for repo uri '
+                  '%(uri)s', {'branches': list(head_commit_ids),
+                              'uri': self.repo['uri']})
+
+        os.chdir(self.folder)
+        heads = {}
+        remote_heads = self._get_remote_heads()
+        for branch in head_commit_ids:
+            if branch in remote_heads:
+                heads[branch] = remote_heads[branch]
+            else:
+                LOG.error('Unable to find branch %(branch)s in repo '
+                          '%(uri)s. Ignore it',
+                          {'branch': branch, 'uri': self.repo['uri']})
+        if not heads:
+            return
+
+        # a failed walk raises, the commits are not read and the caller
+        # must keep the last ids of the branches
+        head_commit_ids = dict((branch, head_commit_ids[branch])
+                               for branch in heads)
+        branches_index = self._get_branches_index(heads, head_commit_ids)
+
+        for commit in self._read_commits(branches_index):
+            yield commit
+
+    def _read_commits(self, branches_index):
+        # commits known to the cache are not read from git again, so only
+        # new commits go through the diff machinery
+        cached = self.commit_cache.get_many(branches_index)
+        missing = [commit_id for commit_id in branches_index
+                   if commit_id not in cached]
+        LOG.debug('Commits found in cache: %(cached)s, to read from git: '
+                  '%(missing)s', {'cached': len(cached),
+                                  'missing': len(missing)})
+
+        if missing:
+            parsed = list(self._read_log(missing))
+            self.commit_cache.set_many(parsed)
+            cached.update((c['commit_id'], c) for c in parsed)
+
+        # parents go before children, so once a commit is stored all
+        # commits reachable from it are, which makes it a valid last id
+        for commit_id in reversed(branches_index):
+            branches = branches_index[commit_id]
+            if commit_id not in cached:
+                continue
+            commit = self._make_commit(dict(cached[commit_id]), branches)
+            if commit:
+                yield commit
+
+    def _read_log(self, commit_ids):
         output = sh.git('log', '--pretty=%s' % GIT_LOG_FORMAT, '--shortstat',
-                        '-M', '--no-merges', commit_range, _tty_out=False,
+                        '-M', '--no-walk=unsorted', '--stdin',
+                        _in='\n'.join(commit_ids) + '\n', _tty_out=False,
                         _decode_errors='ignore')
+        return self._parse_log(output)
+
+    def _parse_log(self, output):
+        for record in str(output).split(GIT_LOG_RECORD_SEPARATOR):
+            for commit in self._parse_log_record(record):
+                yield commit
 
-        for rec in re.finditer(GIT_LOG_PATTERN, str(output)):
+    def _parse_log_record(self, record):
+        for rec in re.finditer(GIT_LOG_PATTERN, record):
             i = 1
             commit = {}
             for param in GIT_LOG_PARAMS:
                 commit[param[0]] = six.text_type(rec.group(i), 'utf8')
                 i += 1
 
-            if not utils.check_email_validity(commit['author_email']):
-                continue
-
             commit['files_changed'] = int(rec.group(i))
             i += 1
             lines_changed_group = rec.group(i)
@@ -208,41 +381,47 @@ class Git(Vcs):
 
             commit['lines_added'] = int(lines_changed or 0)
             commit['lines_deleted'] = int(lines_deleted or 0)
+            commit['date'] = int(commit['date'])
 
-            for pattern_name, pattern in six.iteritems(MESSAGE_PATTERNS):
-                collection = set()
-                for item in re.finditer(pattern, commit['message']):
-                    collection.add(item.group('id'))
-                if collection:
-                    commit[pattern_name] = list(collection)
+            yield commit
 
-            commit['date'] = int(commit['date'])
-            commit['module'] = self.repo['module']
-            commit['branches'] = set([branch])
-            if commit['commit_id'] in self.release_index:
-                commit['release'] = self.release_index[commit['commit_id']]
+    def _make_commit(self, commit, branches):
+        if not utils.check_email_validity(commit['author_email']):
+            return None
+
+        for pattern_name, pattern in six.iteritems(MESSAGE_PATTERNS):
+            collection = set()
+            for item in re.finditer(pattern, commit['message']):
+                collection.add(item.group('id'))
+            if collection:
+                commit[pattern_name] = list(collection)
+
+        commit['module'] = self.repo['module']
+        commit['branches'] = branches
+        if commit['commit_id'] in self.release_index:
+            commit['release'] = self.release_index[commit['commit_id']]
+        else:
+            commit['release'] = None
+
+        if 'blueprint_id' in commit:
+            commit['blueprint_id'] = [(commit['module'] + ':' + bp_name)
+                                      for bp_name
+                                      in commit['blueprint_id']]
+
+        if 'coauthor' in commit:
+            verified_coauthors = []
+            for coauthor in commit['coauthor']:
+                m = re.match(CO_AUTHOR_PATTERN, coauthor)
+                if m and utils.check_email_validity(
+                        m.group("author_email")):
+                    verified_coauthors.append(m.groupdict())
+
+            if verified_coauthors:
+                commit['coauthor'] = verified_coauthors
             else:
-                commit['release'] = None
-
-            if 'blueprint_id' in commit:
-                commit['blueprint_id'] = [(commit['module'] + ':' + bp_name)
-                                          for bp_name
-                                          in commit['blueprint_id']]
-
-            if 'coauthor' in commit:
-                verified_coauthors = []
-                for coauthor in commit['coauthor']:
-                    m = re.match(CO_AUTHOR_PATTERN, coauthor)
-                    if m and utils.check_email_validity(
-                            m.group("author_email")):
-                        verified_coauthors.append(m.groupdict())
-
-                if verified_coauthors:
-                    commit['coauthor'] = verified_coauthors
-                else:
-                    del commit['coauthor']  # no valid authors
+                del commit['coauthor']  # no valid authors
 
-            yield commit
+        return commit
 
     def get_last_id(self, branch):
         LOG.debug('Get head commit for repo uri: %s', self.repo['uri'])
@@ -252,12 +431,174 @@ class Git(Vcs):
             return None
         return str(sh.git('rev-parse', 'HEAD')).strip()
 
+    def is_ancestor(self, ancestor_id, commit_id):
+        os.chdir(self.folder)
+        try:
+            sh.git('merge-base', '--is-ancestor', ancestor_id, commit_id)
+            return True
+        except sh.ErrorReturnCode:
+            return False
+
+    def maintain(self, task):
+        if not os.path.exists(self.folder):
+            return False
+
+        LOG.debug('Run %(task)s for repo uri %(uri)s',
+                  {'task': task, 'uri': self.repo['uri']})
+        os.chdir(self.folder)
+        try:
+            sh.git(*MAINTENANCE_TASKS[task][1])
+            return True
+        except sh.ErrorReturnCode as e:
+            LOG.error('Unable to run %(task)s for git repo %(uri)s',
+                      {'task': task, 'uri': self.repo['uri']})
+            LOG.exception(e)
+            return False
+
+
+class LibGit2(Git):
+    """Git repository read in-process through libgit2.
+
+    Clone and fetch still go through the git command line, everything else
+    (refs, commit walk and diff stats) is read directly from the object
+    database.
+    """
+
+    def __init__(self, repo, sources_root):
+        super(LibGit2, self).__init__(repo, sources_root)
+        self.repository = None
+
+    def _get_repository(self):
+        if not self.repository:
+            self.repository = pygit2.Repository(self.folder)
+        return self.repository
+
+    def fetch(self):
+        self.repository = None
+        super(LibGit2, self).fetch()
+
+    def _resolve(self, revision):
+        return self._get_repository().revparse_single(revision).peel(
+            pygit2.Commit).hex
+
+    def get_release_index(self):
+        if not os.path.exists(self.folder):
+            return {}
+
+        LOG.debug('Get release index for repo uri: %s', self.repo['uri'])
+        if not self.release_index:
+            for release in self.repo.get('releases', []):
+                release_name = release['release_name'].lower()
+
+                try:
+                    tag_to = self._resolve(release['tag_to'])
+                    hidden = []
+                    if 'tag_from' in release:
+                        hidden.append(self._resolve(release['tag_from']))
+                except (KeyError, ValueError) as e:
+                    LOG.error('Unable to resolve tags of release %(release)s '
+                              'in repo %(uri)s. Ignore it',
+                              {'release': release_name,
+                               'uri': self.repo['uri']})
+                    LOG.exception(e)
+                    continue
+
+                for commit_id, parents in self._walk([tag_to], hidden):
+                    self.release_index[commit_id] = release_name
+        return self.release_index
+
+    def log(self, branch, head_commit_id):
+        return self.log_all({branch: head_commit_id})
+
+    def _get_remote_heads(self):
+        repository = self._get_repository()
+        prefix = 'refs/remotes/origin/'
+        heads = {}
+        for refname in repository.listall_references():
+            if refname.startswith(prefix) and refname != prefix + 'HEAD':
+                heads[refname[len(prefix):]] = self._resolve(refname)
+        return heads
+
+    def _get_merge_bases(self, commit_ids):
+        repository = self._get_repository()
+        base = pygit2.Oid(hex=commit_ids[0])
+        for commit_id in commit_ids[1:]:
+            base = repository.merge_base(base, pygit2.Oid(hex=commit_id))
+            if not base:
+                return []
+        return [base.hex]
+
+    def is_ancestor(self, ancestor_id, commit_id):
+        if ancestor_id == commit_id:
+            return True
+        try:
+            return self._get_repository().descendant_of(
+                pygit2.Oid(hex=commit_id), pygit2.Oid(hex=ancestor_id))
+        except (KeyError, ValueError):
+            return False
+
+    def _walk(self, commit_ids, hidden_ids):
+        repository = self._get_repository()
+        walker = repository.walk(None, pygit2.GIT_SORT_TOPOLOGICAL)
+        for commit_id in commit_ids:
+            walker.push(pygit2.Oid(hex=commit_id))
+        for commit_id in hidden_ids:
+            walker.hide(pygit2.Oid(hex=commit_id))
+        for commit in walker:
+            yield commit.hex, [p.hex for p in commit.parent_ids]
+
+    def _read_log(self, commit_ids):
+        repository = self._get_repository()
+        for commit_id in commit_ids:
+            commit = repository[pygit2.Oid(hex=commit_id)]
+
+            if commit.parents:
+                diff = repository.diff(commit.parents[0], commit)
+            else:
+                diff = commit.tree.diff_to_tree(swap=True)
+            diff.find_similar()
+            stats = diff.stats
+            if not stats.files_changed:
+                # git log prints no diff stat for it, such commits are
+                # skipped there
+                continue
+
+            paragraphs = commit.message.strip().split('\n\n', 1)
+            subject = ' '.join(paragraphs[0].split('\n'))
+            message = paragraphs[1] + '\n' if len(paragraphs) > 1 else ''
+
+            yield {
+                'commit_id': six.text_type(commit.hex),
+                'date': commit.author.time,
+                'author_name': six.text_type(commit.author.name),
+                'author_email': six.text_type(commit.author.email),
+                'subject': six.text_type(subject),
+                'message': six.text_type(message),
+                'files_changed': stats.files_changed,
+                'lines_added': stats.insertions,
+                'lines_deleted': stats.deletions,
+            }
+
+    def get_last_id(self, branch):
+        LOG.debug('Get head commit for repo uri: %s', self.repo['uri'])
+
+        try:
+            return self._resolve('refs/remotes/origin/' + branch)
+        except (KeyError, ValueError):
+            LOG.error('Unable to find branch %(branch)s in repo %(uri)s',
+                      {'branch': branch, 'uri': self.repo['uri']})
+            return None
+
 
-def get_vcs(repo, sources_root):
+def get_vcs(repo, sources_root, backend='git'):
     uri = repo['uri']
     LOG.debug('Factory is asked for VCS uri: %s', uri)
     match = re.search(r'\.git$', uri)
     if match:
+        if backend == 'libgit2':
+            if pygit2:
+                return LibGit2(repo, sources_root)
+            LOG.warning('pygit2 is not available, fallback to git')
         return Git(repo, sources_root)
     else:
         LOG.warning('Unsupported VCS, fallback to dummy')
@@ -0,0 +1,73 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import fixtures
+import testtools
+
+from spectrometer.processor import commit_cache
+
+
+class TestCommitCache(testtools.TestCase):
+    def setUp(self):
+        super(TestCommitCache, self).setUp()
+        self.sources_root = self.useFixture(fixtures.TempDir()).path
+
+    def test_get_many_returns_stored(self):
+        cache = commit_cache.CommitCache(self.sources_root)
+        cache.set_many([
+            {'commit_id': 'aaa', 'date': 1369119386, 'lines_added': 3},
+            {'commit_id': 'bbb', 'date': 1369119387, 'lines_added': 5},
+        ])
+        cache.close()
+
+        cache = commit_cache.CommitCache(self.sources_root)
+        result = cache.get_many(['aaa', 'ccc'])
+
+        self.assertEqual(['aaa'], list(result))
+        self.assertEqual(3, result['aaa']['lines_added'])
+
+    def test_get_many_in_chunks(self):
+        cache = commit_cache.CommitCache(self.sources_root)
+        commit_ids = ['%040x' % i
+                      for i in range(commit_cache.BULK_READ_SIZE * 2 + 1)]
+        cache.set_many([{'commit_id': c} for c in commit_ids])
+
+        self.assertEqual(set(commit_ids), set(cache.get_many(commit_ids)))
+
+    def test_concurrent_writers(self):
+        cache = commit_cache.CommitCache(self.sources_root)
+        errors = []
+
+        def write(n):
+            try:
+                for i in range(20):
+                    cache.set_many([{'commit_id': '%d-%d' % (n, i)}])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache.close()
+
+        self.assertEqual([], errors)
+        cache = commit_cache.CommitCache(self.sources_root)
+        self.assertEqual(80, len(cache.get_many(
+            '%d-%d' % (n, i) for n in range(4) for i in range(20))))
@@ -89,3 +89,116 @@ class TestDefaultDataProcessor(testtools.TestCase):
                            'module_group_name': 'stackforge',
                            'modules': ['tux'],
                            'tag': 'organization'}, dd['module_groups'])
+
+    def _make_changed_data(self):
+        data = copy.deepcopy(test_data.DEFAULT_DATA)
+        data['users'][1]['emails'].append('ivan@mirantis.ru')
+        data['companies'][1]['domains'].append('nec.de')
+        return data
+
+    def test_get_default_data_changes(self):
+        old_data = copy.deepcopy(test_data.DEFAULT_DATA)
+        new_data = self._make_changed_data()
+        new_data['mail_lists'] = ['http://lists/']
+
+        changes = default_data_processor._get_default_data_changes(
+            old_data, new_data)
+
+        self.assertEqual(set(['users', 'companies', 'mail_lists']),
+                         set(changes))
+        self.assertEqual(([old_data['users'][1]], [new_data['users'][1]]),
+                         changes['users'])
+        self.assertEqual(([old_data['companies'][1]],
+                          [new_data['companies'][1]]), changes['companies'])
+        self.assertTrue(changes['mail_lists'])
+
+    def _make_storage(self, applied_data):
+        storage = {}
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+        runtime_storage_inst.set_by_key.side_effect = storage.__setitem__
+        if applied_data:
+            default_data_processor._store_applied_data(runtime_storage_inst,
+                                                       applied_data)
+        return runtime_storage_inst, storage
+
+    def _patch_store_users(self):
+        store_users = mock.Mock()
+        patcher = mock.patch.dict(default_data_processor.STORE_FUNCS,
+                                  {'users': store_users})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return store_users
+
+    @mock.patch('spectrometer.processor.default_data_processor.'
+                '_update_members_company_name')
+    @mock.patch('spectrometer.processor.default_data_processor.'
+                '_update_records')
+    @mock.patch('spectrometer.processor.record_processor.RecordProcessor')
+    def test_process_targeted_update(self, record_processor_cls,
+                                     update_records, update_members):
+        store_users = self._patch_store_users()
+        runtime_storage_inst, storage = self._make_storage(
+            copy.deepcopy(test_data.DEFAULT_DATA))
+        default_data = self._make_changed_data()
+        applied_data = copy.deepcopy(default_data)
+
+        self.assertTrue(default_data_processor.process(
+            runtime_storage_inst, default_data, '/tmp', False))
+
+        self.assertFalse(update_records.called)
+        # only the changed user is stored
+        self.assertEqual(['ivan_ivanov'], [
+            user['user_id'] for user in store_users.call_args[0][1]])
+        record_processor_inst = record_processor_cls.return_value
+        record_processor_inst.update_user_info.assert_called_once_with(
+            set(['ivan_ivanov']),
+            set(['ivanivan@yandex.ru', 'iivanov@mirantis.com',
+                 'ivan@mirantis.ru']),
+            set(['nec.com', 'nec.co.jp', 'nec.de']))
+        self.assertFalse(record_processor_inst.update_releases.called)
+        update_members.assert_called_once_with(runtime_storage_inst)
+        self.assertEqual(applied_data, default_data_processor.
+                         _get_applied_data(runtime_storage_inst))
+
+    @mock.patch('spectrometer.processor.default_data_processor.'
+                '_update_members_company_name')
+    @mock.patch('spectrometer.processor.default_data_processor.'
+                '_update_records')
+    def test_process_full_update_first_time(self, update_records,
+                                            update_members):
+        store_users = self._patch_store_users()
+        runtime_storage_inst, storage = self._make_storage(None)
+
+        self.assertTrue(default_data_processor.process(
+            runtime_storage_inst, copy.deepcopy(test_data.DEFAULT_DATA),
+            '/tmp', False))
+
+        self.assertEqual(2, len(store_users.call_args[0][1]))
+        update_records.assert_called_once_with(runtime_storage_inst, '/tmp')
+        self.assertEqual(test_data.DEFAULT_DATA, default_data_processor.
+                         _get_applied_data(runtime_storage_inst))
+        self.assertEqual(sorted(test_data.DEFAULT_DATA),
+                         storage['default_data'])
+
+        # the same data is not processed again
+        self.assertFalse(default_data_processor.process(
+            runtime_storage_inst, copy.deepcopy(test_data.DEFAULT_DATA),
+            '/tmp', False))
+
+    def test_store_applied_data_failed(self):
+        runtime_storage_inst, storage = self._make_storage(
+            copy.deepcopy(test_data.DEFAULT_DATA))
+
+        def set_by_key(key, value):
+            if key == 'default_data:users':
+                raise Exception('Memcached set failed')
+            storage[key] = value
+
+        runtime_storage_inst.set_by_key.side_effect = set_by_key
+        default_data_processor._store_applied_data(
+            runtime_storage_inst, self._make_changed_data())
+
+        # data stored in part is not diffed with, all records are updated
+        self.assertIsNone(default_data_processor._get_applied_data(
+            runtime_storage_inst))
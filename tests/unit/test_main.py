@@ -14,10 +14,14 @@
 # limitations under the License.
 
 import os
+import time
 
+import mock
 import testtools
 
 from spectrometer.processor import main
+from spectrometer.processor import pipeline
+from spectrometer.processor import record_processor
 
 
 class TestMain(testtools.TestCase):
@@ -36,3 +40,368 @@ class TestMain(testtools.TestCase):
         self.assertIn('controller', bootstrap['hydrogen'])
         self.assertIn('controller', core['helium'])
         self.assertIn('foo', incubation['helium'])
+
+    def test_is_repo_changed(self):
+        vcs_inst = mock.Mock()
+        vcs_inst.ls_remote.return_value = {'master': 'a', 'stable/h': 'b'}
+
+        self.assertFalse(main._is_repo_changed(
+            vcs_inst, {'master': 'a', 'stable/h': 'b'}))
+        self.assertTrue(main._is_repo_changed(
+            vcs_inst, {'master': 'c', 'stable/h': 'b'}))
+        self.assertTrue(main._is_repo_changed(
+            vcs_inst, {'master': 'a', 'stable/i': 'b'}))
+
+    def test_is_repo_changed_probe_failed(self):
+        vcs_inst = mock.Mock()
+        vcs_inst.ls_remote.return_value = None
+
+        self.assertTrue(main._is_repo_changed(vcs_inst, {'master': 'a'}))
+
+    @mock.patch('spectrometer.processor.main.cfg')
+    @mock.patch('spectrometer.processor.vcs.get_vcs')
+    def test_maintain_repos_oldest_first(self, get_vcs, cfg):
+        state = {
+            'maintenance:git%3A%2F%2Fa.git': {
+                'commit-graph': 100, 'repack': 100, 'prune': 100},
+            'maintenance:git%3A%2F%2Fb.git': {
+                'commit-graph': 50, 'repack': 200, 'prune': 200},
+        }
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = (
+            lambda key: state.get(key) if key != 'repos' else
+            [{'uri': 'git://a.git'}, {'uri': 'git://b.git'}])
+        now = [1000000]
+
+        def maintain(task):
+            # every task takes the whole budget
+            now[0] += 10
+            return True
+
+        vcs_inst = get_vcs.return_value
+        vcs_inst.maintain.side_effect = maintain
+
+        with mock.patch('spectrometer.processor.main.time') as time_mock:
+            time_mock.time.side_effect = lambda: now[0]
+            main.maintain_repos(runtime_storage_inst, 10)
+
+        vcs_inst.maintain.assert_called_once_with('commit-graph')
+        self.assertEqual(get_vcs.call_args[0][0], {'uri': 'git://b.git'})
+        runtime_storage_inst.set_by_key.assert_called_once_with(
+            'maintenance:git%3A%2F%2Fb.git',
+            {'commit-graph': 1000010, 'repack': 200, 'prune': 200})
+
+    @mock.patch('spectrometer.processor.main.cfg')
+    @mock.patch('spectrometer.processor.vcs.get_vcs')
+    def test_process_repo_checkpoints_go_forward(self, get_vcs, cfg):
+        cfg.CONF.checkpoint_interval = 1
+        cfg.CONF.pipeline_queue_size = 0
+        master_key = 'vcs:git%3A%2F%2Fa.git:master'
+        stable_key = 'vcs:git%3A%2F%2Fa.git:stable/h'
+        saved = []
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = {master_key: 'm2'}.get
+        runtime_storage_inst.set_by_key.side_effect = (
+            lambda key, value: saved.append((key, value)))
+        runtime_storage_inst.set_records.side_effect = (
+            lambda records, merge_handler: list(records))
+        record_processor_inst = mock.Mock()
+        record_processor_inst.process.side_effect = lambda items: items
+
+        # m1 is known to master already and new to the added stable/h
+        ancestors = {'m1': ['m1'], 's1': ['m1', 's1'], 'm3': ['m1', 'm2']}
+        vcs_inst = get_vcs.return_value
+        vcs_inst.ls_remote.return_value = None
+        vcs_inst.log_all.return_value = iter([
+            {'commit_id': 'm1', 'branches': set(['master', 'stable/h'])},
+            {'commit_id': 's1', 'branches': set(['stable/h'])},
+            {'commit_id': 'm3', 'branches': set(['master'])}])
+        vcs_inst.is_ancestor.side_effect = (
+            lambda ancestor_id, commit_id: ancestor_id in ancestors[commit_id])
+        vcs_inst.get_last_id.side_effect = {'master': 'm3',
+                                            'stable/h': 's1'}.get
+
+        main.process_repo({'uri': 'git://a.git', 'module': 'a',
+                           'releases': [{'branch': 'stable/h'}]},
+                          runtime_storage_inst, record_processor_inst)
+
+        self.assertEqual([(stable_key, 'm1'), (stable_key, 's1'),
+                          (master_key, 'm3')], saved[:3])
+        self.assertEqual(set([(stable_key, 's1'), (master_key, 'm3')]),
+                         set(saved[3:]))
+
+    @mock.patch('spectrometer.processor.main.cfg')
+    @mock.patch('spectrometer.processor.vcs.get_vcs')
+    def test_process_repo_failed_log_keeps_last_ids(self, get_vcs, cfg):
+        cfg.CONF.checkpoint_interval = 1
+        cfg.CONF.pipeline_queue_size = 0
+        saved = []
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.return_value = None
+        runtime_storage_inst.set_by_key.side_effect = (
+            lambda key, value: saved.append((key, value)))
+        runtime_storage_inst.set_records.side_effect = (
+            lambda records, merge_handler: list(records))
+        record_processor_inst = mock.Mock()
+        record_processor_inst.process.side_effect = lambda items: items
+
+        def log_all(last_ids):
+            yield {'commit_id': 'm1', 'branches': set(['master'])}
+            raise IOError('rev-list failed')
+
+        vcs_inst = get_vcs.return_value
+        vcs_inst.ls_remote.return_value = None
+        vcs_inst.log_all.side_effect = log_all
+        vcs_inst.get_last_id.return_value = 'm2'
+
+        main.process_repo({'uri': 'git://a.git', 'module': 'a',
+                           'releases': []},
+                          runtime_storage_inst, record_processor_inst)
+
+        # only the commit stored before the failure is taken as seen
+        self.assertEqual([('vcs:git%3A%2F%2Fa.git:master', 'm1')], saved)
+        self.assertFalse(vcs_inst.get_last_id.called)
+
+    def _make_daemon(self):
+        runtime_storage_inst = mock.Mock()
+        storage = {'releases': [], 'repos': [],
+                   record_processor.CORE_CONTRIBUTORS_DATE_KEY:
+                   int(time.time())}
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+        runtime_storage_inst.set_by_key.side_effect = storage.__setitem__
+        return main.Daemon(runtime_storage_inst)
+
+    @mock.patch('spectrometer.processor.main.update_pids')
+    @mock.patch('spectrometer.processor.main.process_mail_lists')
+    @mock.patch('spectrometer.processor.main.process_reviews')
+    @mock.patch('spectrometer.processor.main.process_repo')
+    @mock.patch('spectrometer.processor.record_processor.RecordProcessor.'
+                'update')
+    def test_daemon_idle_poll_no_update(self, update, process_repo,
+                                        process_reviews, *args):
+        daemon = self._make_daemon()
+        process_repo.side_effect = AssertionError('no repos')
+
+        daemon.update_repos()
+        daemon.update_reviews()
+        daemon.update_mail_lists()
+        daemon.update_records()
+        self.assertFalse(update.called)
+
+        # a source that processed records triggers the update
+        def process(repos, runtime_storage_inst, record_processor_inst):
+            record_processor_inst.records_processed = True
+
+        process_reviews.side_effect = process
+        daemon.update_reviews()
+        daemon.update_records()
+        update.assert_called_once_with()
+
+    @mock.patch('spectrometer.processor.main.update_pids')
+    @mock.patch('spectrometer.processor.main.load_default_data')
+    @mock.patch('spectrometer.processor.record_processor.RecordProcessor.'
+                'update')
+    def test_daemon_default_data_no_full_update(self, update,
+                                                load_default_data, *args):
+        load_default_data.return_value = True
+        daemon = self._make_daemon()
+
+        daemon.update_default_data()
+        daemon.update_records()
+        self.assertFalse(update.called)
+
+        # records processed before the reload are still to be updated
+        daemon.record_processor_inst.records_processed = True
+        daemon.update_default_data()
+        daemon.update_records()
+        update.assert_called_once_with()
+
+    @mock.patch('spectrometer.processor.main.update_pids')
+    @mock.patch('spectrometer.processor.record_processor.RecordProcessor.'
+                'update_core_contributors')
+    @mock.patch('spectrometer.processor.record_processor.RecordProcessor.'
+                'update')
+    def test_daemon_daily_core_contributors_update(
+            self, update, update_core_contributors, *args):
+        daemon = self._make_daemon()
+
+        daemon.update_records()
+        self.assertFalse(update_core_contributors.called)
+
+        # a day later core contributors are refreshed without new records
+        day_later = (time.time() +
+                     record_processor.CORE_CONTRIBUTORS_UPDATE_INTERVAL)
+        with mock.patch('time.time', return_value=day_later):
+            daemon.update_records()
+        update_core_contributors.assert_called_once_with()
+        self.assertFalse(update.called)
+
+    @mock.patch('spectrometer.processor.main.process_mail_lists')
+    @mock.patch('spectrometer.processor.main.process_reviews')
+    @mock.patch('spectrometer.processor.main.process_repo')
+    @mock.patch('spectrometer.processor.utils.load_repos')
+    def test_update_records_without_new_records(self, *args):
+        record_processor_inst = mock.Mock()
+        record_processor_inst.is_update_needed.return_value = False
+        record_processor_inst.is_core_update_needed.return_value = False
+
+        main.update_records(mock.Mock(), record_processor_inst)
+
+        self.assertFalse(record_processor_inst.update.called)
+        self.assertFalse(record_processor_inst.update_core_contributors.called)
+
+    def test_maintain_repos_disabled(self):
+        runtime_storage_inst = mock.Mock()
+        main.maintain_repos(runtime_storage_inst, 0)
+        self.assertFalse(runtime_storage_inst.get_by_key.called)
+
+    def test_store_last_review_ids(self):
+        runtime_storage_inst = mock.Mock()
+        stored = []
+        runtime_storage_inst.set_by_key.side_effect = (
+            lambda key, value: stored.append(key))
+        poll_iterator = iter([('review', 'rcs:a', {'id': 1}),
+                              ('review', 'rcs:b', {'id': 2}),
+                              ('done', 'rcs:a', 10),
+                              ('review', 'rcs:b', {'id': 3}),
+                              ('done', 'rcs:b', 20)])
+
+        consumed = []
+        for review in pipeline.apply_checkpoints(main._store_last_review_ids(
+                poll_iterator, runtime_storage_inst)):
+            consumed.append((review['id'], list(stored)))
+
+        self.assertEqual([(1, []), (2, []), (3, ['rcs:a'])], consumed)
+        runtime_storage_inst.set_by_key.assert_called_with('rcs:b', 20)
+
+    def test_get_project_review_task(self):
+        repo = {'uri': 'git://git.opendaylight.org/controller.git',
+                'releases': [{'branch': 'stable/helium'}, {}]}
+        storage = {'rcs:git%3A%2F%2Fgit.opendaylight.org%2Fcontroller.git':
+                   1390559536}
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+
+        tasks = main._get_project_review_tasks(repo, 'rcs',
+                                               runtime_storage_inst)
+
+        self.assertEqual(
+            [('rcs:git%3A%2F%2Fgit.opendaylight.org%2Fcontroller.git', 'rcs',
+              ['master', 'stable/helium'], 1390559536)], tasks)
+
+    def test_get_project_review_task_from_branch_last_ids(self):
+        repo = {'uri': 'git://git.opendaylight.org/controller.git',
+                'releases': [{'branch': 'stable/helium'}]}
+        prefix = 'rcs:git%3A%2F%2Fgit.opendaylight.org%2Fcontroller.git'
+        storage = {prefix + ':master': 1390559536,
+                   prefix + ':stable/helium': 1390550000}
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+
+        tasks = main._get_project_review_tasks(repo, 'rcs',
+                                               runtime_storage_inst)
+        self.assertEqual(1390550000, tasks[0][3])
+
+        del storage[prefix + ':master']
+        tasks = main._get_project_review_tasks(repo, 'rcs',
+                                               runtime_storage_inst)
+        self.assertIsNone(tasks[0][3])
+
+    def test_get_project_review_tasks_added_branch(self):
+        repo = {'uri': 'git://git.opendaylight.org/controller.git',
+                'releases': [{'branch': 'stable/helium'}]}
+        prefix = 'rcs:git%3A%2F%2Fgit.opendaylight.org%2Fcontroller.git'
+        storage = {prefix: 1390559536,
+                   'tracked_branches:' + prefix: ['master']}
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+        runtime_storage_inst.set_by_key.side_effect = storage.__setitem__
+
+        # the added branch is polled from scratch on its own
+        tasks = main._get_project_review_tasks(repo, 'rcs',
+                                               runtime_storage_inst)
+        self.assertEqual([
+            (prefix + ':stable/helium', 'rcs', 'stable/helium', None),
+            (prefix, 'rcs', ['master'], 1390559536)], tasks)
+
+        poll_iterator = iter([('done', prefix + ':stable/helium', 1390550000),
+                              ('done', prefix, 1390560000)])
+        list(pipeline.apply_checkpoints(main._store_last_review_ids(
+            poll_iterator, runtime_storage_inst,
+            branch_sets={prefix: ['master']})))
+
+        # and joins the project query once it has a last id
+        tasks = main._get_project_review_tasks(repo, 'rcs',
+                                               runtime_storage_inst)
+        self.assertEqual([(prefix, 'rcs', ['master', 'stable/helium'],
+                           1390550000)], tasks)
+
+        list(pipeline.apply_checkpoints(main._store_last_review_ids(
+            iter([('done', prefix, 1390570000)]), runtime_storage_inst,
+            branch_sets={prefix: ['master', 'stable/helium']})))
+        self.assertEqual(['master', 'stable/helium'],
+                         storage['tracked_branches:' + prefix])
+        tasks = main._get_project_review_tasks(repo, 'rcs',
+                                               runtime_storage_inst)
+        self.assertEqual([(prefix, 'rcs', ['master', 'stable/helium'],
+                           1390570000)], tasks)
+
+    def test_store_last_review_ids_checkpoints(self):
+        storage = {}
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.set_by_key.side_effect = storage.__setitem__
+        runtime_storage_inst.delete_by_key.side_effect = storage.pop
+        reviews = [{'id': i, 'lastUpdated': 100 - i} for i in range(5)]
+        checkpoints = {'rcs:a': {'last_id': 50}}
+
+        iterator = pipeline.apply_checkpoints(main._store_last_review_ids(
+            iter([('review', 'rcs:a', r) for r in reviews] +
+                 [('done', 'rcs:a', 100)]),
+            runtime_storage_inst, checkpoints, 2))
+
+        # interrupted after the fourth review is stored
+        for i in range(5):
+            next(iterator)
+        self.assertEqual({'last_id': 50, 'newest': 100, 'until': 97},
+                         storage['checkpoint:rcs:a'])
+        self.assertNotIn('rcs:a', storage)
+
+        self.assertEqual([], list(iterator))
+        self.assertEqual({'rcs:a': 100}, storage)
+
+    def test_resume_review_tasks(self):
+        storage = {
+            'checkpoint:rcs:a': {'last_id': 50, 'newest': 100, 'until': 97},
+            'checkpoint:rcs:b': {'last_id': 10, 'newest': 30, 'until': 20},
+        }
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+
+        tasks, checkpoints = main._resume_review_tasks(
+            [('rcs:a', 'rcs', 'master', 50), ('rcs:b', 'rcs', 'master', 25)],
+            runtime_storage_inst)
+
+        # the checkpoint of rcs:b is older than its last id
+        self.assertEqual([('rcs:a', 'rcs', 'master', 50, 97),
+                          ('rcs:b', 'rcs', 'master', 25, None)], tasks)
+        self.assertEqual({'last_id': 25}, checkpoints['rcs:b'])
+
+        # resumed poll keeps the newest review of the interrupted one
+        poll_iterator = iter([('review', 'rcs:a', {'lastUpdated': 96}),
+                              ('done', 'rcs:a', 96)])
+        list(pipeline.apply_checkpoints(main._store_last_review_ids(
+            poll_iterator, runtime_storage_inst, checkpoints, 1)))
+        runtime_storage_inst.set_by_key.assert_called_with('rcs:a', 100)
+        runtime_storage_inst.delete_by_key.assert_called_once_with(
+            'checkpoint:rcs:a')
+
+    def test_checkpoint(self):
+        saved = []
+        consumed = []
+        for record in pipeline.apply_checkpoints(
+                main._checkpoint(iter(range(5)), saved.append, 2)):
+            consumed.append((record, list(saved)))
+
+        # a record is saved once the next one is asked for
+        self.assertEqual([(0, []), (1, []), (2, [1]), (3, [1]),
+                          (4, [1, 3])], consumed)
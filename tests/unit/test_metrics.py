@@ -0,0 +1,94 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import fixtures
+import mock
+import testtools
+
+from spectrometer.processor import metrics
+
+
+class TestMetrics(testtools.TestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.now = [1000.0]
+        patcher = mock.patch('time.time', lambda: self.now[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.metrics = metrics.Metrics()
+
+    def _parse(self, items):
+        for item in items:
+            self.now[0] += 1
+            yield item
+
+    def _process(self, records):
+        for record in records:
+            self.now[0] += 2
+            yield record
+
+    def test_nested_stages_exclusive_time(self):
+        parsed = self.metrics.time_iterator(
+            'git_log', self._parse(['a', 'b', 'c']), 'nova')
+        processed = self.metrics.time_iterator(
+            'process', self._process(parsed), 'nova')
+
+        self.assertEqual(['a', 'b', 'c'], list(processed))
+
+        summary = self.metrics.get_summary()
+        self.assertEqual({'time': 3, 'calls': 4, 'records': 3},
+                         summary['stages']['git_log'])
+        self.assertEqual({'time': 6, 'calls': 4, 'records': 3},
+                         summary['stages']['process'])
+        self.assertEqual(summary['stages'], summary['sources']['nova'])
+        self.assertEqual(9, summary['time'])
+
+    def test_timer_without_source(self):
+        with self.metrics.timer('storage'):
+            self.now[0] += 5
+        self.metrics.add('storage', 'bytes_read', 100)
+
+        summary = self.metrics.get_summary()
+        self.assertEqual({'time': 5, 'calls': 1, 'bytes_read': 100},
+                         summary['stages']['storage'])
+        self.assertEqual({}, summary['sources'])
+
+    def test_store_summary(self):
+        file_name = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'metrics.json')
+        storage = {}
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+        runtime_storage_inst.set_by_key.side_effect = storage.__setitem__
+
+        for i in range(metrics.METRICS_HISTORY_SIZE + 1):
+            self.metrics.add('process', 'records', 1, 'nova')
+            metrics.store_summary(self.metrics.get_summary(),
+                                  runtime_storage_inst, file_name)
+
+        last = storage[metrics.METRICS_KEY]
+        self.assertEqual({'nova': {'process': {'records': i + 1}}},
+                         last['sources'])
+        history = storage[metrics.METRICS_HISTORY_KEY]
+        self.assertEqual(metrics.METRICS_HISTORY_SIZE, len(history))
+        self.assertNotIn('sources', history[-1])
+
+        with open(file_name) as fd:
+            lines = fd.readlines()
+        self.assertEqual(metrics.METRICS_HISTORY_SIZE + 1, len(lines))
+        self.assertEqual(last, json.loads(lines[-1]))
@@ -13,18 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import re
+import gzip
+import threading
+import time
 
+import mock
+import six
 import testtools
 
 from spectrometer.processor import mls
+from spectrometer.processor import pipeline
 
 
 class TestMls(testtools.TestCase):
     def setUp(self):
         super(TestMls, self).setUp()
 
-    def test_mail_parse_regex(self):
+    def test_parse_mbox(self):
 
         content = '''
 URL: <http://lists.openstack.org/pipermail/openstack-dev/>
@@ -45,15 +50,174 @@ test works :)
 From sorlando at nicira.com  Tue Jul 17 07:30:43 2012
 From: sorlando at nicira.com (Salvatore Orlando)
             '''
-        match = re.search(mls.MAIL_BOX_PATTERN, content)
-        self.assertTrue(match)
-        self.assertEqual('sorlando at nicira.com', match.group(1))
-        self.assertEqual('Salvatore Orlando', match.group(2))
-        self.assertEqual('Tue, 17 Jul 2012 00:30:43 -0700', match.group(3))
+        # the incomplete trailing mail is skipped
+        mails = list(mls._parse_mbox(six.StringIO(content)))
+        self.assertEqual(1, len(mails))
+        mail = mails[0]
+        self.assertEqual('sorlando at nicira.com', mail['author_email'])
+        self.assertEqual('Salvatore Orlando', mail['author_name'])
+        self.assertEqual('Tue, 17 Jul 2012 00:30:43 -0700', mail['date'])
         self.assertEqual('[openstack-dev] [nova] [pci device passthrough] '
                          'fails with\n "NameError: global name \'_\' is not '
-                         'defined"', match.group(4))
+                         'defined"', mail['subject'])
         self.assertEqual('<CAGR=i3htLvDOdh5u6mxqmo0zVP1eKKYAxAhj='
-                         'e1-rpQWZOiF6Q@gmail.com>', match.group(5))
+                         'e1-rpQWZOiF6Q@gmail.com>', mail['message_id'])
         self.assertEqual('Good morning Gary!\n\ntest works :)\n',
-                         match.group(6))
+                         mail['body'])
+
+    def test_retrieve_mails_gzipped(self):
+        mbox = ''.join(
+            'From jdoe at example.com  Tue Jul 17 07:3%(n)s:43 2012\n'
+            'From: jdoe at example.com (John Doe)\n'
+            'Date: Tue, 17 Jul 2012 00:3%(n)s:43 -0700\n'
+            'Subject: [dev] Mail %(n)s\n'
+            'Message-ID: <%(n)s@example.com>\n'
+            '\n'
+            'See https://bugs.launchpad.net/bugs/12%(n)s\n'
+            '\n' % {'n': n} for n in range(3))
+        fd = six.StringIO()
+        gzip_fd = gzip.GzipFile(fileobj=fd, mode='w')
+        gzip_fd.write(mbox)
+        gzip_fd.close()
+
+        mails = list(mls._retrieve_mails('http://lists/2012-July.txt.gz',
+                                         fd.getvalue()))
+
+        self.assertEqual(['<0@example.com>', '<1@example.com>',
+                          '<2@example.com>'],
+                         [m['message_id'] for m in mails])
+        self.assertEqual('jdoe@example.com', mails[2]['author_email'])
+        self.assertEqual(1342510363, mails[2]['date'])
+        self.assertEqual(['122'], mails[2]['bug_id'])
+        self.assertEqual('See https://bugs.launchpad.net/bugs/122\n',
+                         mails[2]['body'])
+
+    def test_parse_mbox_skips_known(self):
+        mbox = ''.join(
+            'From jdoe at example.com  Tue Jul 17 07:3%(n)s:43 2012\n'
+            'From: jdoe at example.com (John Doe)\n'
+            'Date: Tue, 17 Jul 2012 00:3%(n)s:43 -0700\n'
+            'Subject: [dev] Mail %(n)s\n'
+            'Message-ID: <%(n)s@example.com>\n'
+            '\n'
+            'Body %(n)s\n'
+            '\n' % {'n': n} for n in range(3))
+        known = set(['<0@example.com>', '<2@example.com>'])
+
+        mails = list(mls._parse_mbox(six.StringIO(mbox), known.__contains__))
+
+        self.assertEqual([('<1@example.com>', 'Body 1\n')],
+                         [(m['message_id'], m['body']) for m in mails])
+
+    @mock.patch('spectrometer.processor.utils.HTTP_CONNECTION_POOL')
+    def test_read_archive_not_modified(self, pool):
+        pool.request.return_value = (304, {}, '')
+        state = {'etag': '"abc"', 'last_modified': 'Tue, 17 Jul 2012',
+                 'length': 100}
+
+        content, new_state = mls._read_archive(
+            'http://lists/2012-July.txt.gz', state)
+
+        self.assertIsNone(content)
+        self.assertEqual(state, new_state)
+        pool.request.assert_called_once_with(
+            'http://lists/2012-July.txt.gz',
+            headers={'If-None-Match': '"abc"',
+                     'If-Modified-Since': 'Tue, 17 Jul 2012'})
+
+    @mock.patch('spectrometer.processor.utils.HTTP_CONNECTION_POOL')
+    def test_read_archive_appended_part(self, pool):
+        pool.request.return_value = (
+            206, {'etag': '"def"', 'content-range': 'bytes 100-108/109'},
+            'From x\nyz')
+
+        content, new_state = mls._read_archive(
+            'http://lists/2012-July.txt', {'etag': '"abc"', 'length': 100})
+
+        self.assertEqual('From x\nyz', content)
+        self.assertEqual({'etag': '"def"', 'last_modified': None,
+                          'length': 109}, new_state)
+        self.assertEqual('bytes=100-',
+                         pool.request.call_args[1]['headers']['Range'])
+
+    @mock.patch('spectrometer.processor.utils.HTTP_CONNECTION_POOL')
+    def test_read_archive_rewritten(self, pool):
+        pool.request.side_effect = [(416, {}, ''),
+                                    (200, {'etag': '"def"'}, 'From x')]
+
+        content, new_state = mls._read_archive(
+            'http://lists/2012-July.txt', {'etag': '"abc"', 'length': 100})
+
+        self.assertEqual('From x', content)
+        self.assertEqual(6, new_state['length'])
+        pool.request.assert_called_with('http://lists/2012-July.txt',
+                                        headers={})
+
+    @mock.patch('spectrometer.processor.mls._read_archive')
+    def test_read_archives_concurrently(self, read_archive):
+        running = []
+        lock = threading.Lock()
+
+        def read(link, state):
+            with lock:
+                running.append(link)
+                concurrent = len(running)
+            # later archives complete first
+            time.sleep(0.01 * (3 - int(link)))
+            with lock:
+                running.remove(link)
+            return 'content ' + link, {'length': concurrent}
+
+        read_archive.side_effect = read
+
+        result = list(mls._read_archives_concurrently(
+            ['0', '1', '2', '3'], [{}] * 4, 2))
+
+        self.assertEqual(['0', '1', '2', '3'], [r[0] for r in result])
+        self.assertEqual(['content 0', 'content 1', 'content 2',
+                          'content 3'], [r[1] for r in result])
+        self.assertTrue(all(r[2]['length'] <= 2 for r in result))
+
+    @mock.patch('spectrometer.processor.mls._read_archive')
+    def test_read_archives_concurrently_failed_download(self, read_archive):
+        read_archive.side_effect = [Exception('connection reset'),
+                                    ('content', {'length': 7})]
+
+        result = list(mls._read_archives_concurrently(
+            ['0', '1'], [{'length': 5}, {}], 1))
+
+        self.assertEqual([('0', None, {'length': 5}),
+                          ('1', 'content', {'length': 7})], result)
+
+    @mock.patch('spectrometer.processor.mls._read_archive')
+    @mock.patch('spectrometer.processor.mls._get_mail_archive_links')
+    def test_log_mail_lists(self, get_links, read_archive):
+        links = {'http://a/': ['http://a/2012-July.txt'],
+                 'http://b/': ['http://b/2012-June.txt',
+                               'http://b/2012-July.txt']}
+        get_links.side_effect = links.get
+        read_archive.side_effect = lambda link, state: (
+            '' if 'June' in link else mbox_template % link, {'etag': link})
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.return_value = None
+
+        items = list(mls.log(['http://a/', 'http://b/'],
+                             runtime_storage_inst, 2))
+
+        # the June archive of b is not changed
+        self.assertEqual([
+            ('mail', 'http://a/2012-July.txt'),
+            ('checkpoint', 'mail_link:http://a/2012-July.txt'),
+            ('mail', 'http://b/2012-July.txt'),
+            ('checkpoint', 'mail_link:http://b/2012-July.txt'),
+        ], [('checkpoint', item.args[0]) if pipeline.is_checkpoint(item)
+            else ('mail', item['subject']) for item in items])
+
+mbox_template = """From john at example.com  Tue Jul 17 07:30:43 2012
+From: john at example.com (John Smith)
+Date: Tue, 17 Jul 2012 00:30:43 -0700
+Subject: %s
+Message-ID: <1@example.com>
+
+Body
+"""
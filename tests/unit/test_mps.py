@@ -14,7 +14,9 @@
 # limitations under the License.
 
 import re
+import time
 
+import mock
 import mockldap
 import testtools
 
@@ -94,13 +96,137 @@ class TestMps(testtools.TestCase):
         self.assertTrue(isinstance(mps.get_mps(ldap_uri), mps.Ldap))
         self.assertTrue(isinstance(mps.get_mps(http_uri), mps.Web))
 
-    @testtools.skip("failing ci")
-    def test_ldap_mps(self):
-        mps_inst = mps.Ldap(base_dn="ou=Users,dc=opendaylight,dc=org",
+    def make_web_mps(self, member_ids):
+        mps_inst = mps.Web('http://members/')
+        mps_inst.setup(concurrency=4)
+        profile = ('<h3>Member %s</h3><div class="span-7 last">'
+                   'June 25, 2013 <br></div>')
+
+        def read_profile(uri):
+            member_id = int(uri[len('http://members/'):])
+            if member_id in member_ids:
+                return profile % member_id
+
+        mps_inst._read_profile = mock.Mock(side_effect=read_profile)
+        return mps_inst
+
+    def test_web_mps(self):
+        member_ids = set([1, 2, 4, 7, 8, 9, 12, 15, 16, 18, 40])
+        mps_inst = self.make_web_mps(member_ids)
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = {
+            'last_update_members_date': int(time.time()),
+            'last_member_index': 8}.get
+
+        result = list(mps_inst.log(runtime_storage_inst, 30))
+
+        # gaps narrower than the probe window do not end the member list
+        self.assertEqual(['9', '12', '15', '16', '18', '40'],
+                         [r['member_id'] for r in result])
+        self.assertEqual('Member 15', result[2]['member_name'])
+        self.assertEqual('http://members/15', result[2]['member_uri'])
+        runtime_storage_inst.set_by_key.assert_called_once_with(
+            'last_member_index', 40)
+
+        # every profile is fetched once
+        uris = [c[0][0] for c in mps_inst._read_profile.call_args_list]
+        self.assertEqual(len(uris), len(set(uris)))
+
+    def test_web_mps_gaps(self):
+        window = mps.MEMBER_PROBE_WINDOW
+        # gaps shorter than the probe window are crawled over, the last
+        # member before the gap as wide as the window ends the list
+        last = 3 + window + 2 * (window - 1)
+        member_ids = set([1, 2, 3, 3 + window, 3 + window * 2 - 1, last,
+                          last + window + 1])
+        mps_inst = self.make_web_mps(member_ids)
+
+        def crawl(last_member_index):
+            runtime_storage_inst = mock.Mock()
+            runtime_storage_inst.get_by_key.side_effect = {
+                'last_update_members_date': int(time.time()),
+                'last_member_index': last_member_index}.get
+            return [int(r['member_id'])
+                    for r in mps_inst.log(runtime_storage_inst, 30)]
+
+        self.assertEqual(sorted(member_ids)[:-1], crawl(0))
+        self.assertEqual(sorted(member_ids)[3:-1], crawl(3))
+        self.assertEqual([last + window + 1], crawl(last + 1))
+
+    @mock.patch.object(mps, 'MEMBER_CRAWL_WINDOW', 3)
+    def test_web_mps_bounded_windows(self):
+        mps_inst = self.make_web_mps(set(range(1, 11)))
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = {
+            'last_update_members_date': int(time.time()),
+            'last_member_index': 0}.get
+        fetched = []
+        fetch = mps_inst._fetch
+
+        def record_fetch(member_ids):
+            fetched.append(list(member_ids))
+            return fetch(member_ids)
+
+        mps_inst._fetch = record_fetch
+        members = mps_inst.log(runtime_storage_inst, 30)
+
+        # profiles are fetched a window at a time as members are consumed
+        next(members)
+        self.assertEqual([[1, 2, 3]], fetched)
+        self.assertEqual(9, len(list(members)))
+        self.assertEqual(10 + mps.MEMBER_PROBE_WINDOW,
+                         mps_inst._read_profile.call_count)
+
+    def test_web_mps_window_checkpoint(self):
+        mps_inst = self.make_web_mps(set(range(1, 11)))
+        storage = {'last_update_members_date': int(time.time()),
+                   'last_member_index': 2}
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = storage.get
+        runtime_storage_inst.set_by_key.side_effect = storage.__setitem__
+
+        with mock.patch.object(mps, 'MEMBER_CRAWL_WINDOW', 3):
+            members = mps_inst.log(runtime_storage_inst, 30)
+            # interrupted while the third window is consumed
+            for i in range(7):
+                next(members)
+
+        self.assertEqual(8, storage['last_member_index'])
+
+    def test_web_mps_no_new_members(self):
+        mps_inst = self.make_web_mps(set([1, 2, 3]))
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.side_effect = {
+            'last_update_members_date': int(time.time()),
+            'last_member_index': 3}.get
+
+        self.assertEqual([], list(mps_inst.log(runtime_storage_inst, 30)))
+
+        self.assertEqual(mps.MEMBER_PROBE_WINDOW,
+                         mps_inst._read_profile.call_count)
+        self.assertFalse(runtime_storage_inst.set_by_key.called)
+
+    def make_ldap_mps(self, entries):
+        mps_inst = mps.Ldap(base_dn='ou=Users,dc=opendaylight,dc=org',
                             uri='ldap://localhost/')
-        mps_inst.setup()
-        member_iterator = mps_inst.log()
-        result = list(member_iterator)
+        mps_inst.connection = PagedLdapStandIn(entries, page_size=1)
+        return mps_inst
+
+    def test_ldap_mps(self):
+        entries = [(dn, dict(attrs, modifyTimestamp=[timestamp]))
+                   for (dn, attrs), timestamp in [
+                       (self.foo, '20140101000000Z'),
+                       (self.dave, '20140301000000Z')]]
+        mps_inst = self.make_ldap_mps(entries)
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.return_value = None
+
+        result = list(mps_inst.log(runtime_storage_inst, 30))
+
+        # a page per entry and the empty closing one
+        self.assertEqual(3, len(mps_inst.connection.searches))
+        self.assertEqual('(objectclass=identityPerson)',
+                         mps_inst.connection.searches[0])
 
         self.assertEqual(result[0]["member_id"], "foo")
         self.assertEqual(result[1]["member_id"], "dave-tucker")
@@ -119,3 +245,55 @@ class TestMps(testtools.TestCase):
 
         self.assertEqual(result[0]["email"], "foo@foo.org")
         self.assertEqual(result[1]["email"], "dave@dtucker.co.uk")
+
+        sync_key, sync = runtime_storage_inst.set_by_key.call_args[0]
+        self.assertEqual('members_sync:ldap%3A%2F%2Flocalhost%2F', sync_key)
+        self.assertEqual('20140301000000Z', sync['modify_timestamp'])
+
+    def test_ldap_mps_modified_since(self):
+        entries = [(dn, dict(attrs, modifyTimestamp=[timestamp]))
+                   for (dn, attrs), timestamp in [
+                       (self.foo, '20140101000000Z'),
+                       (self.dave, '20140301000000Z')]]
+        mps_inst = self.make_ldap_mps(entries)
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_by_key.return_value = {
+            'full_sync_date': int(time.time()),
+            'modify_timestamp': '20140201000000Z'}
+
+        result = list(mps_inst.log(runtime_storage_inst, 30))
+
+        self.assertEqual(['dave-tucker'], [r['member_id'] for r in result])
+        self.assertEqual('(&(objectclass=identityPerson)'
+                         '(modifyTimestamp>=20140201000000Z))',
+                         mps_inst.connection.searches[0])
+
+
+class PagedLdapStandIn(object):
+    """Serves search results in pages of the paged results control."""
+
+    def __init__(self, entries, page_size):
+        self.entries = entries
+        self.page_size = page_size
+        self.searches = []
+        self.pending = {}
+
+    def search_ext(self, base, scope, filterstr, attrlist, serverctrls):
+        self.searches.append(filterstr)
+        since = re.search(r'modifyTimestamp>=(\w+)', filterstr)
+        entries = [e for e in self.entries
+                   if not since or e[1]['modifyTimestamp'][0] >=
+                   since.group(1)]
+        offset = int(serverctrls[0].cookie or 0)
+        page = entries[offset:offset + self.page_size]
+        cookie = str(offset + len(page)) if page else ''
+
+        msgid = len(self.searches)
+        self.pending[msgid] = (page, cookie)
+        return msgid
+
+    def result3(self, msgid):
+        page, cookie = self.pending.pop(msgid)
+        control = mps.ldap_controls.SimplePagedResultsControl(
+            True, size=self.page_size, cookie=cookie)
+        return 101, page, msgid, [control]
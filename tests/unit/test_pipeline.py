@@ -0,0 +1,105 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import mock
+import testtools
+
+from spectrometer.processor import pipeline
+
+
+class TestPipeline(testtools.TestCase):
+    def _wait(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('Condition is not met')
+
+    def test_prefetch_keeps_order(self):
+        self.assertEqual(list(range(100)),
+                         list(pipeline.prefetch(iter(range(100)), 3)))
+
+    def test_prefetch_inline(self):
+        threads = []
+
+        def produce():
+            threads.append(threading.current_thread())
+            yield 1
+
+        self.assertEqual([1], list(pipeline.prefetch(produce(), 0)))
+        self.assertEqual([threading.current_thread()], threads)
+
+    def test_prefetch_bounded(self):
+        produced = []
+
+        def produce():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        iterator = pipeline.prefetch(produce(), 2)
+        self.assertEqual(0, next(iterator))
+        # two items in the queue and one waiting to be put
+        self._wait(lambda: len(produced) == 4)
+        time.sleep(0.05)
+        self.assertEqual(4, len(produced))
+
+        self.assertEqual(list(range(1, 10)), list(iterator))
+
+    def test_prefetch_raises_producer_error(self):
+        def produce():
+            yield 1
+            raise ValueError('broken')
+
+        iterator = pipeline.prefetch(produce(), 5)
+        self.assertEqual(1, next(iterator))
+        self.assertRaises(ValueError, next, iterator)
+
+    @mock.patch.object(pipeline, 'PUT_TIMEOUT', 0.01)
+    def test_prefetch_stops_producer(self):
+        finished = threading.Event()
+
+        def produce():
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                finished.set()
+
+        iterator = pipeline.prefetch(produce(), 1)
+        next(iterator)
+        iterator.close()
+
+        self.assertTrue(finished.wait(5))
+
+    def test_apply_checkpoints_after_stored(self):
+        saved = []
+        consumed = []
+
+        def produce():
+            yield 1
+            yield 2
+            yield pipeline.Checkpoint(saved.append, 2)
+            yield 3
+
+        for record in pipeline.apply_checkpoints(
+                pipeline.prefetch(produce(), 5)):
+            consumed.append((record, list(saved)))
+
+        # the checkpoint is saved once the record before it is stored
+        self.assertEqual([(1, []), (2, []), (3, [2])], consumed)
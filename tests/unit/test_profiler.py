@@ -0,0 +1,92 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pstats
+import time
+
+import fixtures
+import testtools
+
+from spectrometer.processor import profiler
+
+
+def _busy_loop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class TestProfiler(testtools.TestCase):
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.directory = self.useFixture(fixtures.TempDir()).path
+        self.addCleanup(profiler.setup, None, None, None)
+
+    def _get_files(self, extension):
+        return dict((name.split('-', 2)[2], os.path.join(self.directory, name))
+                    for name in os.listdir(self.directory)
+                    if name.endswith(extension))
+
+    def test_cprofile_file_per_stage(self):
+        profiler.setup('cprofile', self.directory, None)
+
+        @profiler.profiled('update')
+        def update():
+            _busy_loop(0.01)
+
+        @profiler.profiled('process_repo')
+        def process_repo():
+            # nested stage is accounted to the outer one
+            update()
+
+        process_repo()
+        process_repo()
+        update()
+        profiler.PROFILER.dump()
+
+        files = self._get_files('.prof')
+        self.assertEqual(set(['process_repo.prof', 'update.prof']),
+                         set(files))
+        stats = pstats.Stats(files['process_repo.prof'])
+        calls = dict((func[2], stat[0])
+                     for func, stat in stats.stats.items())
+        self.assertEqual(2, calls['update'])
+        self.assertEqual(2, calls['_busy_loop'])
+
+    def test_sampling_collapsed_stacks(self):
+        profiler.setup('sampling', self.directory, 0.001)
+
+        with profiler.PROFILER.profile('update_members'):
+            _busy_loop(0.1)
+        profiler.PROFILER.dump()
+
+        files = self._get_files('.stacks')
+        self.assertEqual(['update_members.stacks'], list(files))
+        with open(files['update_members.stacks']) as fd:
+            lines = fd.readlines()
+        self.assertTrue(any('_busy_loop (test_profiler.py:' in line
+                            for line in lines))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].strip().isdigit()
+                            for line in lines))
+
+    def test_disabled(self):
+        profiler.setup(None, self.directory, None)
+
+        with profiler.PROFILER.profile('update'):
+            pass
+        profiler.PROFILER.dump()
+
+        self.assertEqual([], os.listdir(self.directory))
@@ -0,0 +1,481 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+import threading
+import time
+
+import mock
+import paramiko
+from six.moves import BaseHTTPServer
+from six.moves.urllib import parse
+import testtools
+
+from spectrometer.processor import rcs
+
+
+class TestRcs(testtools.TestCase):
+    def setUp(self):
+        super(TestRcs, self).setUp()
+
+        self.repo = {
+            'module': 'controller',
+            'organization': 'opendaylight',
+            'uri': 'git://git.opendaylight.org/controller.git',
+            'releases': []
+        }
+        self.ssh_client_patcher = mock.patch('paramiko.SSHClient')
+        self.ssh_client = self.ssh_client_patcher.start()
+        self.ssh_client.side_effect = lambda: mock.Mock()
+        rcs.close_connections()
+
+    def tearDown(self):
+        super(TestRcs, self).tearDown()
+        rcs.close_connections()
+        self.ssh_client_patcher.stop()
+
+    def make_gerrit(self):
+        gerrit = rcs.Gerrit(self.repo, 'gerrit://git.opendaylight.org')
+        gerrit.setup(key_filename='key', username='user')
+        return gerrit
+
+    def test_connection_is_shared(self):
+        gerrit_a = self.make_gerrit()
+        gerrit_b = self.make_gerrit()
+
+        client = gerrit_a._connect()
+        self.assertIs(client, gerrit_b._connect())
+
+        self.assertEqual(1, self.ssh_client.call_count)
+        client.connect.assert_called_once_with(
+            'git.opendaylight.org', port=rcs.DEFAULT_PORT,
+            key_filename='key', username='user')
+
+    def test_reconnect_on_inactive_transport(self):
+        gerrit = self.make_gerrit()
+        old_client = gerrit._connect()
+        old_client.get_transport.return_value.is_active.return_value = False
+
+        self.assertIsNot(old_client, gerrit._connect())
+        old_client.close.assert_called_once_with()
+
+    def test_exec_command_reconnects_on_broken_transport(self):
+        gerrit = self.make_gerrit()
+        old_client = gerrit._connect()
+        old_client.exec_command.side_effect = paramiko.SSHException()
+
+        result = gerrit._exec_command('gerrit query')
+
+        client = gerrit._connect()
+        self.assertIsNot(old_client, client)
+        self.assertEqual(client.exec_command.return_value, result)
+
+    def test_reconnect_keeps_client_of_other_threads(self):
+        gerrit = self.make_gerrit()
+        old_client = gerrit._connect()
+        old_client.exec_command.side_effect = paramiko.SSHException()
+
+        # two polls fail on the same client, e.g. in two threads
+        gerrit._exec_command('gerrit query')
+        client = gerrit._connect()
+        gerrit._exec_command('gerrit query', old_client)
+
+        # the second one takes the client the first one has connected
+        self.assertIs(client, gerrit._connect())
+        self.assertEqual(2, self.ssh_client.call_count)
+        self.assertEqual(2, client.exec_command.call_count)
+        # the transport is still up, commands of others keep running
+        self.assertFalse(old_client.close.called)
+        rcs.close_connections()
+        old_client.close.assert_called_once_with()
+
+    def test_log_polls_reviews_updated_since_last_id(self):
+        gerrit = self.make_gerrit()
+        client = gerrit._connect()
+        pages = [
+            ['{"id": "I2", "sortKey": "0029f92e00000002", '
+             '"lastUpdated": 1390559536}',
+             '{"id": "I1", "sortKey": "0029f92e00000001", '
+             '"lastUpdated": 1390550000}',
+             '{"type": "stats", "rowCount": 2}'],
+            ['{"type": "stats", "rowCount": 0}'],
+        ]
+        client.exec_command.side_effect = [
+            (None, page, None) for page in pages]
+
+        reviews = list(gerrit.log('master', 1390540000))
+
+        self.assertEqual(['I2', 'I1'], [r['id'] for r in reviews])
+        commands = [c[0][0] for c in
+                    client.exec_command.call_args_list]
+        self.assertEqual(2, len(commands))
+        for cmd in commands:
+            self.assertIn('\'after:"2014-01-24 05:06:40 +0000"\'', cmd)
+            self.assertNotIn('is:open', cmd)
+        self.assertIn('resume_sortkey:0029f92e00000001', commands[1])
+
+        # the newest update becomes last id without another query
+        self.assertEqual(1390559536, gerrit.get_last_id('master'))
+        self.assertEqual(2, client.exec_command.call_count)
+
+    def test_log_failed_page_keeps_last_id(self):
+        gerrit = self.make_gerrit()
+        client = gerrit._connect()
+        client.exec_command.side_effect = [
+            (None, ['{"id": "I2", "sortKey": "0029f92e00000002", '
+                    '"lastUpdated": 1390559536}',
+                    '{"type": "stats", "rowCount": 1}'], None),
+            Exception('broken pipe'),
+        ]
+
+        result = list(rcs.log_concurrently(
+            [('rcs:master', gerrit, 'master', 1390540000, None)], 1))
+
+        # the task is not done, its checkpoint stays where it was
+        self.assertEqual([('review', 'rcs:master')],
+                         [r[:2] for r in result])
+        self.assertEqual({}, gerrit.polled_last_ids)
+
+    def test_log_resumes_until(self):
+        gerrit = self.make_gerrit()
+        client = gerrit._connect()
+        client.exec_command.return_value = (
+            None, ['{"type": "stats", "rowCount": 0}'], None)
+
+        list(gerrit.log('master', None, until=1390559536))
+
+        cmd = client.exec_command.call_args[0][0]
+        self.assertIn('\'before:"2014-01-24 10:32:16 +0000"\'', cmd)
+        self.assertNotIn('after:', cmd)
+
+    def test_log_ignores_stored_sort_key(self):
+        gerrit = self.make_gerrit()
+        client = gerrit._connect()
+        client.exec_command.return_value = (
+            None, ['{"type": "stats", "rowCount": 0}'], None)
+
+        self.assertEqual([], list(gerrit.log('master', 0x0029f92e0000ed31)))
+
+        cmd = client.exec_command.call_args[0][0]
+        self.assertNotIn('after:', cmd)
+        self.assertIsNone(gerrit.get_last_id('master'))
+
+    def test_log_all_branches_with_one_query(self):
+        gerrit = self.make_gerrit()
+        client = gerrit._connect()
+        client.exec_command.side_effect = [
+            (None, ['{"id": "I2", "sortKey": "0029f92e00000002", '
+                    '"branch": "stable/helium", "lastUpdated": 1390559536}',
+                    '{"id": "I1", "sortKey": "0029f92e00000001", '
+                    '"branch": "master", "lastUpdated": 1390550000}'], None),
+            (None, ['{"type": "stats", "rowCount": 0}'], None)]
+
+        branches = ['master', 'stable/helium']
+        reviews = list(gerrit.log(branches, None))
+
+        self.assertEqual([('I2', 'stable/helium'), ('I1', 'master')],
+                         [(r['id'], r['branch']) for r in reviews])
+        cmd = client.exec_command.call_args_list[0][0][0]
+        self.assertIn(' (branch:master OR branch:stable/helium) ', cmd)
+        self.assertEqual(1390559536, gerrit.get_last_id(branches))
+
+    def test_log_keeps_projected_fields(self):
+        gerrit = self.make_gerrit()
+        gerrit.setup(projection={'id': None, 'sortKey': None,
+                                 'lastUpdated': None})
+        client = gerrit._connect()
+        client.exec_command.side_effect = [
+            (None, ['{"id": "I1", "sortKey": "0029f92e00000001", '
+                    '"lastUpdated": 1390550000, "commitMessage": "Fix"}'],
+             None),
+            (None, ['{"type": "stats", "rowCount": 0}'], None)]
+
+        self.assertEqual([{'id': 'I1', 'sortKey': '0029f92e00000001',
+                           'lastUpdated': 1390550000,
+                           'module': 'controller'}],
+                         list(gerrit.log('master', None)))
+
+    def test_log_concurrently(self):
+        barrier = threading.Event()
+        running = []
+
+        class FakeRcs(object):
+            def log(self, branch, last_id, until=None):
+                running.append(branch)
+                if len(running) == 2:
+                    barrier.set()
+                # both branches have to be polled at the same time
+                if not barrier.wait(5):
+                    raise AssertionError('Queries are not concurrent')
+                yield {'id': branch + ':1'}
+                yield {'id': branch + ':2'}
+
+            def get_last_id(self, branch):
+                return branch + ':last'
+
+        fake_rcs = FakeRcs()
+        result = list(rcs.log_concurrently(
+            [('rcs:master', fake_rcs, 'master', None, None),
+             ('rcs:stable', fake_rcs, 'stable', None, None)], 2))
+
+        self.assertEqual(6, len(result))
+        for key, branch in [('rcs:master', 'master'),
+                            ('rcs:stable', 'stable')]:
+            items = [r for r in result if r[1] == key]
+            self.assertEqual([('review', key, {'id': branch + ':1'}),
+                              ('review', key, {'id': branch + ':2'}),
+                              ('done', key, branch + ':last')], items)
+
+    @mock.patch.object(rcs, 'QUEUE_SIZE', 2)
+    def test_log_concurrently_early_close(self):
+        finished = threading.Event()
+
+        class FakeRcs(object):
+            def log(self, branch, last_id, until=None):
+                try:
+                    for i in range(10):
+                        yield {'id': '%s:%d' % (branch, i)}
+                finally:
+                    finished.set()
+
+        log = rcs.log_concurrently(
+            [('rcs:master', FakeRcs(), 'master', None, None)], 1)
+        self.assertEqual(('review', 'rcs:master', {'id': 'master:0'}),
+                         next(log))
+        log.close()
+
+        # the worker blocked on the full queue stops polling
+        self.assertTrue(finished.wait(5))
+
+    def test_log_concurrently_failed_task(self):
+        failing_rcs = mock.Mock()
+        failing_rcs.log.side_effect = Exception('broken pipe')
+
+        result = list(rcs.log_concurrently(
+            [('rcs:master', failing_rcs, 'master', None, None)], 4))
+
+        self.assertEqual([], result)
+
+
+def _make_change(number, updated):
+    return {
+        'change_id': 'I%040d' % number,
+        '_number': number,
+        'project': 'controller',
+        'branch': 'master',
+        'subject': 'Change %d' % number,
+        'status': 'NEW',
+        'created': '2014-01-20 10:00:00.000000000',
+        'updated': updated,
+        'owner': {'_account_id': 1, 'name': 'John Doe',
+                  'email': 'john@example.com', 'username': 'jdoe'},
+        'revisions': {
+            'rev2': {'_number': 2, 'created': '2014-01-22 10:00:00.000000000',
+                     'uploader': {'name': 'John Doe',
+                                  'email': 'john@example.com',
+                                  'username': 'jdoe'}},
+            'rev1': {'_number': 1, 'created': '2014-01-20 10:00:00.000000000',
+                     'uploader': {'name': 'John Doe',
+                                  'email': 'john@example.com',
+                                  'username': 'jdoe'}},
+        },
+        'labels': {
+            'Code-Review': {'all': [
+                {'value': -1, 'date': '2014-01-21 10:00:00.000000000',
+                 'name': 'Bill Smith', 'email': 'bill@example.com',
+                 'username': 'bsmith'},
+                {'value': 0, 'name': 'Jane Roe'},
+            ]},
+        },
+    }
+
+
+class GerritStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.connections.add(self.client_address)
+        query = parse.parse_qs(parse.urlparse(self.path).query)
+        start = int(query.get('S', ['0'])[0])
+        limit = int(query['n'][0])
+
+        # before: includes the given second
+        changes = self.server.changes
+        for before in re.findall(r'before:"([^"]+) \+0000"', query['q'][0]):
+            changes = [c for c in changes if c['updated'][:19] <= before]
+        page = changes[start:start + limit]
+        if start + limit < len(changes):
+            page[-1] = dict(page[-1], _more_changes=True)
+        body = ")]}'\n" + json.dumps(page)
+        if self.server.on_request:
+            self.server.on_request()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGerritRest(testtools.TestCase):
+    def setUp(self):
+        super(TestGerritRest, self).setUp()
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                GerritStubHandler)
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.changes = []
+        self.server.on_request = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.repo = {
+            'module': 'controller',
+            'organization': 'opendaylight',
+            'uri': 'git://git.opendaylight.org/controller.git',
+            'releases': []
+        }
+        self.gerrit = rcs.get_rcs(
+            self.repo, 'http+gerrit://127.0.0.1:%d/gerrit' %
+            self.server.server_address[1])
+
+    def tearDown(self):
+        super(TestGerritRest, self).tearDown()
+        rcs.close_connections()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_rcs(self):
+        self.assertIsInstance(self.gerrit, rcs.GerritRest)
+        self.assertEqual('http://127.0.0.1:%d/gerrit' %
+                         self.server.server_address[1], self.gerrit.base_uri)
+
+    def test_log_pages_over_one_connection(self):
+        self.server.changes = [
+            _make_change(n, time.strftime('%Y-%m-%d %H:%M:%S.000000000',
+                                          time.gmtime(1390561140 - n * 60)))
+            for n in range(rcs.PAGE_LIMIT + 10)]
+
+        reviews = list(self.gerrit.log('master', None))
+
+        self.assertEqual(rcs.PAGE_LIMIT + 10, len(reviews))
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(1, len(self.server.connections))
+        query = parse.parse_qs(parse.urlparse(self.server.requests[1]).query)
+        self.assertEqual(['project:controller branch:master '
+                          'before:"2014-01-24 09:20:01 +0000"'], query['q'])
+        self.assertEqual(['0'], query['S'])
+        self.assertEqual(sorted(rcs.GERRIT_REST_OPTIONS), sorted(query['o']))
+
+        # last id is the newest update seen when polling started
+        self.assertEqual(1390561140, self.gerrit.get_last_id('master'))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_log_pages_by_update_time(self):
+        self.server.changes = [
+            _make_change(n, time.strftime('%Y-%m-%d %H:%M:%S.000000000',
+                                          time.gmtime(1390561140 - n * 60)))
+            for n in range(rcs.PAGE_LIMIT + 10)]
+
+        def update_change():
+            # a change of the first page gets updated while paging and
+            # leaves the resumed poll, the rest of the changes move up
+            change = self.server.changes.pop(50)
+            change['updated'] = '2014-01-24 11:30:00.000000000'
+            self.server.changes.insert(0, change)
+            self.server.on_request = None
+
+        self.server.on_request = update_change
+
+        reviews = list(self.gerrit.log('master', None, until=1390561140))
+
+        self.assertEqual(list(range(rcs.PAGE_LIMIT + 10)),
+                         [int(r['number']) for r in reviews])
+
+    def test_log_pages_within_one_second(self):
+        self.server.changes = [
+            _make_change(n, '2014-01-24 10:32:16.%09d' % (10 ** 9 - n - 1))
+            for n in range(rcs.PAGE_LIMIT + 10)]
+        self.server.changes.append(
+            _make_change(1000, '2014-01-24 10:00:00.000000000'))
+
+        reviews = list(self.gerrit.log('master', None))
+
+        self.assertEqual(list(range(rcs.PAGE_LIMIT + 10)) + [1000],
+                         [int(r['number']) for r in reviews])
+
+    def test_log_record_shape(self):
+        self.server.changes = [
+            _make_change(7, '2014-01-24 10:32:16.000000000')]
+
+        review = list(self.gerrit.log('master', 1390550000))[0]
+
+        self.assertEqual({
+            'id': 'I%040d' % 7,
+            'number': '7',
+            'subject': 'Change 7',
+            'project': 'controller',
+            'branch': 'master',
+            'status': 'NEW',
+            'open': True,
+            'url': self.gerrit.base_uri + '/7',
+            'createdOn': 1390212000,
+            'lastUpdated': 1390559536,
+            'owner': {'name': 'John Doe', 'email': 'john@example.com',
+                      'username': 'jdoe'},
+            'module': 'controller',
+            'patchSets': [{
+                'number': '1',
+                'revision': 'rev1',
+                'ref': None,
+                'createdOn': 1390212000,
+                'uploader': {'name': 'John Doe', 'email': 'john@example.com',
+                             'username': 'jdoe'},
+                'approvals': [{
+                    'type': 'Code-Review',
+                    'description': 'Code-Review',
+                    'value': '-1',
+                    'grantedOn': 1390298400,
+                    'by': {'name': 'Bill Smith', 'email': 'bill@example.com',
+                           'username': 'bsmith'},
+                }],
+            }, {
+                'number': '2',
+                'revision': 'rev2',
+                'ref': None,
+                'createdOn': 1390384800,
+                'uploader': {'name': 'John Doe', 'email': 'john@example.com',
+                             'username': 'jdoe'},
+            }],
+        }, review)
+
+        query = parse.parse_qs(parse.urlparse(self.server.requests[0]).query)
+        self.assertEqual(['project:controller branch:master '
+                          'after:"2014-01-24 07:53:20 +0000"'], query['q'])
+
+    def test_get_last_id(self):
+        self.server.changes = [
+            _make_change(7, '2014-01-24 10:32:16.000000000')]
+
+        self.assertEqual(1390559536, self.gerrit.get_last_id('master'))
+        query = parse.parse_qs(parse.urlparse(self.server.requests[0]).query)
+        self.assertEqual(['1'], query['n'])
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import functools
 import itertools
 import time
 
@@ -443,6 +445,36 @@ class TestRecordProcessor(testtools.TestCase):
             self.assertEqual('IBM', record['company_name'],
                              message='Record %s' % record['primary_key'])
 
+    def test_process_review_skips_unchanged(self):
+        record_processor_inst = self.make_record_processor()
+        runtime_storage_inst = record_processor_inst.runtime_storage_inst
+        review = {
+            'record_type': 'review',
+            'id': 'I1045730e47e9e6ad31fcdfbaefdad77e2f3b2c3e',
+            'subject': 'Fix AttributeError in Keypair._add_details()',
+            'owner': {'name': 'John Doe',
+                      'email': 'john_doe@ibm.com',
+                      'username': 'john_doe'},
+            'createdOn': 1379404951,
+            'module': 'nova', 'branch': 'master',
+            'patchSets': [{'number': '1', 'createdOn': 1379404951,
+                           'uploader': {'name': 'John Doe',
+                                        'email': 'john_doe@ibm.com',
+                                        'username': 'john_doe'}}]}
+
+        processed = list(record_processor_inst.process(
+            [copy.deepcopy(review)]))
+        self.assertEqual(['patch', 'review'],
+                         [r['record_type'] for r in processed])
+        runtime_storage_inst.set_records(processed)
+
+        self.assertEqual([], list(record_processor_inst.process(
+            [copy.deepcopy(review)])))
+
+        review['lastUpdated'] = 1379404999
+        self.assertEqual(2, len(list(record_processor_inst.process(
+            [copy.deepcopy(review)]))))
+
     def test_core_user_guess(self):
         record_processor_inst = self.make_record_processor(
             companies=[{'company_name': 'IBM', 'domains': ['ibm.com']}],
@@ -697,6 +729,150 @@ class TestRecordProcessor(testtools.TestCase):
         commit = runtime_storage_inst.get_by_primary_key('de7e8f2')
         self.assertEqual(1385490000, commit['date'])
 
+    def test_update_resumes_interrupted(self):
+        record_processor_inst = self.make_record_processor()
+        runtime_storage_inst = record_processor_inst.runtime_storage_inst
+        runtime_storage_inst.set_by_key(
+            record_processor.UPDATE_PROGRESS_KEY,
+            {'passes': ['user_info', 'review_numbers']})
+
+        passes = []
+        for name, update_pass in record_processor_inst._get_update_passes(
+                None):
+            setattr(record_processor_inst, update_pass.__name__,
+                    functools.partial(passes.append, name))
+
+        record_processor_inst.update()
+
+        self.assertEqual(['blueprint_mentions', 'merge_dates',
+                          'core_contributors', 'disagreement'], passes)
+        self.assertIsNone(runtime_storage_inst.get_by_key(
+            record_processor.UPDATE_PROGRESS_KEY))
+
+        # new records are processed since the interrupted update, all
+        # passes rerun
+        runtime_storage_inst.set_by_key(
+            record_processor.UPDATE_PROGRESS_KEY, {'passes': ['user_info']})
+        runtime_storage_inst.set_by_key.reset_mock()
+        list(record_processor_inst.process(generate_commits()))
+        list(record_processor_inst.process(generate_emails()))
+        del passes[:]
+
+        # progress is reset once, not for every record
+        self.assertEqual(
+            [mock.call(record_processor.UPDATE_PROGRESS_KEY, None)],
+            [c for c in runtime_storage_inst.set_by_key.call_args_list
+             if c[0][0] == record_processor.UPDATE_PROGRESS_KEY])
+
+        record_processor_inst.update()
+
+        self.assertEqual('user_info', passes[0])
+
+    def test_is_update_needed(self):
+        record_processor_inst = self.make_record_processor()
+        self.assertFalse(record_processor_inst.is_update_needed())
+
+        list(record_processor_inst.process(generate_commits()))
+        self.assertTrue(record_processor_inst.is_update_needed())
+
+        with mock.patch.object(record_processor_inst,
+                               '_update_records_with_user_info',
+                               side_effect=IOError()):
+            self.assertRaises(IOError, record_processor_inst.update)
+        # the update is interrupted in its first pass
+        self.assertTrue(record_processor_inst.is_update_needed())
+
+        record_processor_inst.update()
+        self.assertFalse(record_processor_inst.is_update_needed())
+
+    def test_update_core_contributors(self):
+        record_processor_inst = self.make_record_processor()
+        runtime_storage_inst = record_processor_inst.runtime_storage_inst
+        self.assertTrue(record_processor_inst.is_core_update_needed())
+
+        record_processor_inst.update()
+        self.assertFalse(record_processor_inst.is_core_update_needed())
+
+        # only the passes depending on the quarter are run daily
+        passes = []
+        for name, update_pass in record_processor_inst._get_update_passes(
+                None):
+            setattr(record_processor_inst, update_pass.__name__,
+                    functools.partial(passes.append, name))
+        runtime_storage_inst.set_by_key(
+            record_processor.CORE_CONTRIBUTORS_DATE_KEY,
+            int(time.time()) -
+            record_processor.CORE_CONTRIBUTORS_UPDATE_INTERVAL)
+        self.assertTrue(record_processor_inst.is_core_update_needed())
+        self.assertFalse(record_processor_inst.is_update_needed())
+
+        record_processor_inst.update_core_contributors()
+
+        self.assertEqual(['core_contributors', 'disagreement'], passes)
+        self.assertFalse(record_processor_inst.is_core_update_needed())
+
+    def test_update_resumes_pass_interrupted_partway(self):
+        record_processor_inst = self.make_record_processor()
+        runtime_storage_inst = record_processor_inst.runtime_storage_inst
+        runtime_storage_inst.set_records(record_processor_inst.process(
+            generate_commits()))
+
+        passes = []
+        interrupted = []
+
+        def make_pass(name):
+            def update_pass():
+                passes.append(name)
+                for record in runtime_storage_inst.get_all_records():
+                    yield record
+                if name == 'merge_dates' and not interrupted:
+                    interrupted.append(name)
+                    raise IOError()
+            return update_pass
+
+        for name, update_pass in record_processor_inst._get_update_passes(
+                None):
+            setattr(record_processor_inst, update_pass.__name__,
+                    make_pass(name))
+
+        # the pass is interrupted after it stored a record
+        self.assertRaises(IOError, record_processor_inst.update)
+        del passes[:]
+
+        record_processor_inst.update()
+
+        # writes of the interrupted pass do not reset the completed ones
+        self.assertEqual(['merge_dates', 'core_contributors', 'disagreement'],
+                         passes)
+
+    def test_update_user_info_of_affected_records_only(self):
+        record_processor_inst = self.make_record_processor()
+        runtime_storage_inst = record_processor_inst.runtime_storage_inst
+        records = [{'primary_key': user_id, 'user_id': user_id,
+                    'author_email': email, 'author_name': '',
+                    'company_name': '*independent'}
+                   for user_id, email in [
+                       ('john_doe', 'john@gmail.com'),
+                       ('jane', 'jane@gmail.com'),
+                       ('ivan', 'ivan@lab.mirantis.com'),
+                       ('bob', 'bob@example.com')]]
+        runtime_storage_inst.get_all_records = mock.Mock(
+            return_value=records)
+        updated = []
+
+        def update_record_and_user(record):
+            updated.append(record['user_id'])
+            record['company_name'] = 'Mirantis'
+
+        with mock.patch.object(record_processor_inst,
+                               '_update_record_and_user',
+                               side_effect=update_record_and_user):
+            record_processor_inst.update_user_info(
+                set(['john_doe']), set(['jane@gmail.com']),
+                set(['mirantis.com']))
+
+        self.assertEqual(['john_doe', 'jane', 'ivan'], updated)
+
     # update records
 
     def _generate_record_commit(self):
@@ -1007,6 +1183,10 @@ def make_runtime_storage(users=None, companies=None, releases=None,
     def get_by_primary_key(primary_key):
         return runtime_storage_cache.get(primary_key)
 
+    def get_digest(primary_key):
+        record = runtime_storage_cache.get(primary_key) or {}
+        return record.get('digest')
+
     rs = mock.Mock(runtime_storage.RuntimeStorage)
     rs.get_by_key = mock.Mock(side_effect=get_by_key)
     rs.set_by_key = mock.Mock(side_effect=set_by_key)
@@ -1016,6 +1196,7 @@ def make_runtime_storage(users=None, companies=None, releases=None,
     rs.set_records = mock.Mock(side_effect=set_records)
     rs.get_all_records = mock.Mock(side_effect=get_all_records)
     rs.get_by_primary_key = mock.Mock(side_effect=get_by_primary_key)
+    rs.get_digest = mock.Mock(side_effect=get_digest)
 
     if users:
         for user in users:
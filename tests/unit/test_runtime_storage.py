@@ -0,0 +1,128 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import memcache
+import mock
+import six
+import testtools
+
+from spectrometer.processor import metrics
+from spectrometer.processor import runtime_storage
+from spectrometer.processor import utils
+
+
+class FakeMemcached(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def get_multi(self, keys, key_prefix=''):
+        return dict((k, self.data[key_prefix + str(k)]) for k in keys
+                    if key_prefix + str(k) in self.data)
+
+
+class TestRuntimeStorage(testtools.TestCase):
+    def setUp(self):
+        super(TestRuntimeStorage, self).setUp()
+        self.memcached = FakeMemcached()
+        self.memcache_patcher = mock.patch(
+            'spectrometer.processor.runtime_storage.MeteredClient')
+        memcache_client = self.memcache_patcher.start()
+        memcache_client.return_value = self.memcached
+
+    def tearDown(self):
+        super(TestRuntimeStorage, self).tearDown()
+        self.memcache_patcher.stop()
+
+    def make_storage(self):
+        return runtime_storage.get_runtime_storage(
+            'memcached://127.0.0.1:11211')
+
+    def test_set_records_skips_unchanged(self):
+        storage = self.make_storage()
+        storage.set_records([{'primary_key': 'I1', 'value': 1}],
+                            utils.merge_records)
+        self.assertEqual(1, storage._get_update_count())
+
+        storage.get_by_key = mock.Mock(side_effect=storage.get_by_key)
+        storage.set_records([{'primary_key': 'I1', 'value': 1}],
+                            utils.merge_records)
+
+        # neither the original is read nor an update is logged
+        self.assertFalse(storage.get_by_key.called)
+        self.assertEqual(1, storage._get_update_count())
+
+        storage.set_records([{'primary_key': 'I1', 'value': 2}],
+                            utils.merge_records)
+        self.assertEqual(2, storage._get_update_count())
+        self.assertEqual(2, storage.get_by_key('record:0')['value'])
+
+    def test_digest_index_is_restored(self):
+        storage = self.make_storage()
+        storage.set_records([{'primary_key': 'I1', 'value': 1,
+                              'digest': 'abc'}], utils.merge_records)
+
+        storage = self.make_storage()
+
+        self.assertEqual('abc', storage.get_digest('I1'))
+        self.assertIsNone(storage.get_digest('I2'))
+
+    def test_has_record(self):
+        storage = self.make_storage()
+        storage.set_records([{'primary_key': '<1@example.com>'}])
+
+        self.assertTrue(storage.has_record('<1@example.com>'))
+        self.assertFalse(storage.has_record('<2@example.com>'))
+
+
+class TestMeteredClient(testtools.TestCase):
+    def test_metered_client(self):
+        metrics.METRICS.reset()
+        client = runtime_storage.MeteredClient(['127.0.0.1:11211'])
+        stored = {}
+
+        def set_multi(mapping, *args, **kwargs):
+            for key, value in six.iteritems(mapping):
+                stored[key] = client._val_to_store_info(value, 0)[2]
+            return []
+
+        def get_multi(keys):
+            return dict((key, value if key == 'a' else
+                         runtime_storage._MeteredUnpickler(
+                             six.BytesIO(value)).load())
+                        for key, value in six.iteritems(stored))
+
+        with mock.patch.object(memcache.Client, 'set_multi',
+                               side_effect=set_multi):
+            client.set_multi({'a': 'value', 'b': {'c': 1}})
+        with mock.patch.object(memcache.Client, 'get_multi',
+                               side_effect=get_multi):
+            self.assertEqual({'a': 'value', 'b': {'c': 1}},
+                             client.get_multi(['a', 'b', 'd']))
+        with mock.patch.object(memcache.Client, 'get', return_value=None):
+            self.assertIsNone(client.get('d'))
+
+        # values are pickled once, by memcache.Client
+        size = len(stored['a']) + len(stored['b'])
+        counters = metrics.METRICS.get_summary()['stages']['storage']
+        self.assertEqual(3, counters['calls'])
+        self.assertEqual(size, counters['bytes_written'])
+        self.assertEqual(size, counters['bytes_read'])
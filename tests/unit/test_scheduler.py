@@ -0,0 +1,101 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import testtools
+
+from spectrometer.processor import scheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestScheduler(testtools.TestCase):
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.clock = FakeClock()
+        self.scheduler = scheduler.Scheduler(self.clock, self.clock.sleep)
+        self.runs = []
+
+    def _add(self, name, interval, priority=0, duration=0, delay=0):
+        def action():
+            self.runs.append((name, self.clock.now))
+            self.clock.now += duration
+
+        self.scheduler.add(name, action, interval, priority, delay)
+
+    def test_priority_order(self):
+        self._add('mail', 100, priority=1)
+        self._add('gerrit', 100, priority=5)
+        self._add('git', 100, priority=3)
+
+        while self.scheduler.run_pending():
+            pass
+
+        self.assertEqual(['gerrit', 'git', 'mail'],
+                         [name for name, t in self.runs])
+
+    def test_interval_counts_from_run_end(self):
+        self._add('git', 100, duration=250)
+        self._add('gerrit', 10, priority=1, delay=5)
+
+        def stop():
+            if len(self.runs) >= 4:
+                self.scheduler.stop()
+
+        self.scheduler.add('stop', stop, 1, priority=-1)
+        self.scheduler.run()
+
+        # gerrit waits for the long git run, then runs once, not once
+        # for every interval it missed
+        self.assertEqual([('git', 1000), ('gerrit', 1250),
+                          ('gerrit', 1260), ('gerrit', 1270)], self.runs)
+
+    def test_failed_task_is_rescheduled(self):
+        def fail():
+            self.runs.append('fail')
+            raise Exception('source is down')
+
+        self.scheduler.add('mail', fail, 100)
+
+        self.assertTrue(self.scheduler.run_pending())
+        self.assertFalse(self.scheduler.run_pending())
+        self.clock.now += 100
+        self.assertTrue(self.scheduler.run_pending())
+        self.assertEqual(['fail', 'fail'], self.runs)
+
+    def test_disabled_task(self):
+        self._add('members', 0)
+
+        self.assertFalse(self.scheduler.run_pending())
+        self.assertEqual([], self.runs)
+
+    def test_running_task_is_not_started_again(self):
+        def action():
+            self.runs.append('git')
+            # a nested run does not start the same task again
+            self.scheduler.run_pending()
+
+        self.scheduler.add('git', action, 100)
+        self.scheduler.run_pending()
+
+        self.assertEqual(['git'], self.runs)
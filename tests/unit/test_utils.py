@@ -13,6 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import socket
+import threading
+import time
+
+import mock
+from six.moves import BaseHTTPServer
+from six.moves import http_client
 import testtools
 
 from spectrometer.processor import utils
@@ -90,3 +98,195 @@ class TestUtils(testtools.TestCase):
 
         self.assertEqual(normalized_company_names,
                          correct_normalized_company_names)
+
+    def test_project(self):
+        projection = {
+            'id': None,
+            'owner': {'name': None},
+            'patchSets': {'number': None, 'approvals': {'value': None}},
+        }
+        line = ('{"id": "I1", "subject": "Fix", "owner": {"name": "John", '
+                '"email": "john@example.com"}, "patchSets": [{"number": "1", '
+                '"files": [{"file": "a.py"}], "approvals": [{"value": "2", '
+                '"type": "Code-Review"}]}, {"number": "2", "name": "x"}]}')
+
+        self.assertEqual({'id': 'I1', 'owner': {'name': 'John'},
+                          'patchSets': [{'number': '1',
+                                         'approvals': [{'value': '2'}]},
+                                        {'number': '2'}]},
+                         utils.project(json.loads(line), projection))
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_rate_limiter(self, time_mock, sleep_mock):
+        time_mock.return_value = 100.0
+        rate_limiter = utils.RateLimiter(4)
+
+        for i in range(3):
+            rate_limiter.wait()
+
+        self.assertEqual([mock.call(0.25), mock.call(0.5)],
+                         sleep_mock.call_args_list)
+
+    @mock.patch('time.sleep')
+    def test_http_connection_pool_retries(self, sleep_mock):
+        pool = utils.HttpConnectionPool(retries=2, backoff=1)
+        responses = [socket.error('reset'), (503, {}, ''), (200, {}, 'ok')]
+
+        def request(key, path, headers):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with mock.patch.object(pool, '_request', side_effect=request):
+            self.assertEqual((200, {}, 'ok'),
+                             pool.request('http://lists/index.html'))
+
+        self.assertEqual([mock.call(1), mock.call(2)],
+                         sleep_mock.call_args_list)
+
+    @mock.patch('time.sleep')
+    def test_http_connection_pool_retries_exhausted(self, sleep_mock):
+        pool = utils.HttpConnectionPool(retries=1)
+
+        with mock.patch.object(pool, '_request',
+                               return_value=(503, {}, '')) as request:
+            self.assertEqual(503, pool.request('http://lists/')[0])
+            self.assertEqual(2, request.call_count)
+
+        with mock.patch.object(pool, '_request',
+                               return_value=(404, {}, '')) as request:
+            self.assertEqual(404, pool.request('http://lists/')[0])
+            self.assertEqual(1, request.call_count)
+
+    def test_http_connection_pool_redirects(self):
+        pool = utils.HttpConnectionPool()
+        responses = {
+            ('http', 'old'): (301, {'location': 'http://new/data/a.json'},
+                              ''),
+            ('http', 'new'): (200, {}, 'content'),
+        }
+        requests = []
+
+        def request(key, path, headers):
+            requests.append((key, path))
+            if path == '/data/a.json':
+                return (302, {'location': 'b.json'}, '')
+            return responses[key]
+
+        with mock.patch.object(pool, '_request', side_effect=request):
+            self.assertEqual((200, {}, 'content'),
+                             pool.request('http://old/a.json'))
+
+        # the relative location is resolved against the redirected uri
+        self.assertEqual([(('http', 'old'), '/a.json'),
+                          (('http', 'new'), '/data/a.json'),
+                          (('http', 'new'), '/data/b.json')], requests)
+
+    def test_http_connection_pool_redirect_loop(self):
+        pool = utils.HttpConnectionPool()
+
+        with mock.patch.object(pool, '_request',
+                               return_value=(302, {'location': '/'}, '')):
+            self.assertRaises(http_client.HTTPException,
+                              pool.request, 'http://lists/')
+
+    def test_http_connection_pool_connections_per_host(self):
+        pool = utils.HttpConnectionPool(connections_per_host=2)
+        running = {}
+        peaks = {}
+        lock = threading.Lock()
+
+        def request(key, path, headers):
+            with lock:
+                running[key] = running.get(key, 0) + 1
+                peaks[key] = max(peaks.get(key, 0), running[key])
+            time.sleep(0.01)
+            with lock:
+                running[key] -= 1
+            return 200, {}, ''
+
+        with mock.patch.object(pool, '_request', side_effect=request):
+            list(utils.imap_concurrently(
+                pool.request, ['http://a/%d' % i for i in range(6)] +
+                ['http://b/%d' % i for i in range(6)], 8))
+
+        self.assertEqual({('http', 'a'): 2, ('http', 'b'): 2}, peaks)
+
+    def test_imap_concurrently(self):
+        def square(x):
+            # later items complete first
+            time.sleep(0.01 * (5 - x))
+            return x * x
+
+        self.assertEqual([0, 1, 4, 9, 16],
+                         list(utils.imap_concurrently(square, range(5), 3)))
+
+    def test_imap_concurrently_raises_in_order(self):
+        def check(x):
+            if x == 1:
+                raise ValueError(x)
+            return x
+
+        iterator = utils.imap_concurrently(check, range(3), 2)
+        self.assertEqual(0, next(iterator))
+        self.assertRaises(ValueError, next, iterator)
+
+    def test_imap_concurrently_closed_early(self):
+        lock = threading.Lock()
+        called = []
+        workers = set()
+
+        def call(x):
+            with lock:
+                called.append(x)
+                workers.add(threading.current_thread())
+            return x
+
+        iterator = utils.imap_concurrently(call, range(100), 3)
+        self.assertEqual(0, next(iterator))
+        iterator.close()
+
+        # workers waiting for a slot exit without calling the rest
+        for worker in list(workers):
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+        self.assertTrue(len(called) < 100)
+
+    @mock.patch('spectrometer.processor.utils.HTTP_CONNECTION_POOL')
+    def test_read_uri_http(self, pool):
+        pool.request.return_value = (200, {}, 'content')
+        self.assertEqual('content', utils.read_uri('http://host/file.json'))
+
+        pool.request.return_value = (404, {}, 'not found')
+        self.assertIsNone(utils.read_uri('http://host/file.json'))
+
+    def test_read_uri_follows_redirect(self):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/old.json':
+                    self.send_response(301)
+                    self.send_header('Location', '/new.json')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                else:
+                    self.send_response(200)
+                    self.send_header('Content-Length', '2')
+                    self.end_headers()
+                    self.wfile.write('{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with mock.patch.object(utils, 'HTTP_CONNECTION_POOL',
+                               utils.HttpConnectionPool(timeout=5)):
+            self.assertEqual({}, utils.read_json_from_uri(
+                'http://127.0.0.1:%d/old.json' % server.server_port))
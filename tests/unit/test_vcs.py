@@ -13,7 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import subprocess
+
+import fixtures
 import mock
+import six
 import testtools
 
 from spectrometer.processor import vcs
@@ -28,7 +33,8 @@ class TestVcsProcessor(testtools.TestCase):
             'uri': 'git://github.com/dummy.git',
             'releases': []
         }
-        self.git = vcs.Git(self.repo, '/tmp')
+        self.sources_root = self.useFixture(fixtures.TempDir()).path
+        self.git = vcs.Git(self.repo, self.sources_root)
         self.chdir_patcher = mock.patch('os.chdir')
         self.chdir_patcher.start()
 
@@ -157,3 +163,254 @@ diff_stat:
              {'author_name': 'Bob Dylan',
               'author_email': 'bob.dylan@openstack.com'}],
             commits[5]['coauthor'])
+
+    def test_git_log_all_branch_membership(self):
+        log_output = '''
+commit_id:0000000000000000000000000000000000000003
+date:1369119386
+author_name:John Doe
+author_email:john.doe@dreamhost.com
+subject:Fix in stable
+message:Change-Id: Id26fdfd2af4862652d7270aec132d40662efeb96
+
+diff_stat:
+
+ 1 file changed, 1 insertion(+)
+commit_id:0000000000000000000000000000000000000002
+date:1369119385
+author_name:John Doe
+author_email:john.doe@dreamhost.com
+subject:Shared fix
+message:Change-Id: Id26fdfd2af4862652d7270aec132d40662efeb97
+
+diff_stat:
+
+ 2 files changed, 3 insertions(+), 4 deletions(-)
+commit_id:0000000000000000000000000000000000000001
+date:1369119384
+author_name:John Doe
+author_email:john.doe@dreamhost.com
+subject:Initial commit
+message:Change-Id: Id26fdfd2af4862652d7270aec132d40662efeb98
+
+diff_stat:
+
+ 1 file changed, 1 insertion(+)
+'''
+        outputs = {
+            'for-each-ref': [
+                '0000000000000000000000000000000000000004 '
+                'refs/remotes/origin/master\n',
+                '0000000000000000000000000000000000000003 '
+                'refs/remotes/origin/stable/helium\n',
+            ],
+            'rev-list': [
+                '0000000000000000000000000000000000000004 '
+                '0000000000000000000000000000000000000002\n',
+                '0000000000000000000000000000000000000003 '
+                '0000000000000000000000000000000000000002\n',
+                '0000000000000000000000000000000000000002 '
+                '0000000000000000000000000000000000000001\n',
+                '0000000000000000000000000000000000000001\n',
+            ],
+            'log': log_output,
+        }
+
+        def git(cmd, *args, **kwargs):
+            return outputs[cmd]
+
+        with mock.patch('sh.git') as git_mock:
+            git_mock.side_effect = git
+            commits = list(self.git.log_all({
+                'master': '0000000000000000000000000000000000000004',
+                'stable/helium': None}))
+
+        # parents come before children
+        self.assertEqual(['0000000000000000000000000000000000000001',
+                          '0000000000000000000000000000000000000002',
+                          '0000000000000000000000000000000000000003'],
+                         [c['commit_id'] for c in commits])
+        self.assertEqual(set(['stable/helium']), commits[2]['branches'])
+        self.assertEqual(set(['master', 'stable/helium']),
+                         commits[1]['branches'])
+        self.assertEqual(2, commits[1]['files_changed'])
+        self.assertEqual(4, commits[1]['lines_deleted'])
+
+        log_call = git_mock.call_args_list[-1]
+        self.assertEqual('0000000000000000000000000000000000000003\n'
+                         '0000000000000000000000000000000000000002\n'
+                         '0000000000000000000000000000000000000001\n',
+                         log_call[1]['_in'])
+
+        # the second pass takes parsed commits from the cache
+        with mock.patch('sh.git') as git_mock:
+            git_mock.side_effect = git
+            cached_commits = list(self.git.log_all({
+                'master': '0000000000000000000000000000000000000004',
+                'stable/helium': None}))
+
+        self.assertEqual(commits, cached_commits)
+        self.assertNotIn('log', [c[0][0] for c in git_mock.call_args_list])
+
+    def test_get_vcs_libgit2(self):
+        with mock.patch.object(vcs, 'pygit2', mock.Mock()):
+            vcs_inst = vcs.get_vcs(self.repo, self.sources_root, 'libgit2')
+        self.assertIsInstance(vcs_inst, vcs.LibGit2)
+
+    def test_get_vcs_libgit2_fallback(self):
+        with mock.patch.object(vcs, 'pygit2', None):
+            vcs_inst = vcs.get_vcs(self.repo, self.sources_root, 'libgit2')
+        self.assertEqual(vcs.Git, type(vcs_inst))
+
+    def test_ls_remote(self):
+        with mock.patch('sh.git') as git_mock:
+            git_mock.return_value = [
+                '0000000000000000000000000000000000000004\t'
+                'refs/heads/master\n',
+                '0000000000000000000000000000000000000003\t'
+                'refs/heads/stable/helium\n',
+            ]
+            heads = self.git.ls_remote()
+
+        self.assertEqual({
+            'master': '0000000000000000000000000000000000000004',
+            'stable/helium': '0000000000000000000000000000000000000003'},
+            heads)
+
+
+class TestLibGit2(testtools.TestCase):
+    """Compares libgit2 and git backends over a real repository."""
+
+    def setUp(self):
+        super(TestLibGit2, self).setUp()
+        if not vcs.pygit2:
+            self.skipTest('pygit2 is not available')
+        self.addCleanup(os.chdir, os.getcwd())
+        self.useFixture(fixtures.EnvironmentVariable(
+            'GIT_CONFIG_NOSYSTEM', '1'))
+        for name in ('AUTHOR', 'COMMITTER'):
+            self.useFixture(fixtures.EnvironmentVariable(
+                'GIT_%s_NAME' % name, 'John Doe'))
+            self.useFixture(fixtures.EnvironmentVariable(
+                'GIT_%s_EMAIL' % name, 'john@example.com'))
+
+        origin = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'dummy.git')
+        self._make_origin(origin)
+        self.repo = {'module': 'dummy', 'uri': origin, 'releases': []}
+
+    def _git(self, *args):
+        subprocess.check_call(('git',) + args, cwd=self.origin,
+                              stdout=open(os.devnull, 'w'))
+
+    def _commit(self, message, date, files=None, allow_empty=False):
+        for file_name, content in six.iteritems(files or {}):
+            with open(os.path.join(self.origin, file_name), 'w') as fd:
+                fd.write(content)
+            self._git('add', file_name)
+        env = {'GIT_AUTHOR_DATE': '%d +0000' % date,
+               'GIT_COMMITTER_DATE': '%d +0000' % date}
+        args = ['git', 'commit', '-q', '-m', message]
+        if allow_empty:
+            args.append('--allow-empty')
+        subprocess.check_call(args, cwd=self.origin,
+                              env=dict(os.environ, **env))
+
+    def _make_origin(self, origin):
+        self.origin = origin
+        os.mkdir(origin)
+        self._git('init', '-q')
+        self._git('checkout', '-q', '-b', 'master')
+        self._commit('Initial commit', 1400000000,
+                     {'a.py': 'a\nb\nc\n', 'b.py': 'x\n'})
+        self._commit('Fix bug 123\n\nCloses-Bug: #123', 1400000100,
+                     {'a.py': 'a\nc\nd\ne\n'})
+        self._git('checkout', '-q', '-b', 'stable/helium')
+        self._commit('Backport fix\nto stable\n\nBody line 1\nBody line 2',
+                     1400000200, {'b.py': 'y\n'})
+        self._commit('Empty commit', 1400000300, allow_empty=True)
+        self._git('checkout', '-q', 'master')
+        self._commit('Delete lines', 1400000400, {'a.py': 'a\n'})
+
+    def _log(self, cls, head_commit_ids):
+        sources_root = self.useFixture(fixtures.TempDir()).path
+        vcs_inst = cls(self.repo, sources_root)
+        vcs_inst.fetch()
+        return list(vcs_inst.log_all(head_commit_ids))
+
+    def _sorted(self, commits):
+        return sorted(commits, key=lambda commit: commit['commit_id'])
+
+    def test_log_all_same_as_git(self):
+        heads = {'master': None, 'stable/helium': None}
+        git_commits = self._log(vcs.Git, heads)
+        libgit2_commits = self._log(vcs.LibGit2, heads)
+
+        # the empty commit is skipped
+        self.assertEqual(['Initial commit', 'Fix bug 123',
+                          'Backport fix to stable', 'Delete lines'],
+                         [c['subject'] for c in sorted(
+                             git_commits, key=lambda c: c['date'])])
+        self.assertEqual(u'Body line 1\nBody line 2\n', git_commits[
+            [c['date'] for c in git_commits].index(1400000200)]['message'])
+        # order of commits of different branches is up to the walk
+        self.assertEqual(self._sorted(git_commits),
+                         self._sorted(libgit2_commits))
+
+    def test_is_ancestor_same_as_git(self):
+        commits = self._log(vcs.Git, {'master': None, 'stable/helium': None})
+        ids = dict((c['subject'], c['commit_id']) for c in commits)
+        initial = ids['Initial commit']
+        backport = ids['Backport fix to stable']
+        delete = ids['Delete lines']
+
+        for cls in (vcs.Git, vcs.LibGit2):
+            vcs_inst = cls(self.repo, self.useFixture(fixtures.TempDir()).path)
+            vcs_inst.fetch()
+            self.assertTrue(vcs_inst.is_ancestor(initial, delete))
+            self.assertTrue(vcs_inst.is_ancestor(delete, delete))
+            self.assertFalse(vcs_inst.is_ancestor(delete, initial))
+            self.assertFalse(vcs_inst.is_ancestor(backport, delete))
+
+    def test_log_all_from_last_ids_same_as_git(self):
+        first_id = self._log(vcs.Git, {'master': None})[0]['commit_id']
+        heads = {'master': first_id, 'stable/helium': first_id}
+
+        git_commits = self._log(vcs.Git, heads)
+
+        self.assertEqual(3, len(git_commits))
+        self.assertEqual(self._sorted(git_commits),
+                         self._sorted(self._log(vcs.LibGit2, heads)))
+
+    def test_read_log_same_as_git(self):
+        sources_root = self.useFixture(fixtures.TempDir()).path
+        git = vcs.Git(self.repo, sources_root)
+        git.fetch()
+        libgit2 = vcs.LibGit2(self.repo, sources_root)
+        commit_ids = [commit_id for commit_id, parents in git._walk(
+            list(git._get_remote_heads().values()), [])]
+
+        self.assertEqual(5, len(commit_ids))
+        self.assertEqual(list(git._read_log(commit_ids)),
+                         list(libgit2._read_log(commit_ids)))
+
+    def test_walk_and_merge_bases(self):
+        sources_root = self.useFixture(fixtures.TempDir()).path
+        git = vcs.Git(self.repo, sources_root)
+        git.fetch()
+        libgit2 = vcs.LibGit2(self.repo, sources_root)
+        heads = git._get_remote_heads()
+
+        self.assertEqual(heads, libgit2._get_remote_heads())
+        self.assertEqual(git._get_merge_bases(list(heads.values())),
+                         libgit2._get_merge_bases(list(heads.values())))
+        git_walk = list(git._walk(list(heads.values()), []))
+        libgit2_walk = list(libgit2._walk(list(heads.values()), []))
+        self.assertEqual(dict(git_walk), dict(libgit2_walk))
+        # parents are listed after their children
+        for walk in (git_walk, libgit2_walk):
+            order = [commit_id for commit_id, parents in walk]
+            for commit_id, parents in walk:
+                for parent in parents:
+                    self.assertGreater(order.index(parent),
+                                       order.index(commit_id))
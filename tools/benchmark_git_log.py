@@ -0,0 +1,74 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure Git.log_all time before and after repo maintenance.
+
+Usage: python tools/benchmark_git_log.py <sources_root> <repo uri> [runs]
+
+The repo must already be cloned into sources_root. The commit cache is
+bypassed, so every run reads the full history through git.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from spectrometer.processor import commit_cache
+from spectrometer.processor import vcs
+
+
+def _measure(git, runs):
+    walk_timings = []
+    log_timings = []
+    for i in range(runs):
+        start = time.time()
+        os.chdir(git.folder)
+        heads = git._get_remote_heads()
+        list(git._walk([heads['master']], []))
+        walk_timings.append(time.time() - start)
+
+        cache_root = tempfile.mkdtemp()
+        git.commit_cache = commit_cache.CommitCache(cache_root)
+        start = time.time()
+        count = len(list(git.log_all({'master': None})))
+        log_timings.append(time.time() - start)
+        git.commit_cache.close()
+        shutil.rmtree(cache_root)
+    return count, min(walk_timings), min(log_timings)
+
+
+def main():
+    sources_root, uri = sys.argv[1], sys.argv[2]
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    git = vcs.Git({'uri': uri, 'module': 'benchmark', 'releases': []},
+                  sources_root)
+
+    print('before maintenance: %d commits, walk %.2fs, log %.2fs' %
+          _measure(git, runs))
+
+    for task in ['prune', 'repack', 'commit-graph']:
+        start = time.time()
+        git.maintain(task)
+        print('%s took %.2fs' % (task, time.time() - start))
+
+    print('after maintenance: %d commits, walk %.2fs, log %.2fs' %
+          _measure(git, runs))
+
+
+if __name__ == '__main__':
+    main()